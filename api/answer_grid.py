@@ -0,0 +1,302 @@
+import io
+import math
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from .dataset_version import get_dataset_version
+from .models import FoodTruck, PrecomputedGrid
+from .process_cache import ProcessWideCache
+from .ranking import AMBIGUITY_RATIO, HaversineRanker
+from .street_graph import haversine_meters
+from .walking_time import METERS_PER_DEGREE_LATITUDE
+
+# Slack (in meters) absorbing rounding errors when checking that a cell's
+# candidates are enough to answer a query
+CERTIFICATE_SLACK_METERS = 0.01
+
+
+class AnswerGrid:
+    """
+    Straight-line candidates precomputed for a grid over the trucks' bounding box.
+
+    Each cell stores the `candidates` trucks closest to its center, and every
+    other truck as close as the farthest of them, within `radius` meters of the
+    center. For a query point p at `offset` meters from its cell's center, every
+    other truck is farther than radius - offset from p, so when the k-th nearest
+    eligible candidate is closer than that (with the geodesic ambiguity margin),
+    ranking the candidates alone gives the same answer as the full index, for
+    any time filter. Otherwise the lookup misses and the caller uses the index.
+    """
+
+    def __init__(
+        self,
+        min_lat,
+        min_long,
+        lat_step,
+        long_step,
+        rows,
+        columns,
+        ids,
+        latitudes,
+        longitudes,
+        offsets,
+        positions,
+        radii,
+    ):
+        self.min_lat = float(min_lat)
+        self.min_long = float(min_long)
+        self.lat_step = float(lat_step)
+        self.long_step = float(long_step)
+        self.rows = int(rows)
+        self.columns = int(columns)
+        # Trucks in truck index order, so that ties are broken the same way
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        # Candidates of cell c: positions[offsets[c]:offsets[c + 1]]
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.int32)
+        self.radii = np.asarray(radii, dtype=np.float64)
+
+    @classmethod
+    def empty(cls):
+        """
+        A grid without cells, which never answers.
+        """
+        return cls(0, 0, 1, 1, 0, 0, [], [], [], [0], [], [])
+
+    @classmethod
+    def build(cls, trucks, cell_meters, candidates):
+        """
+        Build the grid for (truck_id, latitude, longitude) trucks, given in
+        truck index order.
+        """
+        trucks = list(trucks)
+        if not trucks:
+            return cls.empty()
+        ids = [truck_id for truck_id, _, _ in trucks]
+        latitudes = np.array([lat for _, lat, _ in trucks], dtype=np.float64)
+        longitudes = np.array([long for _, _, long in trucks], dtype=np.float64)
+        ranker = HaversineRanker(ids, latitudes, longitudes)
+
+        lat_step = cell_meters / METERS_PER_DEGREE_LATITUDE
+        mid_lat = math.radians((latitudes.min() + latitudes.max()) / 2)
+        long_step = lat_step / max(math.cos(mid_lat), 1e-6)
+        rows = int((latitudes.max() - latitudes.min()) // lat_step) + 1
+        columns = int((longitudes.max() - longitudes.min()) // long_step) + 1
+        if rows * columns > settings.ANSWER_GRID_MAX_CELLS:
+            raise ValueError(
+                f"A grid of {rows} x {columns} cells exceeds ANSWER_GRID_MAX_CELLS, "
+                "use larger cells."
+            )
+
+        offsets = [0]
+        positions = []
+        radii = []
+        for row in range(rows):
+            for column in range(columns):
+                meters = ranker.distances(
+                    latitudes.min() + (row + 0.5) * lat_step,
+                    longitudes.min() + (column + 0.5) * long_step,
+                )
+                if len(meters) > candidates:
+                    radius = float(np.partition(meters, candidates - 1)[candidates - 1])
+                    selected = np.flatnonzero(meters <= radius)
+                else:
+                    radius = math.inf
+                    selected = np.arange(len(meters))
+                positions.extend(selected.tolist())
+                offsets.append(len(positions))
+                radii.append(radius)
+
+        return cls(
+            latitudes.min(),
+            longitudes.min(),
+            lat_step,
+            long_step,
+            rows,
+            columns,
+            ids,
+            latitudes,
+            longitudes,
+            offsets,
+            positions,
+            radii,
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(bytes(data))) as arrays:
+            return cls(
+                *arrays["geometry"],
+                arrays["ids"],
+                arrays["latitudes"],
+                arrays["longitudes"],
+                arrays["offsets"],
+                arrays["positions"],
+                arrays["radii"],
+            )
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            geometry=np.array(
+                [
+                    self.min_lat,
+                    self.min_long,
+                    self.lat_step,
+                    self.long_step,
+                    self.rows,
+                    self.columns,
+                ]
+            ),
+            ids=self.ids,
+            latitudes=self.latitudes,
+            longitudes=self.longitudes,
+            offsets=self.offsets,
+            positions=self.positions,
+            radii=self.radii,
+        )
+        return buffer.getvalue()
+
+    @property
+    def cell_count(self):
+        return self.rows * self.columns
+
+    def cell_for(self, lat, long):
+        """
+        Index of the cell containing the coordinate, None outside the grid.
+        """
+        if not (math.isfinite(lat) and math.isfinite(long)):
+            return None
+        row = math.floor((lat - self.min_lat) / self.lat_step)
+        column = math.floor((long - self.min_long) / self.long_step)
+        if not (0 <= row < self.rows and 0 <= column < self.columns):
+            return None
+        return row * self.columns + column
+
+    def nearest(self, lat, long, k=10, allowed_ids=None, exact=True):
+        """
+        Same answer as `TruckSpatialIndex.nearest`, computed from the cell's
+        candidates only, or None when they are not enough to be sure of it.
+        """
+        cell = self.cell_for(lat, long)
+        if cell is None or k <= 0:
+            return None
+        row, column = divmod(cell, self.columns)
+        candidates = self.positions[self.offsets[cell] : self.offsets[cell + 1]]
+        ranker = HaversineRanker(
+            self.ids[candidates],
+            self.latitudes[candidates],
+            self.longitudes[candidates],
+        )
+        mask = None
+        if allowed_ids is not None:
+            mask = np.isin(ranker.ids, list(allowed_ids))
+        ranked = ranker.top_k(lat, long, k=k, mask=mask, exact=exact)
+
+        radius = self.radii[cell]
+        if not math.isinf(radius):
+            if len(ranked) < k:
+                return None
+            # Spherical distance of the k-th candidate, whatever the ranking used
+            kth = float(ranker.distances(lat, long)[[p for p, _ in ranked]].max())
+            offset = float(
+                haversine_meters(
+                    lat,
+                    long,
+                    self.min_lat + (row + 0.5) * self.lat_step,
+                    self.min_long + (column + 0.5) * self.long_step,
+                )
+            )
+            limit = kth * AMBIGUITY_RATIO if exact else kth
+            if limit > radius - offset - CERTIFICATE_SLACK_METERS:
+                return None
+        return [(int(ranker.ids[position]), meters) for position, meters in ranked]
+
+
+def build_answer_grid(cell_meters=None, candidates=None):
+    """
+    Precompute the grid for the current trucks and store it for the current
+    dataset version, replacing older grids. Returns the stored grid.
+    """
+    cell_meters = cell_meters or settings.ANSWER_GRID_CELL_METERS
+    candidates = candidates or settings.ANSWER_GRID_CANDIDATES
+    # Same query as the truck index, hence the same order
+    grid = AnswerGrid.build(
+        FoodTruck.objects.values_list("id", "latitude", "longitude"),
+        cell_meters,
+        candidates,
+    )
+    with transaction.atomic():
+        PrecomputedGrid.objects.all().delete()
+        PrecomputedGrid.objects.create(
+            dataset_version=get_dataset_version(),
+            cell_meters=cell_meters,
+            candidates=candidates,
+            data=grid.to_bytes(),
+        )
+    invalidate_answer_grid()
+    return grid
+
+
+def discard_answer_grids(**kwargs):
+    """
+    Delete the stored grids, e.g. after a truck was edited in place. Also
+    usable as a signal receiver.
+    """
+    PrecomputedGrid.objects.all().delete()
+    invalidate_answer_grid()
+
+
+def refresh_answer_grid():
+    """
+    Rebuild the grid of the current dataset version, with the same cell size
+    and candidates, after trucks were added, moved or deleted in place. A grid
+    that no longer fits ANSWER_GRID_MAX_CELLS is discarded.
+    """
+    stored = (
+        PrecomputedGrid.objects.filter(dataset_version=get_dataset_version())
+        .order_by("-id")
+        .values_list("cell_meters", "candidates")
+        .first()
+    )
+    if stored is None:
+        return
+    try:
+        build_answer_grid(*stored)
+    except ValueError:
+        discard_answer_grids()
+
+
+def _load_answer_grid():
+    stored = (
+        PrecomputedGrid.objects.filter(dataset_version=get_dataset_version())
+        .order_by("-id")
+        .first()
+    )
+    # An empty grid (rather than None) avoids querying again on every request
+    return AnswerGrid.from_bytes(stored.data) if stored else AnswerGrid.empty()
+
+
+def _grid_fingerprint():
+    return (
+        get_dataset_version(),
+        PrecomputedGrid.objects.order_by("-id").values_list("id", flat=True).first(),
+    )
+
+
+_answer_grid = ProcessWideCache(_load_answer_grid, _grid_fingerprint)
+
+
+def get_answer_grid():
+    """
+    Return the process-wide grid of the current dataset version, or an empty
+    grid when none was precomputed.
+    """
+    return _answer_grid.get()
+
+
+def invalidate_answer_grid(**kwargs):
+    _answer_grid.invalidate()
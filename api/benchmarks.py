@@ -0,0 +1,558 @@
+import csv
+import functools
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, models
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+from .csv_parsing import is_locatable, map_row, parse_hours
+from .importer import bulk_import
+from .models import FoodTruck, FoodTruckOperatingHour
+from .ranking import HaversineRanker
+from .serializers import FoodTruckSerializer, TruckFragmentCache
+from .spatial_index import TruckSpatialIndex, nearest_from_database
+from .synthetic import (
+    SF_BOUNDS,
+    FakeDistanceMatrixClient,
+    FakeGoogleMapsServer,
+    temporary_database,
+)
+from .utils import calculate_straight_distance_between_two_points
+from .walking_time import GoogleDistanceMatrixProvider
+from .week_bitmap import DAYS
+
+SyntheticTruck = namedtuple("SyntheticTruck", ["id", "latitude", "longitude"])
+
+# Index on the operating hours foreign key, as it was before the (food_truck, day) one
+LEGACY_HOURS_INDEX = models.Index(fields=["food_truck"], name="operating_hour_truck")
+
+# Projection timed by the serializer section in addition to every field
+SERIALIZER_PROJECTION = ["applicant", "address", "food_items", "latitude", "longitude"]
+TRUCKS_PER_RESPONSE = 5
+
+# (name, fake server behaviour, client options) of each Google client scenario
+GOOGLE_CLIENT_SCENARIOS = [
+    ("healthy", {}, {}),
+    ("slow_tail", {"slow_rate": 0.05}, {}),
+    ("slow_tail_no_hedging", {"slow_rate": 0.05}, {"hedge_after_ms": 0}),
+    ("outage", {"error_rate": 1.0}, {}),
+    ("flaky", {"error_rate": 0.1}, {}),
+    ("over_quota", {}, {"elements_per_second": 200, "burst_elements": 100}),
+]
+GOOGLE_CLIENT_CONCURRENCY = 16
+GOOGLE_CLIENT_SLOW_MS = 1000
+GOOGLE_CLIENT_HEDGE_AFTER_MS = 150
+DESTINATIONS_PER_CALL = 10
+
+# What a WSGI worker imports before serving its first request. Loading the
+# URLconf imports the views, which the first request would otherwise pay for.
+WSGI_BOOT = (
+    "import food_trucks_locator.wsgi\n"
+    "from django.urls import get_resolver\n"
+    "get_resolver().url_patterns\n"
+)
+STARTUP_RUNS = 5
+# Slowest packages listed per startup target
+STARTUP_TOP_PACKAGES = 8
+
+
+def summarize(latencies, elapsed=None):
+    """
+    Latency statistics (in milliseconds) of a list of per-call durations in
+    seconds, and the throughput when the wall time of the run is given.
+    """
+    latencies = sorted(seconds * 1000 for seconds in latencies)
+
+    def percentile(percent):
+        # Nearest-rank percentile
+        return latencies[max(0, -(-len(latencies) * percent // 100) - 1)]
+
+    summary = {
+        "count": len(latencies),
+        "mean_ms": sum(latencies) / len(latencies),
+        "min_ms": latencies[0],
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": latencies[-1],
+    }
+    if elapsed:
+        summary["per_second"] = len(latencies) / elapsed
+    return summary
+
+
+def time_each(call, arguments):
+    """
+    Call `call(*argument)` for each argument and summarize the durations.
+    """
+    latencies = []
+    started = time.perf_counter()
+    for argument in arguments:
+        call_started = time.perf_counter()
+        call(*argument)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def random_points(rng, count):
+    (min_lat, max_lat), (min_long, max_long) = SF_BOUNDS
+    return [
+        (rng.uniform(min_lat, max_lat), rng.uniform(min_long, max_long))
+        for _ in range(count)
+    ]
+
+
+def throughput(rows, seconds):
+    return {"rows": rows, "seconds": seconds, "per_second": rows / seconds}
+
+
+def benchmark_loader(csv_path, directory, workers, legacy_rows):
+    """
+    The bulk loader, with each number of parser processes in `workers`, and
+    the previous row-by-row loader on the first `legacy_rows` rows.
+    """
+    results = {}
+    if legacy_rows:
+        with temporary_database(os.path.join(directory, "legacy.sqlite3")):
+            started = time.perf_counter()
+            rows = legacy_load(csv_path, legacy_rows)
+            results["loader.row_by_row"] = throughput(
+                rows, time.perf_counter() - started
+            )
+
+    for count in workers:
+        with temporary_database(os.path.join(directory, "bulk.sqlite3")):
+            stats = bulk_import(csv_path, workers=count)
+        results[f"loader.bulk_x{count}"] = throughput(stats.rows, stats.elapsed)
+        for stage in stats.stages.values():
+            results[f"loader.bulk_x{count}.{stage.name}"] = throughput(
+                stage.rows, stage.seconds
+            )
+    return results
+
+
+def legacy_load(csv_path, limit):
+    # The loader used before bulk imports: one existence check and one
+    # insert per row and per operating hour, in autocommit mode
+    errors = []
+    count = 0
+    with open(csv_path, mode="r", encoding="utf-8-sig") as file:
+        for count, row in enumerate(csv.DictReader(file), start=1):
+            if not FoodTruck.objects.filter(
+                location_id=row["locationid"],
+                latitude=row["Latitude"],
+                longitude=row["Longitude"],
+            ).exists() and is_locatable(row):
+                food_truck = FoodTruck.objects.create(**map_row(row, errors))
+                if row.get("dayshours"):
+                    for hour_data in parse_hours(row["dayshours"]):
+                        FoodTruckOperatingHour.objects.create(
+                            food_truck=food_truck, **hour_data
+                        )
+            if count >= limit:
+                break
+    return count
+
+
+def benchmark_queries(rng, queries, k):
+    """
+    The nearest truck and operating hours queries on the loaded trucks,
+    without and then with the coordinates and (food_truck, day) indexes.
+    Each result holds the SQLite plan of the query.
+    """
+    points = random_points(rng, queries)
+    truck_ids = list(
+        FoodTruckOperatingHour.objects.values_list("food_truck_id", flat=True)
+        .distinct()
+        .order_by("food_truck_id")
+    )
+    hour_lookups = [(rng.choice(truck_ids), rng.choice(DAYS)) for _ in range(queries)]
+    lat, long = points[0]
+    plans = {
+        "whole_table": FoodTruck.objects.values_list("id", "latitude", "longitude"),
+        "bounding_box": FoodTruck.objects.filter(
+            latitude__range=(lat - 0.005, lat + 0.005),
+            longitude__range=(long - 0.006, long + 0.006),
+        ).values_list("id", "latitude", "longitude"),
+        "operating_hours": FoodTruckOperatingHour.objects.filter(
+            food_truck_id=hour_lookups[0][0], day=hour_lookups[0][1]
+        ).values_list("open_time", "close_time"),
+    }
+    runs = {
+        # The previous nearest truck query read the whole table
+        "whole_table": (
+            lambda lat, long: list(
+                FoodTruck.objects.values_list("id", "latitude", "longitude")
+            ),
+            points,
+        ),
+        "bounding_box": (
+            lambda lat, long: nearest_from_database(lat, long, k=k),
+            points,
+        ),
+        "operating_hours": (
+            lambda truck_id, day: list(
+                FoodTruckOperatingHour.objects.filter(
+                    food_truck_id=truck_id, day=day
+                ).values_list("open_time", "close_time")
+            ),
+            hour_lookups,
+        ),
+    }
+
+    results = {}
+    for label, indexes in (("without_indexes", False), ("with_indexes", True)):
+        set_indexes(present=indexes)
+        for name, (query, arguments) in runs.items():
+            result = time_each(query, arguments)
+            # SQLite plan rows are "id parent notused detail"
+            result["plan"] = " / ".join(
+                line.split(maxsplit=3)[-1]
+                for line in plans[name].explain().splitlines()
+            )
+            results[f"queries.{name}.{label}"] = result
+    return results
+
+
+def set_indexes(present):
+    with connection.schema_editor() as schema_editor:
+        for model in (FoodTruck, FoodTruckOperatingHour):
+            for index in model._meta.indexes:
+                if present:
+                    schema_editor.add_index(model, index)
+                else:
+                    schema_editor.remove_index(model, index)
+        if present:
+            schema_editor.remove_index(FoodTruckOperatingHour, LEGACY_HOURS_INDEX)
+        else:
+            schema_editor.add_index(FoodTruckOperatingHour, LEGACY_HOURS_INDEX)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+
+def benchmark_ranking(rng, sizes, queries, k, legacy_rows):
+    """
+    Straight-line candidate ranking engines on in-memory synthetic trucks of
+    each size. The previous per-row loop is timed on at most `legacy_rows`
+    trucks and extrapolated, being linear.
+    """
+    results = {}
+    for size in sizes:
+        trucks = [
+            SyntheticTruck(i, lat, long)
+            for i, (lat, long) in enumerate(random_points(rng, size))
+        ]
+        points = random_points(rng, queries)
+
+        legacy_size = min(size, legacy_rows) or size
+        result = time_each(
+            lambda lat, long: legacy_top_k(trucks[:legacy_size], lat, long, k),
+            points[:1],
+        )
+        scale = size / legacy_size
+        results[f"ranking.legacy_loop.{size}"] = {
+            **{
+                name: value * scale if name.endswith("_ms") else value
+                for name, value in result.items()
+                if name != "per_second"
+            },
+            "extrapolated": legacy_size < size,
+        }
+
+        started = time.perf_counter()
+        ranker = HaversineRanker(
+            [t.id for t in trucks],
+            [t.latitude for t in trucks],
+            [t.longitude for t in trucks],
+        )
+        build_ms = (time.perf_counter() - started) * 1000
+        for engine, exact in (("haversine", False), ("haversine_exact", True)):
+            result = time_each(
+                lambda lat, long: ranker.top_k(lat, long, k=k, exact=exact), points
+            )
+            results[f"ranking.{engine}.{size}"] = {**result, "build_ms": build_ms}
+
+        started = time.perf_counter()
+        index = TruckSpatialIndex(trucks)
+        build_ms = (time.perf_counter() - started) * 1000
+        result = time_each(lambda lat, long: index.nearest(lat, long, k=k), points)
+        results[f"ranking.kd_tree.{size}"] = {**result, "build_ms": build_ms}
+    return results
+
+
+def legacy_top_k(trucks, lat, long, k):
+    # The per-row loop used before the batch engine
+    trucks_with_straight_distance = [
+        (
+            truck,
+            calculate_straight_distance_between_two_points(
+                lat, long, truck.latitude, truck.longitude
+            ),
+        )
+        for truck in trucks
+    ]
+    trucks_with_straight_distance.sort(key=lambda x: x[1])
+    return [t[0] for t in trucks_with_straight_distance[:k]]
+
+
+def benchmark_serializer(rng, responses):
+    """
+    Responses of TRUCKS_PER_RESPONSE loaded trucks rendered by the DRF
+    `ModelSerializer` and by the fragment path, cold and cached.
+    """
+    truck_ids = list(FoodTruck.objects.values_list("id", flat=True))
+    samples = [
+        (rng.sample(truck_ids, min(TRUCKS_PER_RESPONSE, len(truck_ids))),)
+        for _ in range(responses)
+    ]
+    fragments = TruckFragmentCache(max_entries=len(truck_ids) * 2)
+    every_field = tuple(fragments.field_names)
+    projection = fragments.normalize_fields(SERIALIZER_PROJECTION)
+
+    def model_serializer(ids):
+        trucks = FoodTruck.objects.filter(pk__in=ids)
+        return JSONRenderer().render(FoodTruckSerializer(trucks, many=True).data)
+
+    def fragment_path(fields):
+        def serialize(ids):
+            return "[" + ",".join(fragments.render(ids, fields).values()) + "]"
+
+        return serialize
+
+    def cached_fragment_path(fields):
+        def serialize(ids):
+            return "[" + ",".join(fragments.get_many(ids, fields).values()) + "]"
+
+        return serialize
+
+    # Warm the fragment cache so the cached runs measure hits only
+    for (ids,) in samples:
+        fragments.get_many(ids)
+        fragments.get_many(ids, projection)
+
+    return {
+        f"serializer.{name}": time_each(serialize, samples)
+        for name, serialize in [
+            ("model_serializer", model_serializer),
+            ("fragments", fragment_path(every_field)),
+            ("fragments_projection", fragment_path(projection)),
+            ("cached_fragments", cached_fragment_path(None)),
+            ("cached_fragments_projection", cached_fragment_path(projection)),
+        ]
+    }
+
+
+def benchmark_walking_time(rng, queries, concurrency, round_trip_ms):
+    """
+    Per-truck, batched and coalesced (merged across concurrent queries)
+    Distance Matrix lookups against a simulated API, for origins drawn
+    around a few hot spots.
+    """
+    trucks = random_points(rng, 50)
+    hot_spots = random_points(rng, 10)
+    lookups = []
+    for _ in range(queries):
+        lat, long = rng.choice(hot_spots)
+        origin = (lat + rng.uniform(-5e-5, 5e-5), long + rng.uniform(-5e-5, 5e-5))
+        # The candidates of an origin are its nearest trucks
+        nearest = sorted(
+            trucks,
+            key=lambda truck: (truck[0] - origin[0]) ** 2 + (truck[1] - origin[1]) ** 2,
+        )
+        lookups.append((origin, nearest[:DESTINATIONS_PER_CALL]))
+
+    def per_truck_lookup(client, origin, destinations):
+        # One request per truck, as the thread pool did before batching
+        with ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(client.distance_matrix, origin, destination)
+                for destination in destinations
+            ]
+            return [future.result() for future in futures]
+
+    def batched_lookup(client, origin, destinations):
+        return GoogleDistanceMatrixProvider(client).get_elements(*origin, destinations)
+
+    def coalesced_lookup(provider, client, origin, destinations):
+        return provider.get_elements(*origin, destinations)
+
+    results = {}
+    for threads in concurrency:
+        for mode in ("per_truck", "batched", "coalesced"):
+            client = FakeDistanceMatrixClient(round_trip_ms, 2, connections=10)
+            if mode == "per_truck":
+                lookup = per_truck_lookup
+            elif mode == "batched":
+                lookup = batched_lookup
+            else:
+                # One provider, hence one coalescer, for every query
+                lookup = functools.partial(
+                    coalesced_lookup, GoogleDistanceMatrixProvider(client)
+                )
+
+            def timed(query):
+                started = time.perf_counter()
+                lookup(client, *query)
+                return time.perf_counter() - started
+
+            started = time.perf_counter()
+            with override_settings(
+                WALKING_TIME_COALESCE_ENABLED=mode == "coalesced"
+            ), ThreadPoolExecutor(max_workers=threads) as executor:
+                latencies = list(executor.map(timed, lookups))
+            results[f"walking_time.{mode}.x{threads}"] = {
+                **summarize(latencies, time.perf_counter() - started),
+                "calls_per_query": client.calls / len(lookups),
+                "elements_per_query": client.elements / len(lookups),
+            }
+    return results
+
+
+def benchmark_google_client(rng, calls, round_trip_ms, seed):
+    """
+    The Google Maps client (pooling, rate limiting, hedging, circuit breaker)
+    against a local fake Distance Matrix API, in each of the
+    GOOGLE_CLIENT_SCENARIOS.
+    """
+    # Imported here, with the HTTP libraries, only when this section runs
+    from .google_client import ResilientDistanceMatrixClient
+
+    arguments = [
+        (point, random_points(rng, DESTINATIONS_PER_CALL))
+        for point in random_points(rng, calls)
+    ]
+    results = {}
+    for name, behaviour, options in GOOGLE_CLIENT_SCENARIOS:
+        with FakeGoogleMapsServer(
+            latency_ms=round_trip_ms,
+            slow_ms=GOOGLE_CLIENT_SLOW_MS,
+            seed=seed,
+            **behaviour,
+        ) as server:
+            client = ResilientDistanceMatrixClient(
+                "AIza-fake-key",
+                base_url=server.url,
+                pool_size=GOOGLE_CLIENT_CONCURRENCY * 2,
+                **{
+                    "hedge_after_ms": GOOGLE_CLIENT_HEDGE_AFTER_MS,
+                    # Only the "over_quota" scenario is limited by the quota
+                    "elements_per_second": 1_000_000,
+                    "burst_elements": 1_000_000,
+                    "breaker_reset_seconds": 60,
+                    **options,
+                },
+            )
+
+            def timed(call):
+                started = time.perf_counter()
+                try:
+                    client.distance_matrix(*call)
+                    failed = False
+                except ConnectionError:
+                    failed = True
+                return time.perf_counter() - started, failed
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=GOOGLE_CLIENT_CONCURRENCY) as executor:
+                outcomes = list(executor.map(timed, arguments))
+            elapsed = time.perf_counter() - started
+            failed = sum(failed for _, failed in outcomes)
+            stats = client.stats()
+            results[f"google_client.{name}"] = {
+                **summarize([seconds for seconds, _ in outcomes], elapsed),
+                "ok": len(outcomes) - failed,
+                "failed": failed,
+                "requests": server.requests,
+                **{
+                    counter: stats[counter]
+                    for counter in (
+                        "hedges",
+                        "hedge_wins",
+                        "retries",
+                        "rate_limited",
+                        "short_circuited",
+                        "circuit",
+                    )
+                },
+            }
+    return results
+
+
+def benchmark_startup(commands):
+    """
+    Startup of a WSGI worker and of the given management commands in fresh
+    interpreters, with the import time and slowest packages reported by
+    `python -X importtime`.
+    """
+    targets = [("wsgi_worker", ["-c", WSGI_BOOT])] + [
+        (
+            "manage_" + "_".join(command.split()),
+            [str(settings.BASE_DIR / "manage.py")] + command.split(),
+        )
+        for command in commands
+    ]
+    results = {}
+    for name, arguments in targets:
+        # Timed without -X importtime, which slows imports down
+        durations = [run_python(arguments)[0] for _ in range(STARTUP_RUNS)]
+        imports = parse_importtime(run_python(["-X", "importtime"] + arguments)[1])
+        results[f"startup.{name}"] = {
+            **summarize(durations),
+            "imports_ms": sum(self_us for _, self_us, _ in imports) / 1000,
+            "modules": len(imports),
+            "slowest_packages": time_by_package(imports)[:STARTUP_TOP_PACKAGES],
+        }
+    return results
+
+
+def run_python(arguments):
+    """
+    Run the interpreter with `arguments` from the project directory and
+    return its wall time in seconds and its stderr.
+    """
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable] + arguments,
+        cwd=settings.BASE_DIR,
+        env=os.environ.copy(),
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if process.returncode:
+        raise RuntimeError(f"{' '.join(arguments)} failed:\n{process.stderr[-2000:]}")
+    return elapsed, process.stderr
+
+
+def parse_importtime(stderr):
+    """
+    Parse the `python -X importtime` report into (module, self µs, cumulative µs)
+    tuples, in import order. Other stderr lines are ignored.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # The header line
+            continue
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def time_by_package(imports):
+    """
+    Import time in milliseconds per top-level package, slowest first. Self
+    times are summed, so nested imports are not counted twice.
+    """
+    packages = {}
+    for module, self_us, _ in imports:
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us / 1000
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)
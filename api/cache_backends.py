@@ -0,0 +1,30 @@
+import os
+import tempfile
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class AtomicFileBasedCache(FileBasedCache):
+    """
+    File-based cache whose `add` is atomic across processes, so it can be used
+    for the locks protecting the response cache from stampedes. Django's own
+    implementation checks for the key and writes it in two separate steps.
+    """
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._createdir()
+        fname = self._key_to_file(key, version)
+        # Drops the file if it holds an expired entry
+        if self.has_key(key, version):
+            return False
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir)
+        try:
+            with open(fd, "wb") as f:
+                self._write_content(f, timeout, value)
+            # Unlike a rename, a hard link fails if the target already exists
+            os.link(tmp_path, fname)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
@@ -0,0 +1,238 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from django.conf import settings
+from .profiling import LatencyHistogram, current_profile
+
+# Distance Matrix limits per request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+
+def plan_calls(batch):
+    """
+    Group the lookups of a batch, a {cell: (origin, [destination, ...])} dict,
+    into Distance Matrix calls as (origins, destinations) tuples.
+
+    Every element of a call is billed, so origins are only sent together when
+    they need the same destinations; no element is requested for nothing.
+    """
+    origins_by_destinations = {}
+    for origin, destinations in batch.values():
+        origins_by_destinations.setdefault(tuple(sorted(destinations)), []).append(
+            origin
+        )
+
+    calls = []
+    for destinations, origins in origins_by_destinations.items():
+        for start in range(0, len(destinations), MAX_DESTINATIONS):
+            chunk = list(destinations[start : start + MAX_DESTINATIONS])
+            origins_per_call = max(1, min(MAX_ORIGINS, MAX_ELEMENTS // len(chunk)))
+            for first in range(0, len(origins), origins_per_call):
+                calls.append((origins[first : first + origins_per_call], chunk))
+    return calls
+
+
+class WalkingTimeCoalescer:
+    """
+    Process-wide queue merging the walking time lookups of concurrent requests.
+
+    Lookups are keyed on the origin's walking time cache cell and the
+    destination, like the walking time cache: origins of the same cell share
+    their walking times. A lookup already pending or in flight is not sent
+    again. Pending lookups are collected for WALKING_TIME_COALESCE_WINDOW_MS,
+    then sent as multi-origin, multi-destination calls (see `plan_calls`) by a
+    pool of WALKING_TIME_COALESCE_WORKERS threads, and every waiting request
+    gets its elements back.
+
+    `send(origins, destinations)` returns one row of elements per origin.
+    """
+
+    def __init__(self, send, cell_for):
+        self.send = send
+        self.cell_for = cell_for
+        self._condition = threading.Condition()
+        # {cell: (origin, {destination: future})} of the lookups not sent yet
+        self._pending = {}
+        self._opened_at = None
+        # {(cell, destination): future} of every lookup not answered yet
+        self._futures = {}
+        self._dispatcher = None
+        self._executor = None
+        self._stats = {"lookups": 0, "coalesced": 0, "elements": 0, "calls": 0}
+        self._queueing = LatencyHistogram()
+
+    def submit(self, lat, long, destinations):
+        """
+        Queue the lookups from (lat, long) to each destination and return
+        their futures, in order. Each future results in a Distance Matrix
+        element or raises ConnectionError.
+        """
+        cell = self.cell_for(lat, long)
+        futures = []
+        with self._condition:
+            self._start()
+            for dest_lat, dest_long in destinations:
+                destination = (float(dest_lat), float(dest_long))
+                future = self._futures.get((cell, destination))
+                if future is None:
+                    future = concurrent.futures.Future()
+                    future.enqueued_at = time.perf_counter()
+                    future.add_done_callback(
+                        lambda _, key=(cell, destination): self._forget(key)
+                    )
+                    self._futures[(cell, destination)] = future
+                    _, cell_lookups = self._pending.setdefault(
+                        cell, ((float(lat), float(long)), {})
+                    )
+                    cell_lookups[destination] = future
+                    if self._opened_at is None:
+                        self._opened_at = time.perf_counter()
+                        self._condition.notify()
+                else:
+                    self._stats["coalesced"] += 1
+                futures.append(future)
+            self._stats["lookups"] += len(destinations)
+        return futures
+
+    def lookup(self, lat, long, destinations):
+        """
+        Blocking variant of `submit`, returning the elements. Raises
+        ConnectionError when a lookup failed or missed WALKING_TIME_DEADLINE.
+        """
+        started = time.perf_counter()
+        futures = self.submit(lat, long, destinations)
+        done, pending = concurrent.futures.wait(
+            futures, timeout=settings.WALKING_TIME_DEADLINE
+        )
+        self.record_queueing(futures, started)
+        if pending:
+            raise ConnectionError("Timed out fetching walking times.")
+        return [future.result() for future in futures]
+
+    async def lookup_async(self, lat, long, destinations):
+        """
+        Async variant of `lookup`, returning None for the lookups not answered
+        before the deadline, like `WalkingTimeProvider.get_elements_async`.
+        """
+        started = time.perf_counter()
+        futures = self.submit(lat, long, destinations)
+        # Shared futures are never cancelled, other requests may wait on them
+        waiters = [asyncio.wrap_future(future) for future in futures]
+        done, _ = await asyncio.wait(waiters, timeout=settings.WALKING_TIME_DEADLINE)
+        self.record_queueing(futures, started)
+
+        elements = [
+            waiter.result() if waiter in done and not waiter.exception() else None
+            for waiter in waiters
+        ]
+        if all(element is None for element in elements):
+            for waiter in done:
+                if waiter.exception() is not None:
+                    raise waiter.exception()
+            raise ConnectionError("Timed out fetching walking times.")
+        return elements
+
+    def record_queueing(self, futures, started):
+        """
+        Add the time the request waited for its lookups to be sent to the
+        current request profile, as the `walking_time_queue` stage.
+        """
+        profile = current_profile.get()
+        dispatched = [
+            future.dispatched_at
+            for future in futures
+            if getattr(future, "dispatched_at", None) is not None
+        ]
+        if profile is not None and dispatched:
+            profile.add_stage("walking_time_queue", max(0, max(dispatched) - started))
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["queueing"] = self._queueing.summary()
+        # Lookups asked for per element paid for
+        stats["coalescing_ratio"] = (
+            stats["lookups"] / stats["elements"] if stats["elements"] else None
+        )
+        return stats
+
+    def _forget(self, key):
+        with self._condition:
+            self._futures.pop(key, None)
+
+    def _start(self):
+        if self._dispatcher is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.WALKING_TIME_COALESCE_WORKERS,
+                thread_name_prefix="walking-time",
+            )
+            self._dispatcher = threading.Thread(
+                target=self._run, name="walking-time-coalescer", daemon=True
+            )
+            self._dispatcher.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._opened_at is None:
+                    self._condition.wait()
+                opened_at = self._opened_at
+            time.sleep(
+                max(
+                    0,
+                    opened_at
+                    + settings.WALKING_TIME_COALESCE_WINDOW_MS / 1000
+                    - time.perf_counter(),
+                )
+            )
+            with self._condition:
+                batch, self._pending, self._opened_at = self._pending, {}, None
+                now = time.perf_counter()
+                for _, cell_lookups in batch.values():
+                    for future in cell_lookups.values():
+                        future.dispatched_at = now
+                        self._queueing.add((now - future.enqueued_at) * 1000)
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        futures = {
+            (origin, destination): future
+            for origin, cell_lookups in batch.values()
+            for destination, future in cell_lookups.items()
+        }
+        calls = plan_calls(
+            {
+                cell: (origin, list(cell_lookups))
+                for cell, (origin, cell_lookups) in batch.items()
+            }
+        )
+        with self._condition:
+            self._stats["calls"] += len(calls)
+            self._stats["elements"] += sum(
+                len(origins) * len(destinations) for origins, destinations in calls
+            )
+        for origins, destinations in calls:
+            self._executor.submit(self._call, origins, destinations, futures)
+
+    def _call(self, origins, destinations, futures):
+        error = ConnectionError("Incomplete Distance Matrix response.")
+        try:
+            rows = self.send(origins, destinations)
+            for origin, row in zip(origins, rows):
+                for destination, element in zip(destinations, row["elements"]):
+                    futures[(origin, destination)].set_result(element)
+        except Exception as e:
+            error = (
+                e
+                if isinstance(e, ConnectionError)
+                else ConnectionError("Error connecting to Google Maps API.")
+            )
+        # Never leave a request waiting on a failed call or a malformed response
+        for origin in origins:
+            for destination in destinations:
+                future = futures[(origin, destination)]
+                if not future.done():
+                    future.set_exception(error)
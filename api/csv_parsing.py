@@ -0,0 +1,202 @@
+import time
+import zoneinfo
+from datetime import datetime
+from functools import lru_cache
+from django.utils import timezone
+from .week_bitmap import encode_week_bitmap
+
+# Parsing helpers for rows of the city food truck CSV. This module does not
+# import the models, and only reads the Django settings for the time zone of
+# the feed's dates, which process pool workers are given instead (see
+# `set_feed_timezone`): they can use it without setting up Django, whatever
+# the start method. Feeds repeat the same dates and hours on many rows, so
+# every string parse is memoized.
+
+DAY_CODES = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
+DAYS_MAPPING = {
+    "Mo": "Monday",
+    "Tu": "Tuesday",
+    "We": "Wednesday",
+    "Th": "Thursday",
+    "Fr": "Friday",
+    "Sa": "Saturday",
+    "Su": "Sunday",
+}
+PARSE_CACHE_SIZE = 4096
+
+# Time zone of the feed's dates when set by `set_feed_timezone`, TIME_ZONE
+# otherwise
+_feed_timezone = None
+
+
+def set_feed_timezone(name):
+    """
+    Read the feed's dates in the time zone `name`. Used as the initializer of
+    the process pool workers, with TIME_ZONE.
+    """
+    global _feed_timezone
+    _feed_timezone = zoneinfo.ZoneInfo(name)
+    _parse_aware_datetime.cache_clear()
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_aware_datetime(value, date_format):
+    # Aware datetimes are immutable, so cached instances can be shared
+    naive_datetime = datetime.strptime(value, date_format)
+    return timezone.make_aware(
+        naive_datetime, _feed_timezone or timezone.get_default_timezone()
+    )
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_clock_time(value):
+    """
+    Parse an hour like '7AM' or '12PM'.
+    """
+    return datetime.strptime(value.strip(), "%I%p").time()
+
+
+def parse_datetime(datetime_str, errors):
+    """
+    Parse a datetime in AM/PM format, e.g. "09/20/2023 12:00:00 AM".
+    """
+    if datetime_str:
+        try:
+            return _parse_aware_datetime(datetime_str, "%m/%d/%Y %I:%M:%S %p")
+        except ValueError:
+            errors.append("Invalid datetime format detected.")
+    return None
+
+
+def parse_date(datetime_str, errors):
+    """
+    Parse a date without time, e.g. "20230920".
+    """
+    if datetime_str:
+        try:
+            return _parse_aware_datetime(datetime_str, "%Y%m%d")
+        except ValueError:
+            errors.append("Invalid date format detected.")
+    return None
+
+
+def parse_day_range(day_range_str):
+    """
+    Expand a day range like 'Mo-We' into its day codes.
+    """
+    start_day, end_day = day_range_str.split("-")
+    start_index = DAY_CODES.index(start_day)
+    end_index = DAY_CODES.index(end_day)
+    return DAY_CODES[start_index : end_index + 1]
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_schedule(hours_str):
+    operating_hours = []
+
+    for group in hours_str.split(";"):
+        days, times = group.split(":")
+        day_codes = parse_day_range(days) if "-" in days else days.split("/")
+        for time_range in times.split("/"):
+            open_time, close_time = time_range.split("-")
+            open_time, close_time = parse_clock_time(open_time), parse_clock_time(
+                close_time
+            )
+            for day_code in day_codes:
+                operating_hours.append((DAYS_MAPPING[day_code], open_time, close_time))
+
+    return tuple(operating_hours)
+
+
+def parse_hours(hours_str):
+    """
+    Parse operating hours like 'Mo-Fr:7AM-8AM/10AM-11AM;Sa:9AM-4PM' into a list
+    of {"day", "open_time", "close_time"} dicts.
+    """
+    return [
+        {"day": day, "open_time": open_time, "close_time": close_time}
+        for day, open_time, close_time in _parse_schedule(hours_str)
+    ]
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def schedule_bitmap(hours_str):
+    """
+    Weekly availability bitmap of operating hours like 'Mo-Fr:10AM-3PM'.
+    """
+    return encode_week_bitmap(_parse_schedule(hours_str))
+
+
+def is_locatable(row):
+    """
+    Trucks without latitude and longitude cannot be localized.
+    """
+    return float(row.get("Latitude")) != 0 and float(row.get("Longitude")) != 0
+
+
+def map_row(row, errors):
+    """
+    Map a CSV row to FoodTruck model fields.
+    """
+    return {
+        "location_id": row.get("locationid"),
+        "applicant": row.get("Applicant"),
+        "facility_type": row.get("FacilityType"),
+        "cnn": row.get("cnn"),
+        "location_description": row.get("LocationDescription"),
+        "address": row.get("Address"),
+        "block_lot": row.get("blocklot"),
+        "block": row.get("block"),
+        "lot": row.get("lot"),
+        "permit": row.get("permit"),
+        "status": row.get("Status"),
+        "food_items": row.get("FoodItems"),
+        "x": float(row.get("X")) if row.get("X") else None,
+        "y": float(row.get("Y")) if row.get("Y") else None,
+        "latitude": float(row.get("Latitude")),
+        "longitude": float(row.get("Longitude")),
+        "schedule": row.get("Schedule"),
+        "days_hours": row.get("dayshours") if row.get("dayshours") else None,
+        "noi_sent": row.get("NOISent"),
+        "approved": parse_datetime(row.get("Approved"), errors),
+        "received": parse_date(row.get("Received"), errors),
+        "prior_permit": int(row.get("PriorPermit")),
+        "expiration_date": parse_datetime(row.get("ExpirationDate"), errors),
+        "location": row.get("Location"),
+        "fire_prevention_districts": (
+            int(row.get("Fire Prevention Districts"))
+            if row.get("Fire Prevention Districts")
+            else None
+        ),
+        "police_districts": (
+            int(row.get("Police Districts")) if row.get("Police Districts") else None
+        ),
+        "supervisor_districts": (
+            int(row.get("Supervisor Districts"))
+            if row.get("Supervisor Districts")
+            else None
+        ),
+        "zip_codes": int(row.get("Zip Codes")) if row.get("Zip Codes") else None,
+        "neighborhoods": row.get("Neighborhoods (old)"),
+        "open_hours_bitmap": (
+            schedule_bitmap(row["dayshours"]) if row.get("dayshours") else None
+        ),
+    }
+
+
+def parse_chunk(rows):
+    """
+    Parse a chunk of CSV rows into (truck fields, operating hours) pairs.
+    Runs in process pool workers, so it returns its errors and parsing time
+    instead of updating shared state.
+    """
+    started = time.perf_counter()
+    errors = []
+    parsed = [
+        (
+            map_row(row, errors),
+            parse_hours(row["dayshours"]) if row.get("dayshours") else [],
+        )
+        for row in rows
+    ]
+    return parsed, errors, time.perf_counter() - started
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from .models import DatasetVersion
+
+CACHE_KEY = "food_trucks_dataset_version"
+
+
+def get_dataset_version():
+    """
+    Return the current version of the food truck dataset, 0 before any load.
+
+    The version is read through the shared cache, so looking it up on every
+    request costs no database query.
+    """
+    version = cache.get(CACHE_KEY)
+    if version is None:
+        version = (
+            DatasetVersion.objects.aggregate(version=Max("version"))["version"] or 0
+        )
+        cache.set(CACHE_KEY, version, settings.DATASET_VERSION_CACHE_SECONDS)
+    return version
+
+
+def bump_dataset_version(summary=None):
+    """
+    Record a change of the dataset and return the new version.
+    Must run inside the transaction applying the change.
+    """
+    latest = DatasetVersion.objects.select_for_update().order_by("-version").first()
+    version = (latest.version if latest else 0) + 1
+    DatasetVersion.objects.create(version=version, summary=summary or {})
+    # Published once the change is visible; other processes with their own
+    # cache catch up within DATASET_VERSION_CACHE_SECONDS
+    transaction.on_commit(
+        lambda: cache.set(CACHE_KEY, version, settings.DATASET_VERSION_CACHE_SECONDS)
+    )
+    return version
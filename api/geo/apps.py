@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+
+
+class GeoConfig(AppConfig):
+    """
+    Optional GeoDjango mode, installed when SPATIAL_BACKEND is set: truck
+    locations as points with a spatial index, queried nearest first by the
+    database.
+    """
+
+    default_auto_field = "django.db.models.BigAutoField"
+    name = "api.geo"
+    label = "geo"
+
+    def ready(self):
+        from . import signals  # noqa: F401
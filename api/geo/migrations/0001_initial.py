@@ -0,0 +1,49 @@
+import django.contrib.gis.db.models.fields
+from django.contrib.gis.geos import Point
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_truck_locations(apps, schema_editor):
+    FoodTruck = apps.get_model("api", "FoodTruck")
+    TruckLocation = apps.get_model("geo", "TruckLocation")
+    TruckLocation.objects.bulk_create(
+        [
+            TruckLocation(food_truck_id=truck_id, point=Point(long, lat, srid=4326))
+            for truck_id, lat, long in FoodTruck.objects.values_list(
+                "id", "latitude", "longitude"
+            ).iterator()
+        ],
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = [
+        ("api", "0009_coordinate_and_hours_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TruckLocation",
+            fields=[
+                (
+                    "food_truck",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="geo_location",
+                        serialize=False,
+                        to="api.foodtruck",
+                    ),
+                ),
+                (
+                    "point",
+                    django.contrib.gis.db.models.fields.PointField(srid=4326),
+                ),
+            ],
+        ),
+        migrations.RunPython(fill_truck_locations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.contrib.gis.db import models
+from api.models import FoodTruck
+
+
+class TruckLocation(models.Model):
+    """
+    Location of a food truck as a WGS-84 point, with a spatial index. Mirrors
+    `FoodTruck.latitude` and `FoodTruck.longitude`, which stay the source of truth.
+    """
+
+    food_truck = models.OneToOneField(
+        FoodTruck,
+        primary_key=True,
+        related_name="geo_location",
+        on_delete=models.CASCADE,
+    )
+    point = models.PointField(srid=4326, spatial_index=True)
+
+    def __str__(self):
+        return f"{self.food_truck_id} at {self.point.y}, {self.point.x}"
@@ -0,0 +1,104 @@
+import math
+from itertools import islice
+from django.conf import settings
+from django.contrib.gis.db.models.functions import Distance, GeometryDistance
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+from api.models import FoodTruck
+from api.ranking import AMBIGUITY_RATIO, EARTH_RADIUS_METERS, SPHERE_ERROR
+from api.ranking import HaversineRanker
+from .models import TruckLocation
+
+
+def refresh_truck_locations(batch_size=5000):
+    """
+    Rebuild every truck point from the truck coordinates. Bulk loads send no
+    signals, `load_food_trucks` calls this after them.
+    """
+    with transaction.atomic():
+        TruckLocation.objects.all().delete()
+        rows = FoodTruck.objects.values_list("id", "latitude", "longitude").iterator()
+        while batch := list(islice(rows, batch_size)):
+            TruckLocation.objects.bulk_create(
+                [
+                    TruckLocation(
+                        food_truck_id=truck_id, point=Point(long, lat, srid=4326)
+                    )
+                    for truck_id, lat, long in batch
+                ]
+            )
+
+
+def _nearest_rows(lat, long, limit, allowed_ids):
+    """
+    Return the ids of the `limit` eligible trucks nearest to the point, nearest
+    first, along with a lower bound (in meters) of the spherical distance of
+    every truck left out.
+    """
+    origin = Point(long, lat, srid=4326)
+    locations = TruckLocation.objects.all()
+    if allowed_ids is not None:
+        locations = locations.filter(food_truck_id__in=list(allowed_ids))
+
+    if connection.ops.postgis:
+        # KNN through the spatial index: `<->` orders by planar distance in
+        # degrees, so the trucks left out are outside a circle of that many
+        # degrees, which contains a box, which contains a spherical circle
+        rows = list(
+            locations.annotate(degrees=GeometryDistance("point", origin))
+            .order_by("degrees")
+            .values_list("food_truck_id", "degrees")[:limit]
+        )
+        if not rows:
+            return [], math.inf
+        half_side = rows[-1][1] / math.sqrt(2)
+        widest_lat = min(abs(lat) + half_side, 90.0)
+        bound = (
+            EARTH_RADIUS_METERS
+            * math.radians(half_side)
+            * math.cos(math.radians(widest_lat))
+        )
+        return [truck_id for truck_id, _ in rows], bound
+
+    # SpatiaLite has no KNN operator, the database orders by geodesic distance
+    rows = list(
+        locations.annotate(meters=Distance("point", origin))
+        .order_by("meters")
+        .values_list("food_truck_id", "meters")[:limit]
+    )
+    if not rows:
+        return [], math.inf
+    return [truck_id for truck_id, _ in rows], rows[-1][1].m / (1 + SPHERE_ERROR)
+
+
+def nearest_from_spatial_database(lat, long, k=10, allowed_ids=None, exact=True):
+    """
+    Same answer as `TruckSpatialIndex.nearest`, from the trucks the database
+    returns nearest first. Their exact order is computed here, and more trucks
+    are fetched until no truck left out can rank.
+    """
+    if k <= 0:
+        return []
+    limit = k * settings.SPATIAL_KNN_OVERFETCH
+    while True:
+        truck_ids, left_out_meters = _nearest_rows(lat, long, limit, allowed_ids)
+        # Table order, so that ties are broken as the in-memory index does
+        rows = list(
+            FoodTruck.objects.filter(id__in=truck_ids)
+            .order_by("id")
+            .values_list("id", "latitude", "longitude")
+        )
+        if not rows:
+            return []
+        ranker = HaversineRanker(*zip(*rows))
+        ranked = ranker.top_k(lat, long, k=k, exact=exact)
+        if len(truck_ids) < limit:
+            # Every eligible truck was fetched
+            return [(int(ranker.ids[p]), meters) for p, meters in ranked]
+        kth = float(ranker.distances(lat, long)[[p for p, _ in ranked]].max())
+        if (
+            len(ranked) == k
+            and (kth * AMBIGUITY_RATIO if exact else kth) < left_out_meters
+        ):
+            return [(int(ranker.ids[p]), meters) for p, meters in ranked]
+        limit *= 2
@@ -0,0 +1,17 @@
+from django.contrib.gis.geos import Point
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from api.models import FoodTruck
+from .models import TruckLocation
+
+
+@receiver(post_save, sender=FoodTruck)
+def food_truck_saved(sender, instance, **kwargs):
+    """
+    Keep the truck's point in sync with its coordinates. Deleting the truck
+    deletes its point.
+    """
+    TruckLocation.objects.update_or_create(
+        food_truck=instance,
+        defaults={"point": Point(instance.longitude, instance.latitude, srid=4326)},
+    )
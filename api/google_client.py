@@ -0,0 +1,435 @@
+import asyncio
+import concurrent.futures
+import functools
+import math
+import threading
+import time
+import weakref
+import googlemaps
+import httpx
+import requests
+from django.conf import settings
+
+DISTANCE_MATRIX_PATH = "/maps/api/distancematrix/json"
+# Top-level statuses blaming Google Maps or the quota rather than the request
+SERVICE_FAILURE_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised without calling Google Maps while the circuit breaker is open.
+    """
+
+
+class RateLimitedError(ConnectionError):
+    """
+    Raised when the quota leaves no room for a call within the allowed wait.
+    """
+
+
+def is_service_failure(error):
+    """
+    Whether a failed call tells that Google Maps is unhealthy or over quota:
+    a transport error, a timeout, a 5xx response or one of the
+    SERVICE_FAILURE_STATUSES. Errors in the request itself (INVALID_REQUEST,
+    REQUEST_DENIED, a 4xx response...) say nothing about the service.
+    """
+    if isinstance(error, googlemaps.exceptions.ApiError):
+        return error.status in SERVICE_FAILURE_STATUSES
+    if isinstance(error, googlemaps.exceptions.HTTPError):
+        return error.status_code >= 500
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(
+        error,
+        (
+            googlemaps.exceptions.TransportError,
+            googlemaps.exceptions.Timeout,
+            httpx.TransportError,
+            requests.RequestException,
+            OSError,
+        ),
+    )
+
+
+class TokenBucket:
+    """
+    Client-side rate limit: `rate` tokens per second, up to `burst` saved up.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, cost):
+        """
+        Take `cost` tokens if available and return 0, otherwise return how long
+        to wait (in seconds) before they are.
+        """
+        # A call larger than the burst waits for a full bucket
+        cost = min(cost, self.burst)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return 0
+            return (cost - self._tokens) / self.rate
+
+    def try_acquire(self, cost=1):
+        return self._take(cost) == 0
+
+    def acquire(self, cost=1, timeout=0):
+        """
+        Wait up to `timeout` seconds for `cost` tokens, False if they don't come.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._take(cost)
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, cost=1, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._take(cost)
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a service after `failure_threshold` consecutive failures.
+    After `reset_seconds`, a single trial call is let through (half-open): its
+    success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def release(self):
+        """
+        Give back a trial call that was not made, e.g. for lack of quota.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+
+
+class ResilientDistanceMatrixClient:
+    """
+    Distance Matrix client shared by every request of the process, with the
+    same `distance_matrix` interface as `googlemaps.Client`.
+
+    - HTTP connections are pooled, GOOGLE_MAPS_POOL_SIZE of them (the sync
+      calls go through a `requests` session, the async ones through httpx).
+    - A token bucket keeps the calls within GOOGLE_MAPS_ELEMENTS_PER_SECOND,
+      Distance Matrix quotas being counted in elements. A call waits at most
+      GOOGLE_MAPS_RATE_LIMIT_WAIT seconds for its tokens.
+    - A call still running after GOOGLE_MAPS_HEDGE_AFTER_MS is sent a second
+      time, if the quota allows it right away, and the first answer wins. A
+      call failing without having been hedged is retried once right away.
+    - After GOOGLE_MAPS_BREAKER_FAILURES failed calls in a row, calls fail
+      immediately for GOOGLE_MAPS_BREAKER_RESET_SECONDS, so that requests fall
+      back to offline estimates instead of waiting on an unhealthy service.
+      Only service failures count (see `is_service_failure`); calls rejected
+      for their content are neither retried nor counted by the breaker.
+
+    Every failure is raised as a ConnectionError.
+    """
+
+    def __init__(
+        self,
+        key,
+        base_url="https://maps.googleapis.com",
+        pool_size=20,
+        timeout=5,
+        elements_per_second=1000,
+        burst_elements=1000,
+        rate_limit_wait=1,
+        hedge_after_ms=0,
+        breaker_failures=5,
+        breaker_reset_seconds=30,
+    ):
+        self.key = key
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.rate_limit_wait = rate_limit_wait
+        self.hedge_after = hedge_after_ms / 1000
+        self.bucket = TokenBucket(elements_per_second, burst_elements)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset_seconds)
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.client = googlemaps.Client(
+            key,
+            timeout=timeout,
+            # No retries with backoff sleeps of half a second and more: failed
+            # calls are retried once right away, slow ones hedged
+            retry_timeout=0.001,
+            retry_over_query_limit=False,
+            # The token bucket is the rate limit, a query has at least one element
+            # (googlemaps exits the process unless these are ints)
+            queries_per_second=max(1, math.ceil(elements_per_second)),
+            queries_per_minute=max(1, math.ceil(elements_per_second)) * 60,
+            requests_session=session,
+            base_url=self.base_url,
+        )
+        # Runs the calls that may be hedged, primary and hedge side by side
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="google-maps"
+        )
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._stats = {
+            "calls": 0,
+            "failures": 0,
+            "rejected": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "short_circuited": 0,
+        }
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            settings.GOOGLE_MAPS_API_KEY,
+            base_url=settings.GOOGLE_MAPS_BASE_URL,
+            pool_size=settings.GOOGLE_MAPS_POOL_SIZE,
+            timeout=settings.WALKING_TIME_TIMEOUT,
+            elements_per_second=settings.GOOGLE_MAPS_ELEMENTS_PER_SECOND,
+            burst_elements=settings.GOOGLE_MAPS_BURST_ELEMENTS,
+            rate_limit_wait=settings.GOOGLE_MAPS_RATE_LIMIT_WAIT,
+            hedge_after_ms=settings.GOOGLE_MAPS_HEDGE_AFTER_MS,
+            breaker_failures=settings.GOOGLE_MAPS_BREAKER_FAILURES,
+            breaker_reset_seconds=settings.GOOGLE_MAPS_BREAKER_RESET_SECONDS,
+        )
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["circuit"] = self.breaker.state
+        stats["circuit_trips"] = self.breaker.trips
+        return stats
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _admit(self, origins, destinations):
+        """
+        Check the breaker, then wait for the quota. Returns the call's cost.
+        """
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise CircuitOpenError("Google Maps is unhealthy, circuit open.")
+        return len(as_list(origins)) * len(as_list(destinations))
+
+    def _record_success(self, attempt):
+        if attempt == "hedge":
+            self._count("hedge_wins")
+        self.breaker.record_success()
+
+    def _record_failure(self, errors):
+        """
+        Record a call whose attempts all failed with `errors`.
+        """
+        if any(is_service_failure(error) for error in errors):
+            self._count("failures")
+            self.breaker.record_failure()
+        else:
+            self._count("rejected")
+            # Google Maps answered, a trial call may be made again
+            self.breaker.release()
+
+    def distance_matrix(self, origins, destinations, mode="walking"):
+        cost = self._admit(origins, destinations)
+        if not self.bucket.acquire(cost, timeout=self.rate_limit_wait):
+            self._count("rate_limited")
+            self.breaker.release()
+            raise RateLimitedError("Google Maps quota exhausted.")
+        self._count("calls")
+
+        call = functools.partial(
+            self.client.distance_matrix, origins, destinations, mode=mode
+        )
+        attempts = {self._executor.submit(call): "first"}
+        if self.hedge_after:
+            done, _ = concurrent.futures.wait(attempts, timeout=self.hedge_after)
+            if not done and self.bucket.try_acquire(cost):
+                self._count("hedges")
+                attempts[self._executor.submit(call)] = "hedge"
+
+        errors = []
+        pending = set(attempts)
+        while pending:
+            # A losing attempt is left to finish in the background
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for attempt in done:
+                if attempt.exception() is None:
+                    self._record_success(attempts[attempt])
+                    return attempt.result()
+                errors.append(attempt.exception())
+            if (
+                not pending
+                and is_service_failure(errors[-1])
+                and self._retry(attempts, cost)
+            ):
+                retry = self._executor.submit(call)
+                attempts[retry] = "retry"
+                pending = {retry}
+        self._record_failure(errors)
+        raise ConnectionError("Error connecting to Google Maps API.") from errors[-1]
+
+    async def distance_matrix_async(self, origins, destinations, mode="walking"):
+        """
+        Async variant of `distance_matrix`, sending its calls with httpx.
+        """
+        cost = self._admit(origins, destinations)
+        if not await self.bucket.acquire_async(cost, timeout=self.rate_limit_wait):
+            self._count("rate_limited")
+            self.breaker.release()
+            raise RateLimitedError("Google Maps quota exhausted.")
+        self._count("calls")
+
+        params = {
+            "origins": "|".join(f"{lat},{long}" for lat, long in as_list(origins)),
+            "destinations": "|".join(
+                f"{lat},{long}" for lat, long in as_list(destinations)
+            ),
+            "mode": mode,
+            "key": self.key,
+        }
+        attempts = {asyncio.create_task(self._get_async(params)): "first"}
+        if self.hedge_after:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_after)
+            if not done and self.bucket.try_acquire(cost):
+                self._count("hedges")
+                attempts[asyncio.create_task(self._get_async(params))] = "hedge"
+
+        errors = []
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for attempt in done:
+                if attempt.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    self._record_success(attempts[attempt])
+                    return attempt.result()
+                errors.append(attempt.exception())
+            if (
+                not pending
+                and is_service_failure(errors[-1])
+                and self._retry(attempts, cost)
+            ):
+                retry = asyncio.create_task(self._get_async(params))
+                attempts[retry] = "retry"
+                pending = {retry}
+        self._record_failure(errors)
+        raise ConnectionError("Error connecting to Google Maps API.") from errors[-1]
+
+    def _retry(self, attempts, cost):
+        """
+        Whether to retry a call whose attempts all failed: once, right away,
+        unless it was already hedged or the quota has no room for it.
+        """
+        if len(attempts) > 1 or not self.bucket.try_acquire(cost):
+            return False
+        self._count("retries")
+        return True
+
+    async def _get_async(self, params):
+        response = await self.async_http_client().get(
+            self.base_url + DISTANCE_MATRIX_PATH, params=params, timeout=self.timeout
+        )
+        response.raise_for_status()
+        body = response.json()
+        if body.get("status") != "OK":
+            # As googlemaps reports it
+            raise googlemaps.exceptions.ApiError(
+                body.get("status"), body.get("error_message")
+            )
+        return body
+
+    def async_http_client(self):
+        """
+        Return the pooled async HTTP client bound to the running event loop.
+        Under an ASGI server there is a single loop, so connections are reused
+        by every request of the worker.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            self._async_clients[loop] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size)
+            )
+        return self._async_clients[loop]
+
+
+def as_list(points):
+    """
+    Origins or destinations as a list, googlemaps also accepts a single one.
+    """
+    return points if isinstance(points, list) else [points]
@@ -0,0 +1,353 @@
+import csv
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from django.conf import settings
+from django.db import transaction
+from .csv_parsing import (
+    is_locatable,
+    map_row,
+    parse_chunk,
+    parse_hours,
+    set_feed_timezone,
+)
+from .dataset_version import bump_dataset_version
+from .models import FoodTruck, FoodTruckOperatingHour, WalkingTimeCacheEntry
+from .open_hours import refresh_open_hours_bitmaps
+from .signals import bulk_changes
+
+
+class StageStats:
+    """
+    Rows handled and time spent by one stage of the import pipeline.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, rows, seconds):
+        self.rows += rows
+        self.seconds += seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class ImportStats:
+    """
+    Counters reported at the end of an import.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.operating_hours = 0
+        self.duplicates = 0
+        self.conflicts = 0
+        self.unlocatable = 0
+        self.errors = []
+        self.version = None
+        self.stages = {name: StageStats(name) for name in ("read", "parse", "write")}
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+def bulk_import(file_path, batch_size=1000, workers=0):
+    """
+    Load the food trucks of a CSV file with as few database round trips as possible.
+
+    The import streams through three stages, so memory stays flat whatever the
+    file size: chunks of new rows are read (de-duplicated in memory against the
+    trucks already stored), parsed, optionally by `workers` processes, and
+    written by this process with `bulk_create`, one transaction per chunk of
+    `batch_size` rows.
+    """
+    stats = ImportStats()
+    existing_keys = set(
+        FoodTruck.objects.values_list("location_id", "latitude", "longitude")
+    )
+    chunks = read_new_rows(file_path, batch_size, existing_keys, stats)
+
+    for parsed in parse_chunks(chunks, workers, stats):
+        write_batch(parsed, stats)
+
+    if stats.created:
+        with transaction.atomic():
+            stats.version = bump_dataset_version(
+                {"mode": "load", "created": stats.created}
+            )
+
+    stats.elapsed = time.perf_counter() - stats.started_at
+    return stats
+
+
+def read_chunks(file_path, chunk_size, stage):
+    """
+    Yield the rows of a CSV file in lists of `chunk_size`.
+    """
+    with open(file_path, mode="r", encoding="utf-8-sig") as file:
+        reader = csv.DictReader(file)
+        while True:
+            started = time.perf_counter()
+            chunk = list(islice(reader, chunk_size))
+            stage.add(len(chunk), time.perf_counter() - started)
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_new_rows(file_path, chunk_size, existing_keys, stats):
+    """
+    Yield chunks of the locatable CSV rows that are not stored yet.
+    `existing_keys` holds the (location id, latitude, longitude) of stored trucks.
+    """
+    existing_location_ids = {location_id for location_id, _, _ in existing_keys}
+    stage = stats.stages["read"]
+    batch = []
+
+    for chunk in read_chunks(file_path, chunk_size, stage):
+        started = time.perf_counter()
+        for row in chunk:
+            stats.rows += 1
+            if not is_locatable(row):
+                stats.unlocatable += 1
+                continue
+            key = (row["locationid"], float(row["Latitude"]), float(row["Longitude"]))
+            if key in existing_keys:
+                stats.duplicates += 1
+                continue
+            if row["locationid"] in existing_location_ids:
+                # Same location id at other coordinates, location ids are unique
+                stats.conflicts += 1
+                continue
+            existing_keys.add(key)
+            existing_location_ids.add(row["locationid"])
+            batch.append(row)
+        stage.add(0, time.perf_counter() - started)
+
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_chunks(chunks, workers, stats):
+    """
+    Parse chunks of CSV rows, in order. With more than one worker, chunks are
+    parsed by a process pool while the caller writes the previous ones; at most
+    two chunks per worker are in flight, to keep memory flat.
+    """
+    stage = stats.stages["parse"]
+
+    def collect(result):
+        parsed, errors, seconds = result
+        stats.errors.extend(errors)
+        stage.add(len(parsed), seconds)
+        return parsed
+
+    if workers <= 1:
+        for chunk in chunks:
+            yield collect(parse_chunk(chunk))
+        return
+
+    # Workers only need the time zone from the settings, they get it as is
+    # rather than setting up Django
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=set_feed_timezone,
+        initargs=(settings.TIME_ZONE,),
+    ) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield collect(pending.popleft().result())
+        while pending:
+            yield collect(pending.popleft().result())
+
+
+def write_batch(parsed, stats):
+    """
+    Insert a batch of parsed trucks and their operating hours in a single
+    transaction.
+    """
+    started = time.perf_counter()
+    trucks = [FoodTruck(**values) for values, _ in parsed]
+
+    with transaction.atomic():
+        # Primary keys are set on the instances, so operating hours can refer to them
+        FoodTruck.objects.bulk_create(trucks)
+        operating_hours = [
+            FoodTruckOperatingHour(food_truck=truck, **hour_data)
+            for truck, (_, truck_hours) in zip(trucks, parsed)
+            for hour_data in truck_hours
+        ]
+        FoodTruckOperatingHour.objects.bulk_create(operating_hours)
+
+    stats.created += len(trucks)
+    stats.operating_hours += len(operating_hours)
+    stats.stages["write"].add(len(trucks), time.perf_counter() - started)
+
+
+class SyncStats(ImportStats):
+    """
+    Counters reported at the end of a sync.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.updated = 0
+        self.hours_changed = 0
+        self.moved = 0
+        self.deleted = 0
+        self.unchanged = 0
+
+    @property
+    def changed(self):
+        return bool(self.created or self.updated or self.deleted)
+
+    def summary(self):
+        return {
+            "mode": "sync",
+            "created": self.created,
+            "updated": self.updated,
+            "hours_changed": self.hours_changed,
+            "moved": self.moved,
+            "deleted": self.deleted,
+        }
+
+
+def read_incoming(file_path, stats):
+    """
+    Read the locatable rows of a CSV file, keyed by location id.
+    The first row of a location id wins, later ones are counted as duplicates.
+    """
+    incoming = {}
+    with open(file_path, mode="r", encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            stats.rows += 1
+            if not is_locatable(row):
+                stats.unlocatable += 1
+            elif row["locationid"] in incoming:
+                stats.duplicates += 1
+            else:
+                incoming[row["locationid"]] = row
+    return incoming
+
+
+def sync_import(file_path, batch_size=1000):
+    """
+    Make the stored food trucks match a CSV file, keyed by location id.
+
+    New location ids are inserted, changed trucks are updated and trucks missing
+    from the CSV are deleted, all in bulk and in one transaction, so readers see
+    either the old or the new dataset. Operating hours are only rewritten for
+    trucks whose `days_hours` changed, and cached walking times are dropped for
+    trucks that moved. The dataset version is bumped when anything changed.
+    """
+    stats = SyncStats()
+    incoming = read_incoming(file_path, stats)
+    fields = {
+        field.name: field
+        for field in FoodTruck._meta.concrete_fields
+        if not field.primary_key
+    }
+
+    # Deletes send a signal per row: the receivers are off during the sync, the
+    # indexes, fragments, answer grids and truck snapshot are discarded once
+    # it is committed
+    with bulk_changes(), transaction.atomic():
+        existing = {truck.location_id: truck for truck in FoodTruck.objects.all()}
+
+        to_create, to_update, changed_fields = [], [], set()
+        rewrite_hours, moved_ids = [], []
+        for location_id, row in incoming.items():
+            values = map_row(row, stats.errors)
+            truck = existing.get(location_id)
+            if truck is None:
+                truck = FoodTruck(**values)
+                to_create.append(truck)
+                rewrite_hours.append((truck, row))
+                continue
+
+            changed = [
+                name
+                for name, value in values.items()
+                if fields[name].to_python(value) != getattr(truck, name)
+            ]
+            if not changed:
+                stats.unchanged += 1
+                continue
+            for name in changed:
+                setattr(truck, name, values[name])
+            to_update.append(truck)
+            changed_fields.update(changed)
+            if "days_hours" in changed:
+                rewrite_hours.append((truck, row))
+                stats.hours_changed += 1
+            if "latitude" in changed or "longitude" in changed:
+                moved_ids.append(truck.pk)
+
+        deleted_ids = [
+            truck.pk
+            for location_id, truck in existing.items()
+            if location_id not in incoming
+        ]
+
+        FoodTruck.objects.bulk_create(to_create, batch_size=batch_size)
+        if to_update:
+            FoodTruck.objects.bulk_update(
+                to_update, sorted(changed_fields), batch_size=batch_size
+            )
+
+        # Trucks are deleted with their operating hours and walking times
+        for ids in chunked(deleted_ids, batch_size):
+            FoodTruck.objects.filter(pk__in=ids).delete()
+        for ids in chunked(moved_ids, batch_size):
+            WalkingTimeCacheEntry.objects.filter(food_truck_id__in=ids).delete()
+
+        # Recreated without signals, the bitmaps are refreshed once the new
+        # rows are in
+        rewritten_ids = [truck.pk for truck, _ in rewrite_hours]
+        for ids in chunked(rewritten_ids, batch_size):
+            FoodTruckOperatingHour.objects.filter(food_truck_id__in=ids).delete()
+        operating_hours = [
+            FoodTruckOperatingHour(food_truck=truck, **hour_data)
+            for truck, row in rewrite_hours
+            if row.get("dayshours")
+            for hour_data in parse_hours(row["dayshours"])
+        ]
+        FoodTruckOperatingHour.objects.bulk_create(
+            operating_hours, batch_size=batch_size
+        )
+        for ids in chunked(rewritten_ids, batch_size):
+            refresh_open_hours_bitmaps(ids)
+
+        stats.created = len(to_create)
+        stats.updated = len(to_update)
+        stats.moved = len(moved_ids)
+        stats.deleted = len(deleted_ids)
+        stats.operating_hours = len(operating_hours)
+        if stats.changed:
+            stats.version = bump_dataset_version(stats.summary())
+
+    stats.elapsed = time.perf_counter() - stats.started_at
+    return stats
+
+
+def chunked(items, size):
+    """
+    Split a list in chunks of `size` items, to keep `IN` queries under the
+    database parameter limit.
+    """
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
@@ -0,0 +1,465 @@
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from rest_framework.throttling import AnonRateThrottle
+import api.walking_time as walking_time
+from api.benchmarks import (
+    benchmark_google_client,
+    benchmark_loader,
+    benchmark_queries,
+    benchmark_ranking,
+    benchmark_serializer,
+    benchmark_startup,
+    benchmark_walking_time,
+    time_each,
+)
+from api.models import FoodTruck
+from api.synthetic import (
+    SF_BOUNDS,
+    FakeDistanceMatrixClient,
+    temporary_database,
+    write_synthetic_csv,
+)
+from api.utils import (
+    get_eligible_truck_ids,
+    get_top_five_closet_trucks_adaptive,
+    get_top_five_closet_trucks_by_walking_time,
+    get_top_ten_closet_trucks_by_straight_distance,
+)
+from api.views import build_response
+
+# Version of the JSON report layout
+REPORT_FORMAT = 2
+# "pipeline" is the default, the others time one component in depth
+SECTIONS = [
+    "pipeline",
+    "loader",
+    "queries",
+    "ranking",
+    "serializer",
+    "walking_time",
+    "google_client",
+    "startup",
+]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the locator pipeline end to end and stage by stage, and "
+        "optionally its components, on a synthetic dataset, against a throwaway "
+        "database, and report JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--trucks", type=int, default=5000)
+        parser.add_argument(
+            "--hours-density",
+            type=float,
+            default=0.5,
+            help="Share of the synthetic trucks with operating hours",
+        )
+        parser.add_argument(
+            "--queries", type=int, default=200, help="Queries per benchmark"
+        )
+        parser.add_argument(
+            "--round-trip-ms",
+            type=float,
+            default=0,
+            help="Simulated Distance Matrix latency, 0 to measure our code only",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--sections",
+            nargs="+",
+            choices=SECTIONS + ["all"],
+            default=["pipeline"],
+            help="Benchmarks to run",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            nargs="+",
+            default=[0],
+            help="loader: parser process counts to run the bulk loader with",
+        )
+        parser.add_argument(
+            "--legacy-rows",
+            type=int,
+            default=500,
+            help=(
+                "loader, ranking: trucks handled by the previous row-by-row code, "
+                "ranking times on larger sizes are extrapolated"
+            ),
+        )
+        parser.add_argument(
+            "--ranking-sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 100_000],
+            help="ranking: synthetic truck counts to rank",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            nargs="+",
+            default=[1, 8],
+            help="walking_time: simultaneous queries for each run",
+        )
+        parser.add_argument(
+            "--lookup-round-trip-ms",
+            type=float,
+            default=100,
+            help="walking_time, google_client: simulated Distance Matrix latency",
+        )
+        parser.add_argument(
+            "--startup-commands",
+            nargs="*",
+            default=["check"],
+            help="startup: management commands to time, with their arguments",
+        )
+        parser.add_argument(
+            "--startup-budget-ms",
+            type=float,
+            default=settings.STARTUP_BUDGET_MS,
+            help="startup: median startup allowed per target, 0 for no budget",
+        )
+        parser.add_argument(
+            "--output", default="-", help="Where to write the JSON report"
+        )
+        parser.add_argument(
+            "--baseline",
+            default=None,
+            help="Previous JSON report to compare the p50 latencies with",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.25,
+            help="Slowdown over the baseline reported as a regression",
+        )
+
+    def handle(self, *args, **kwargs):
+        sections = SECTIONS if "all" in kwargs["sections"] else kwargs["sections"]
+        rng = random.Random(kwargs["seed"])
+        (min_lat, max_lat), (min_long, max_long) = SF_BOUNDS
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        queries = [
+            (
+                rng.uniform(min_lat, max_lat),
+                rng.uniform(min_long, max_long),
+                (start + timedelta(minutes=15 * rng.randrange(672))).strftime(
+                    "%Y-%m-%dT%H:%M"
+                ),
+            )
+            for _ in range(kwargs["queries"])
+        ]
+        client = FakeDistanceMatrixClient(kwargs["round_trip_ms"], 0, connections=64)
+
+        report = {
+            "format": REPORT_FORMAT,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "platform": platform.platform(),
+                "commit": git_commit(),
+            },
+            "parameters": {
+                name: kwargs[name]
+                for name in (
+                    "trucks",
+                    "hours_density",
+                    "queries",
+                    "round_trip_ms",
+                    "seed",
+                    "workers",
+                    "legacy_rows",
+                    "ranking_sizes",
+                    "concurrency",
+                    "lookup_round_trip_ms",
+                    "startup_commands",
+                )
+            },
+            "sections": sections,
+            "benchmarks": {},
+        }
+
+        # A private cache, so the benchmark neither reads nor clears the shared one
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                    "LOCATION": "benchmark-suite",
+                }
+            },
+            WALKING_TIME_PROVIDER="api.walking_time.GoogleDistanceMatrixProvider",
+        ), mock.patch.object(
+            walking_time, "get_google_client", return_value=client
+        ), mock.patch.object(
+            AnonRateThrottle, "allow_request", return_value=True
+        ):
+            csv_path = os.path.join(directory, "trucks.csv")
+            write_synthetic_csv(
+                csv_path,
+                kwargs["trucks"],
+                seed=kwargs["seed"],
+                hours_density=kwargs["hours_density"],
+            )
+            benchmarks = report["benchmarks"]
+            with temporary_database(os.path.join(directory, "benchmark.sqlite3")):
+                benchmarks["load_food_trucks"] = self.benchmark_load(csv_path)
+                if "pipeline" in sections:
+                    benchmarks.update(self.benchmark_stages(queries))
+                    benchmarks.update(self.benchmark_requests(queries))
+                if "serializer" in sections:
+                    benchmarks.update(benchmark_serializer(rng, kwargs["queries"]))
+                # Last, it drops and recreates indexes
+                if "queries" in sections:
+                    benchmarks.update(
+                        benchmark_queries(
+                            rng, kwargs["queries"], settings.NEAREST_TRUCKS_K
+                        )
+                    )
+            if "loader" in sections:
+                benchmarks.update(
+                    benchmark_loader(
+                        csv_path, directory, kwargs["workers"], kwargs["legacy_rows"]
+                    )
+                )
+        if "ranking" in sections:
+            benchmarks.update(
+                benchmark_ranking(
+                    rng,
+                    kwargs["ranking_sizes"],
+                    kwargs["queries"],
+                    settings.NEAREST_TRUCKS_K,
+                    kwargs["legacy_rows"],
+                )
+            )
+        if "walking_time" in sections:
+            benchmarks.update(
+                benchmark_walking_time(
+                    rng,
+                    kwargs["queries"],
+                    kwargs["concurrency"],
+                    kwargs["lookup_round_trip_ms"],
+                )
+            )
+        if "google_client" in sections:
+            benchmarks.update(
+                benchmark_google_client(
+                    rng,
+                    kwargs["queries"],
+                    kwargs["lookup_round_trip_ms"],
+                    kwargs["seed"],
+                )
+            )
+        if "startup" in sections:
+            try:
+                benchmarks.update(benchmark_startup(kwargs["startup_commands"]))
+            except RuntimeError as e:
+                raise CommandError(e)
+            budget = kwargs["startup_budget_ms"]
+            report["over_budget"] = [
+                name
+                for name, result in benchmarks.items()
+                if name.startswith("startup.") and budget and result["p50_ms"] > budget
+            ]
+        report["google_calls"] = client.calls
+        report["google_elements"] = client.elements
+
+        if kwargs["baseline"]:
+            with open(kwargs["baseline"], encoding="utf-8") as file:
+                report["regressions"] = self.compare(
+                    json.load(file), report, kwargs["tolerance"]
+                )
+
+        payload = json.dumps(report, indent=2)
+        if kwargs["output"] == "-":
+            self.stdout.write(payload)
+        else:
+            with open(kwargs["output"], "w", encoding="utf-8") as file:
+                file.write(payload + "\n")
+            self.print_summary(report)
+
+        if report.get("over_budget"):
+            raise CommandError(
+                f"Startup over the {kwargs['startup_budget_ms']:.0f} ms budget: "
+                f"{', '.join(report['over_budget'])}"
+            )
+        if report.get("regressions"):
+            raise CommandError(
+                f"{len(report['regressions'])} benchmarks regressed by more than "
+                f"{kwargs['tolerance']:.0%}: {', '.join(report['regressions'])}"
+            )
+
+    def benchmark_load(self, csv_path):
+        started = time.perf_counter()
+        call_command("load_food_trucks", csv_path, stdout=io.StringIO())
+        elapsed = time.perf_counter() - started
+        trucks = FoodTruck.objects.count()
+        return {"trucks": trucks, "seconds": elapsed, "per_second": trucks / elapsed}
+
+    def benchmark_stages(self, queries):
+        """
+        Microbenchmarks of each stage of the pipeline in `api/utils.py`.
+        """
+        # Warm the process-wide indexes, their build is not part of a request
+        get_top_ten_closet_trucks_by_straight_distance(
+            *queries[0][:2], queries[0][2], "UTC"
+        )
+        candidates = [
+            get_top_ten_closet_trucks_by_straight_distance(lat, long, None, None)
+            for lat, long, _ in queries
+        ]
+        with override_settings(WALKING_TIME_CACHE_ENABLED=False):
+            rankings = [
+                get_top_five_closet_trucks_by_walking_time(lat, long, trucks)
+                for (lat, long, _), trucks in zip(queries, candidates)
+            ]
+            walking = time_each(
+                lambda lat, long, trucks: get_top_five_closet_trucks_by_walking_time(
+                    lat, long, trucks
+                ),
+                [
+                    (lat, long, trucks)
+                    for (lat, long, _), trucks in zip(queries, candidates)
+                ],
+            )
+            adaptive = time_each(
+                lambda lat, long, user_time: get_top_five_closet_trucks_adaptive(
+                    lat, long, None, None
+                ),
+                queries,
+            )
+
+        return {
+            "stage.open_hours": time_each(
+                lambda lat, long, user_time: get_eligible_truck_ids(user_time, "UTC"),
+                queries,
+            ),
+            "stage.straight_distance": time_each(
+                lambda lat, long, user_time: (
+                    get_top_ten_closet_trucks_by_straight_distance(
+                        lat, long, None, None
+                    )
+                ),
+                queries,
+            ),
+            "stage.straight_distance_open": time_each(
+                lambda lat, long, user_time: (
+                    get_top_ten_closet_trucks_by_straight_distance(
+                        lat, long, user_time, "UTC"
+                    )
+                ),
+                queries,
+            ),
+            "stage.walking_time": walking,
+            "stage.walking_time_adaptive": adaptive,
+            "stage.serialization": time_each(
+                lambda ranking: build_response(ranking), [(r,) for r in rankings]
+            ),
+        }
+
+    def benchmark_requests(self, queries):
+        """
+        Whole requests through the Django test client: every response cache
+        and walking time cache miss (cold), then the same requests again (warm).
+        """
+        client = Client()
+
+        def request(lat, long, user_time):
+            response = client.get(
+                "/api/food-trucks/",
+                {
+                    "latitude": lat,
+                    "longitude": long,
+                    "time": user_time,
+                    "timezone": "UTC",
+                },
+            )
+            if response.status_code != 200:
+                raise CommandError(
+                    f"Request failed with {response.status_code}: {response.content!r}"
+                )
+
+        results = {}
+        for name, walking_cache in (("cold", False), ("warm", True)):
+            cache.clear()
+            with override_settings(
+                WALKING_TIME_CACHE_ENABLED=walking_cache,
+                # Each cold request misses, the warm run repeats the same ones
+                CACHE_TIMEOUT=settings.CACHE_TIMEOUT if walking_cache else 0,
+                RESPONSE_CACHE_STALE_TTL=(
+                    settings.RESPONSE_CACHE_STALE_TTL if walking_cache else 0
+                ),
+            ):
+                if walking_cache:
+                    for query in queries:
+                        request(*query)
+                results[f"request.{name}"] = time_each(request, queries)
+        return results
+
+    def compare(self, baseline, report, tolerance):
+        """
+        Names of the benchmarks whose p50 latency grew by more than `tolerance`.
+        """
+        if baseline.get("parameters") != report["parameters"]:
+            self.stderr.write(
+                "The baseline was run with other parameters, comparing anyway"
+            )
+        regressions = []
+        for name, result in report["benchmarks"].items():
+            previous = baseline.get("benchmarks", {}).get(name, {})
+            if "p50_ms" in result and previous.get("p50_ms"):
+                if result["p50_ms"] > previous["p50_ms"] * (1 + tolerance):
+                    regressions.append(name)
+        return regressions
+
+    def print_summary(self, report):
+        self.stdout.write(
+            f"{'benchmark':<44} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'per s':>10}"
+        )
+        for name, result in report["benchmarks"].items():
+            per_second = (
+                f"{result['per_second']:>10.0f}" if "per_second" in result else ""
+            )
+            if "p50_ms" in result:
+                self.stdout.write(
+                    f"{name:<44} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} "
+                    f"{result['p99_ms']:>9.3f} {per_second}"
+                )
+            else:
+                self.stdout.write(
+                    f"{name:<44} {result['seconds']:>8.2f}s {'':>19} {per_second}"
+                )
+        for name in report.get("over_budget", []):
+            self.stdout.write(self.style.ERROR(f"Over the startup budget: {name}"))
+        for name in report.get("regressions", []):
+            self.stdout.write(self.style.ERROR(f"Regression: {name}"))
@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand
+from api.answer_grid import build_answer_grid
+
+
+class Command(BaseCommand):
+    help = (
+        "Precompute the straight-line candidates of every cell of a grid over the "
+        "trucks, used to answer queries without searching the whole index"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--cell-meters",
+            type=int,
+            default=None,
+            help="Side of the grid cells, ANSWER_GRID_CELL_METERS by default",
+        )
+        parser.add_argument(
+            "--candidates",
+            type=int,
+            default=None,
+            help="Trucks stored per cell, ANSWER_GRID_CANDIDATES by default",
+        )
+
+    def handle(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            grid = build_answer_grid(kwargs["cell_meters"], kwargs["candidates"])
+        except ValueError as e:
+            self.stdout.write(self.style.ERROR(str(e)))
+            return
+        self.stdout.write(
+            f"{grid.rows} x {grid.columns} cells, {len(grid.positions)} candidates "
+            f"({len(grid.to_bytes()) / 1024:.0f} KiB) "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+        self.stdout.write(self.style.SUCCESS("Answer grid stored"))
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from api.truck_snapshot import write_truck_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the memory-mapped snapshot of the trucks used by every worker, "
+        "as `load_food_trucks` does after a load"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            default=None,
+            help="Where to write the snapshot, TRUCK_SNAPSHOT_PATH by default",
+        )
+
+    def handle(self, *args, **kwargs):
+        started = time.perf_counter()
+        snapshot = write_truck_snapshot(kwargs["output"])
+        self.stdout.write(
+            f"{len(snapshot)} trucks of dataset version {snapshot.dataset_version} "
+            f"({len(snapshot.buffer) / 1024:.0f} KiB) "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+        self.stdout.write(self.style.SUCCESS("Truck snapshot written"))
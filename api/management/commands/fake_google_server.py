@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from api.synthetic import FakeGoogleMapsServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a fake Distance Matrix API with injected latency and errors, "
+        "for GOOGLE_MAPS_BASE_URL=http://127.0.0.1:<port>"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency-ms", type=float, default=100)
+        parser.add_argument(
+            "--slow-ms", type=float, default=2000, help="Latency of slow requests"
+        )
+        parser.add_argument(
+            "--slow-rate", type=float, default=0.0, help="Share of slow requests"
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Share of requests failing with an HTTP 500",
+        )
+        parser.add_argument(
+            "--status", default="OK", help="Top-level status of every response"
+        )
+
+    def handle(self, *args, **kwargs):
+        server = FakeGoogleMapsServer(
+            port=kwargs["port"],
+            latency_ms=kwargs["latency_ms"],
+            slow_ms=kwargs["slow_ms"],
+            slow_rate=kwargs["slow_rate"],
+            error_rate=kwargs["error_rate"],
+            status=kwargs["status"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"Fake Google Maps API listening on {server.url}")
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
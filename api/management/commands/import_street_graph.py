@@ -0,0 +1,44 @@
+import time
+from xml.etree.ElementTree import ParseError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.street_graph import StreetGraph
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the walkable street graph used for offline walking time estimates "
+        "from an OpenStreetMap XML extract (.osm)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("osm_file", type=str)
+        parser.add_argument(
+            "--output",
+            default=None,
+            help="Where to write the graph, STREET_GRAPH_PATH by default",
+        )
+
+    def handle(self, *args, **kwargs):
+        file_path = kwargs["osm_file"]
+        output = kwargs["output"] or settings.STREET_GRAPH_PATH
+
+        started = time.perf_counter()
+        try:
+            graph = StreetGraph.from_osm(file_path)
+        except FileNotFoundError:
+            self.stdout.write(self.style.ERROR(f"File not found: {file_path}"))
+            return
+        except ParseError as e:
+            self.stdout.write(self.style.ERROR(f"Invalid OSM file: {e}"))
+            return
+        if not len(graph):
+            self.stdout.write(self.style.ERROR("No walkable way in the extract"))
+            return
+
+        graph.save(output)
+        self.stdout.write(
+            f"{len(graph)} nodes, {len(graph.indices) // 2} street segments "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Street graph written to {output}"))
@@ -3,7 +3,7 @@ from api.utils import (
     get_top_ten_closet_trucks_by_straight_distance,
     get_top_five_closet_trucks_by_walking_time,
 )
-from api.serializers import FoodTruckSerializer
+from api.models import FoodTruck
 from rich.console import Console
 from rich.table import Table
 import traceback
@@ -20,28 +20,39 @@ class Command(BaseCommand):
             "--time", type=str, help="Time in format YYYY-MM-DD HH:MM", default=None
         )
         parser.add_argument("--timezone", type=str, help="Timezone", default=None)
+        parser.add_argument(
+            "--open-within",
+            type=int,
+            help="Also list trucks opening within this many minutes of --time",
+            default=None,
+        )
 
     def handle(self, *args, **kwargs):
         latitude = kwargs["latitude"]
         longitude = kwargs["longitude"]
         user_time = kwargs["time"]
         user_timezone = kwargs["timezone"]
+        open_within = kwargs["open_within"]
 
         # Ensure that if time is provided, timezone is also provided
         if user_time and not user_timezone:
             raise CommandError("Timezone is required when time is provided.")
+        if open_within is not None and not user_time:
+            raise CommandError("Time is required when open-within is provided.")
 
         try:
             top_ten_trucks = get_top_ten_closet_trucks_by_straight_distance(
-                latitude, longitude, user_time, user_timezone
+                latitude, longitude, user_time, user_timezone, open_within=open_within
             )
             top_five_trucks = get_top_five_closet_trucks_by_walking_time(
                 latitude, longitude, top_ten_trucks
             )
 
-            serializer = FoodTruckSerializer(
-                [truck["truck_details"] for truck in top_five_trucks], many=True
-            )
+            # Only the displayed fields are fetched
+            rows = FoodTruck.objects.filter(
+                pk__in=[truck["truck_details"].id for truck in top_five_trucks]
+            ).values_list("id", "applicant", "address", "food_items")
+            details = {truck_id: fields for truck_id, *fields in rows}
 
             # Create a Rich table
             table = Table(show_header=True, header_style="bold magenta")
@@ -52,18 +63,12 @@ class Command(BaseCommand):
             table.add_column("Duration")
 
             for truck in top_five_trucks:
-                truck_details = truck["truck_details"]
+                applicant, address, food_items = details[truck["truck_details"].id]
                 gmaps_response = truck["gmaps_response"]
                 distance = gmaps_response["rows"][0]["elements"][0]["distance"]["text"]
                 duration = gmaps_response["rows"][0]["elements"][0]["duration"]["text"]
 
-                table.add_row(
-                    truck_details.applicant,
-                    truck_details.address,
-                    truck_details.food_items,
-                    distance,
-                    duration,
-                )
+                table.add_row(applicant, address, food_items, distance, duration)
             self.console.print(table)
         except Exception as e:
             self.console.print(traceback.format_exc())
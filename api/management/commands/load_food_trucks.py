@@ -1,8 +1,13 @@
 import csv
+import time
+from django.apps import apps
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from api.models import FoodTruck, FoodTruckOperatingHour
-from datetime import datetime
-from django.utils import timezone
+from api.answer_grid import build_answer_grid
+from api.importer import bulk_import, sync_import
+from api.open_hours import invalidate_open_hours_index
+from api.spatial_index import invalidate_truck_index
+from api.truck_snapshot import write_truck_snapshot
 
 
 class Command(BaseCommand):
@@ -10,171 +15,59 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("csv_file", type=str)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of CSV rows written per transaction",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help="Processes parsing CSV chunks in parallel, 0 to parse in-process",
+        )
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="Make the database match the CSV: insert, update and delete trucks",
+        )
 
     def handle(self, *args, **kwargs):
         file_path = kwargs["csv_file"]
 
-        # Function to parse datetime in AM/PM format
-        def parse_datetime(datetime_str):
-            if datetime_str:
-                try:
-                    naive_datetime = datetime.strptime(
-                        datetime_str, "%m/%d/%Y %I:%M:%S %p"
-                    )
-                    return timezone.make_aware(
-                        naive_datetime, timezone.get_default_timezone()
-                    )
-                except ValueError:
-                    self.stdout.write(
-                        self.style.ERROR("Invalid datetime format detected.")
-                    )
-            return None
-
-        # Function to parse date without time
-        def parse_date(datetime_str):
-            if datetime_str:
-                try:
-                    naive_datetime = datetime.strptime(datetime_str, "%Y%m%d")
-                    return timezone.make_aware(
-                        naive_datetime, timezone.get_default_timezone()
-                    )
-                except ValueError:
-                    self.stdout.write(self.style.ERROR("Invalid date format detected."))
-            return None
-
-        # Function to parse day range like 'Mo-We'
-        def parse_day_range(day_range_str):
-            days_mapping = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
-            start_day, end_day = day_range_str.split("-")
-            start_index = days_mapping.index(start_day)
-            end_index = days_mapping.index(end_day)
-            return days_mapping[start_index : end_index + 1]
-
-        # Function to parse operating hours
-        def parse_hours(hours_str):
-            days_mapping = {
-                "Mo": "Monday",
-                "Tu": "Tuesday",
-                "We": "Wednesday",
-                "Th": "Thursday",
-                "Fr": "Friday",
-                "Sa": "Saturday",
-                "Su": "Sunday",
-            }
-
-            day_groups = hours_str.split(";")
-            operating_hours = []
-
-            for group in day_groups:
-                days, times = group.split(":")
-                time_ranges = times.split("/")
-                for time_range in time_ranges:
-                    open_time, close_time = time_range.split("-")
-                    if "-" in days:
-                        day_range = parse_day_range(days)
-                        for day_code in day_range:
-                            operating_hours.append(
-                                {
-                                    "day": days_mapping[day_code],
-                                    "open_time": datetime.strptime(
-                                        open_time.strip(), "%I%p"
-                                    ).time(),
-                                    "close_time": datetime.strptime(
-                                        close_time.strip(), "%I%p"
-                                    ).time(),
-                                }
-                            )
-                    else:
-                        for day_code in days.split("/"):
-                            operating_hours.append(
-                                {
-                                    "day": days_mapping[day_code],
-                                    "open_time": datetime.strptime(
-                                        open_time.strip(), "%I%p"
-                                    ).time(),
-                                    "close_time": datetime.strptime(
-                                        close_time.strip(), "%I%p"
-                                    ).time(),
-                                }
-                            )
-
-            return operating_hours
-
         # Read CSV and populate database
         try:
-            with open(file_path, mode="r", encoding="utf-8-sig") as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    # Check for duplicates and valid latitude/longitude
-                    if (
-                        not FoodTruck.objects.filter(
-                            location_id=row["locationid"],
-                            latitude=row["Latitude"],
-                            longitude=row["Longitude"],
-                        ).exists()
-                        and float(row.get("Latitude")) != 0
-                        and float(row.get("Longitude")) != 0
-                    ):
-                        # Map CSV row to FoodTruck model fields
-                        mapped_row = {
-                            "location_id": row.get("locationid"),
-                            "applicant": row.get("Applicant"),
-                            "facility_type": row.get("FacilityType"),
-                            "cnn": row.get("cnn"),
-                            "location_description": row.get("LocationDescription"),
-                            "address": row.get("Address"),
-                            "block_lot": row.get("blocklot"),
-                            "block": row.get("block"),
-                            "lot": row.get("lot"),
-                            "permit": row.get("permit"),
-                            "status": row.get("Status"),
-                            "food_items": row.get("FoodItems"),
-                            "x": float(row.get("X")) if row.get("X") else None,
-                            "y": float(row.get("Y")) if row.get("Y") else None,
-                            "latitude": float(row.get("Latitude")),
-                            "longitude": float(row.get("Longitude")),
-                            "schedule": row.get("Schedule"),
-                            "days_hours": row.get("dayshours")
-                            if row.get("dayshours")
-                            else None,
-                            "noi_sent": row.get("NOISent"),
-                            "approved": parse_datetime(row.get("Approved")),
-                            "received": parse_date(row.get("Received")),
-                            "prior_permit": int(row.get("PriorPermit")),
-                            "expiration_date": parse_datetime(
-                                row.get("ExpirationDate")
-                            ),
-                            "location": row.get("Location"),
-                            "fire_prevention_districts": int(
-                                row.get("Fire Prevention Districts")
-                            )
-                            if row.get("Fire Prevention Districts")
-                            else None,
-                            "police_districts": int(row.get("Police Districts"))
-                            if row.get("Police Districts")
-                            else None,
-                            "supervisor_districts": int(row.get("Supervisor Districts"))
-                            if row.get("Supervisor Districts")
-                            else None,
-                            "zip_codes": int(row.get("Zip Codes"))
-                            if row.get("Zip Codes")
-                            else None,
-                            "neighborhoods": row.get("Neighborhoods (old)"),
-                        }
-                        # Create FoodTruck instance
-                        food_truck_instance = FoodTruck.objects.create(**mapped_row)
+            if kwargs["sync"]:
+                stats = sync_import(file_path, batch_size=kwargs["batch_size"])
+            else:
+                stats = bulk_import(
+                    file_path,
+                    batch_size=kwargs["batch_size"],
+                    workers=kwargs["workers"],
+                )
+
+            for error in stats.errors:
+                self.stdout.write(self.style.ERROR(error))
 
-                        # Parse and create operating hours
-                        if row.get("dayshours"):
-                            hours_data = parse_hours(row["dayshours"])
-                            for hour_data in hours_data:
-                                FoodTruckOperatingHour.objects.create(
-                                    food_truck=food_truck_instance,
-                                    day=hour_data["day"],
-                                    open_time=hour_data["open_time"],
-                                    close_time=hour_data["close_time"],
-                                )
+            # Make this process rebuild its in-memory indexes from the new data
+            invalidate_truck_index()
+            invalidate_open_hours_index()
 
+            if kwargs["sync"]:
+                self.report_sync(stats)
+            else:
+                self.report_load(stats)
+            self.report_version(stats)
+            if settings.ANSWER_GRID_ENABLED:
+                self.rebuild_answer_grid()
+            if settings.TRUCK_SNAPSHOT_ENABLED:
+                self.write_snapshot()
+            if apps.is_installed("api.geo"):
+                # Imported here, GeoDjango needs GDAL which the default mode does not
+                from api.geo.queries import refresh_truck_locations
+
+                refresh_truck_locations()
             self.stdout.write(self.style.SUCCESS("Successfully loaded food truck data"))
         except FileNotFoundError:
             self.stdout.write(self.style.ERROR(f"File not found: {file_path}"))
@@ -182,3 +75,58 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f"CSV error: {e}"))
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Unexpected error: {e}"))
+
+    def report_load(self, stats):
+        self.stdout.write(
+            f"Read {stats.rows} rows in {stats.elapsed:.2f}s "
+            f"({stats.rows_per_second:,.0f} rows/s): "
+            f"{stats.created} trucks and {stats.operating_hours} operating hours "
+            f"created, {stats.duplicates} duplicates, {stats.conflicts} location "
+            f"id conflicts and {stats.unlocatable} rows without coordinates skipped"
+        )
+        for stage in stats.stages.values():
+            self.stdout.write(
+                f"  {stage.name:<6} {stage.rows:>10} rows {stage.seconds:>8.2f}s "
+                f"{stage.rows_per_second:>12,.0f} rows/s"
+            )
+
+    def report_sync(self, stats):
+        self.stdout.write(
+            f"Read {stats.rows} rows in {stats.elapsed:.2f}s "
+            f"({stats.rows_per_second:,.0f} rows/s): "
+            f"{stats.created} trucks created, {stats.updated} updated "
+            f"({stats.hours_changed} with new operating hours, {stats.moved} moved), "
+            f"{stats.deleted} deleted and {stats.unchanged} unchanged; "
+            f"{stats.duplicates} duplicates and {stats.unlocatable} rows without "
+            f"coordinates skipped"
+        )
+
+    def rebuild_answer_grid(self):
+        # Grids are tied to a dataset version, the previous one no longer answers
+        started = time.perf_counter()
+        try:
+            grid = build_answer_grid()
+        except ValueError as e:
+            # The trucks are loaded, queries search the index instead
+            self.stdout.write(self.style.WARNING(f"Answer grid not rebuilt: {e}"))
+            return
+        self.stdout.write(
+            f"Answer grid rebuilt: {grid.cell_count} cells, "
+            f"{len(grid.positions)} candidates in {time.perf_counter() - started:.2f}s"
+        )
+
+    def write_snapshot(self):
+        # Workers swap the new snapshot in on their next check
+        started = time.perf_counter()
+        snapshot = write_truck_snapshot()
+        self.stdout.write(
+            f"Truck snapshot written: {len(snapshot)} trucks, "
+            f"{len(snapshot.buffer) / 1024:.0f} KiB "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+
+    def report_version(self, stats):
+        if stats.version is None:
+            self.stdout.write("No changes, dataset version unchanged")
+        else:
+            self.stdout.write(f"Dataset version is now {stats.version}")
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-17 21:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0004_alter_foodtruck_days_hours"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WalkingTimeCacheEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("origin_cell", models.CharField(max_length=50)),
+                ("element", models.JSONField()),
+                ("created_at", models.DateTimeField()),
+                ("last_used_at", models.DateTimeField(db_index=True)),
+                (
+                    "food_truck",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="walking_time_cache_entries",
+                        to="api.foodtruck",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="walkingtimecacheentry",
+            constraint=models.UniqueConstraint(
+                fields=("origin_cell", "food_truck"), name="unique_walking_time_cell"
+            ),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:20
+
+from django.db import migrations, models
+
+# A copy of api.week_bitmap.encode_week_bitmap as of this migration, which must
+# keep producing the same bitmaps whatever happens to that module
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+SLOT_SECONDS = 15 * 60
+SLOTS_PER_WEEK = 7 * 24 * 60 * 60 // SLOT_SECONDS
+
+
+def encode_week_bitmap(hours):
+    bitmap = bytearray(SLOTS_PER_WEEK // 8)
+    for day, open_time, close_time in hours:
+        day_start = DAYS.index(day) * 24 * 60 * 60
+        start = day_start + open_time.hour * 3600 + open_time.minute * 60
+        start += open_time.second
+        end = day_start + close_time.hour * 3600 + close_time.minute * 60
+        end += close_time.second
+        if end > start:
+            # Slots covered by [start, end), bits in little-endian order
+            for slot in range(start // SLOT_SECONDS, -(-end // SLOT_SECONDS)):
+                bitmap[slot // 8] |= 1 << (slot % 8)
+    return bytes(bitmap)
+
+
+def fill_open_hours_bitmaps(apps, schema_editor):
+    FoodTruck = apps.get_model("api", "FoodTruck")
+    FoodTruckOperatingHour = apps.get_model("api", "FoodTruckOperatingHour")
+
+    hours_by_truck = {}
+    rows = FoodTruckOperatingHour.objects.values_list(
+        "food_truck_id", "day", "open_time", "close_time"
+    )
+    for truck_id, *hours in rows:
+        hours_by_truck.setdefault(truck_id, []).append(hours)
+
+    trucks = list(FoodTruck.objects.filter(pk__in=hours_by_truck))
+    for truck in trucks:
+        truck.open_hours_bitmap = encode_week_bitmap(hours_by_truck[truck.pk])
+    FoodTruck.objects.bulk_update(trucks, ["open_hours_bitmap"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0006_datasetversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="foodtruck",
+            name="open_hours_bitmap",
+            field=models.BinaryField(blank=True, max_length=84, null=True),
+        ),
+        migrations.RunPython(fill_open_hours_bitmaps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0007_foodtruck_open_hours_bitmap"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PrecomputedGrid",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("dataset_version", models.PositiveIntegerField(db_index=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("cell_meters", models.PositiveIntegerField()),
+                ("candidates", models.PositiveIntegerField()),
+                ("data", models.BinaryField()),
+            ],
+        ),
+    ]
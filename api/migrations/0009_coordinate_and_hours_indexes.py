@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0008_precomputedgrid"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="foodtruck",
+            index=models.Index(
+                fields=["latitude", "longitude"], name="foodtruck_coordinates"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="foodtruckoperatinghour",
+            index=models.Index(
+                fields=["food_truck", "day"], name="operating_hour_truck_day"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="foodtruckoperatinghour",
+            name="food_truck",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="operating_hours",
+                to="api.foodtruck",
+            ),
+        ),
+    ]
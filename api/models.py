@@ -31,6 +31,16 @@ class FoodTruck(models.Model):
     supervisor_districts = models.IntegerField(null=True, blank=True)
     zip_codes = models.IntegerField(null=True, blank=True)
     neighborhoods = models.CharField(max_length=255, null=True, blank=True)
+    # Weekly availability, one bit per quarter hour (see api/week_bitmap.py)
+    open_hours_bitmap = models.BinaryField(max_length=84, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Bounding box queries of `nearest_from_database`
+            models.Index(
+                fields=["latitude", "longitude"], name="foodtruck_coordinates"
+            ),
+        ]
 
     def __str__(self):
         return self.applicant
@@ -38,11 +48,75 @@ class FoodTruck(models.Model):
 
 class FoodTruckOperatingHour(models.Model):
     food_truck = models.ForeignKey(
-        FoodTruck, related_name="operating_hours", on_delete=models.CASCADE
+        FoodTruck,
+        related_name="operating_hours",
+        on_delete=models.CASCADE,
+        # Covered by the (food_truck, day) index
+        db_index=False,
     )
     day = models.CharField(max_length=9)  # For example, 'Monday', 'Tuesday', etc.
     open_time = models.TimeField()
     close_time = models.TimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["food_truck", "day"], name="operating_hour_truck_day"),
+        ]
+
     def __str__(self):
         return f"{self.food_truck.applicant} - {self.day}: {self.open_time.strftime('%I:%M %p')} - {self.close_time.strftime('%I:%M %p')}"
+
+
+class WalkingTimeCacheEntry(models.Model):
+    """
+    Google Distance Matrix element for walking from an origin cell to a truck.
+    """
+
+    origin_cell = models.CharField(max_length=50)
+    food_truck = models.ForeignKey(
+        FoodTruck, related_name="walking_time_cache_entries", on_delete=models.CASCADE
+    )
+    element = models.JSONField()
+    created_at = models.DateTimeField()
+    last_used_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["origin_cell", "food_truck"], name="unique_walking_time_cell"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.origin_cell} -> {self.food_truck_id}"
+
+
+class DatasetVersion(models.Model):
+    """
+    One row per change of the food truck dataset. The latest version is part of
+    downstream cache keys, so a new version makes them miss.
+    """
+
+    version = models.PositiveIntegerField(unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    summary = models.JSONField(default=dict)
+
+    def __str__(self):
+        return f"v{self.version}"
+
+
+class PrecomputedGrid(models.Model):
+    """
+    Straight-line candidate trucks precomputed for every cell of a grid over
+    the trucks' bounding box, for one dataset version (see api/answer_grid.py).
+    """
+
+    dataset_version = models.PositiveIntegerField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    cell_meters = models.PositiveIntegerField()
+    candidates = models.PositiveIntegerField()
+    # Grid geometry and candidate lists, as a compressed .npz archive
+    data = models.BinaryField()
+
+    def __str__(self):
+        return f"v{self.dataset_version} grid of {self.cell_meters} m cells"
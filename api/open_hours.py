@@ -0,0 +1,172 @@
+from collections import defaultdict
+import numpy as np
+from django.db.models import Count, Max
+from .models import FoodTruck, FoodTruckOperatingHour
+from .dataset_version import get_dataset_version
+from .process_cache import ProcessWideCache
+from .truck_snapshot import get_truck_snapshot
+from .week_bitmap import (
+    BITMAP_BYTES,
+    SLOT_SECONDS,
+    SLOTS_PER_WEEK,
+    encode_week_bitmap,
+    second_of_week,
+    stack_week_bitmaps,
+)
+
+
+def week_boundaries(bitmaps, chunk_size=4096):
+    """
+    Moments of the week at which the set of open trucks can change, for a
+    matrix of packed weekly bitmaps: a slot boundary where some truck's
+    availability changes and, closing times being inclusive, a second after it.
+    """
+    changed = np.zeros(SLOTS_PER_WEEK - 1, dtype=bool)
+    # Unpacked a chunk of trucks at a time, a slot taking a byte once unpacked
+    for start in range(0, len(bitmaps), chunk_size):
+        slots = np.unpackbits(
+            bitmaps[start : start + chunk_size], axis=1, bitorder="little"
+        )
+        changed |= np.any(slots[:, 1:] != slots[:, :-1], axis=0)
+    changed = np.flatnonzero(changed) + 1
+    return sorted(
+        {0}
+        | {int(slot) * SLOT_SECONDS for slot in changed}
+        | {int(slot) * SLOT_SECONDS + 1 for slot in changed}
+    )
+
+
+class OpenHoursIndex:
+    """
+    Weekly availability bitmaps of every truck, kept packed as stored (see
+    `api/week_bitmap.py`) in a truck-major matrix, so "which trucks are open at
+    T" reads a single byte column. The arrays may be read-only views of the
+    memory-mapped truck snapshot.
+    """
+
+    def __init__(self, truck_ids, bitmaps, boundaries=None):
+        # truck_ids in ascending order, bitmaps[i] being the packed bitmap of
+        # truck_ids[i]
+        self.truck_ids = np.asarray(truck_ids, dtype=np.int64)
+        self.bitmaps = np.asarray(bitmaps, dtype=np.uint8).reshape(
+            len(self.truck_ids), BITMAP_BYTES
+        )
+        self.boundaries = list(
+            week_boundaries(self.bitmaps) if boundaries is None else boundaries
+        )
+
+    @classmethod
+    def from_database(cls):
+        """
+        Build the index from the bitmaps stored on the FoodTruck table.
+        """
+        rows = list(
+            FoodTruck.objects.order_by("id").values_list("id", "open_hours_bitmap")
+        )
+        return cls(
+            [truck_id for truck_id, _ in rows],
+            stack_week_bitmaps([bitmap for _, bitmap in rows]),
+        )
+
+    def _slot_mask(self, slot):
+        return ((self.bitmaps[:, slot >> 3] >> (slot & 7)) & 1).astype(bool)
+
+    def _open_mask(self, moment):
+        slot = moment // SLOT_SECONDS
+        mask = self._slot_mask(slot)
+        if moment % SLOT_SECONDS == 0 and slot > 0:
+            # A truck closing exactly at this moment is still open
+            mask |= self._slot_mask(slot - 1)
+        return mask
+
+    def open_truck_ids(self, user_datetime):
+        """
+        Return the ids of every truck open at the given datetime.
+        """
+        moment = second_of_week(user_datetime.weekday(), user_datetime.time())
+        return set(self.truck_ids[self._open_mask(moment)].tolist())
+
+    def open_within_truck_ids(self, user_datetime, minutes):
+        """
+        Return the ids of every truck open at some point between the given
+        datetime and `minutes` later, wrapping around the end of the week.
+        """
+        moment = second_of_week(user_datetime.weekday(), user_datetime.time())
+        last_slot = (moment + minutes * 60) // SLOT_SECONDS
+        slots = np.arange(moment // SLOT_SECONDS, last_slot + 1) % SLOTS_PER_WEEK
+        # Only the bytes holding these slots are unpacked
+        columns = np.unique(slots >> 3)
+        bits = np.unpackbits(self.bitmaps[:, columns], axis=1, bitorder="little")
+        selected = np.searchsorted(columns, slots >> 3) * 8 + (slots & 7)
+        mask = self._open_mask(moment) | np.any(bits[:, selected], axis=1)
+        return set(self.truck_ids[mask].tolist())
+
+    def is_open(self, truck_id, user_datetime):
+        """
+        Check if a single truck is open at the given datetime.
+        """
+        column = int(np.searchsorted(self.truck_ids, truck_id))
+        if column == len(self.truck_ids) or self.truck_ids[column] != truck_id:
+            return False
+        moment = second_of_week(user_datetime.weekday(), user_datetime.time())
+        return bool(self._open_mask(moment)[column])
+
+
+def refresh_open_hours_bitmap(truck_id):
+    """
+    Recompute the stored bitmap of a truck from its operating hours rows.
+    """
+    refresh_open_hours_bitmaps([truck_id])
+
+
+def refresh_open_hours_bitmaps(truck_ids):
+    """
+    Recompute the stored bitmaps of several trucks from their operating hours
+    rows, in two queries. Trucks without hours get no bitmap.
+    """
+    hours = defaultdict(list)
+    rows = FoodTruckOperatingHour.objects.filter(
+        food_truck_id__in=truck_ids
+    ).values_list("food_truck_id", "day", "open_time", "close_time")
+    for truck_id, day, open_time, close_time in rows:
+        hours[truck_id].append((day, open_time, close_time))
+    FoodTruck.objects.bulk_update(
+        [
+            FoodTruck(
+                pk=truck_id,
+                open_hours_bitmap=(
+                    encode_week_bitmap(hours[truck_id]) if truck_id in hours else None
+                ),
+            )
+            for truck_id in truck_ids
+        ],
+        ["open_hours_bitmap"],
+    )
+
+
+def _table_fingerprint():
+    return (get_dataset_version(),) + tuple(
+        FoodTruck.objects.aggregate(count=Count("id"), max_id=Max("id")).values()
+    )
+
+
+_open_hours_index = ProcessWideCache(OpenHoursIndex.from_database, _table_fingerprint)
+
+
+def get_open_hours_index():
+    """
+    Return the open hours index of the truck snapshot when one is available.
+    Otherwise return the process-wide index, building it on first use and
+    rebuilding it whenever the truck table has changed.
+    """
+    snapshot = get_truck_snapshot()
+    if snapshot is not None:
+        return snapshot.open_hours
+    return _open_hours_index.get()
+
+
+def invalidate_open_hours_index(**kwargs):
+    """
+    Drop the process-wide open hours index so the next query rebuilds it.
+    """
+    _open_hours_index.invalidate()
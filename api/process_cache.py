@@ -0,0 +1,47 @@
+import threading
+import time
+from django.conf import settings
+
+
+class ProcessWideCache:
+    """
+    Holds an in-memory structure derived from the database (e.g. the truck
+    index), built lazily on first use and shared by every request of the process.
+
+    `build` creates the structure. `fingerprint` cheaply summarises the source
+    tables; it is re-checked every TRUCK_INDEX_REFRESH_SECONDS so that changes
+    made by other processes (e.g. `load_food_trucks`) trigger a rebuild.
+    """
+
+    def __init__(self, build, fingerprint):
+        self.build = build
+        self.fingerprint = fingerprint
+        self._value = None
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        refresh_seconds = getattr(settings, "TRUCK_INDEX_REFRESH_SECONDS", 60)
+        now = time.monotonic()
+        if self._value is not None and now - self._checked_at < refresh_seconds:
+            return self._value
+
+        with self._lock:
+            if self._value is not None and now - self._checked_at < refresh_seconds:
+                return self._value
+            fingerprint = self.fingerprint()
+            if self._value is None or fingerprint != self._fingerprint:
+                self._value = self.build()
+                self._fingerprint = fingerprint
+            self._checked_at = now
+            return self._value
+
+    def invalidate(self, **kwargs):
+        """
+        Drop the cached structure so the next `get` rebuilds it.
+        Also usable as a signal receiver.
+        """
+        with self._lock:
+            self._value = None
+            self._fingerprint = None
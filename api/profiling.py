@@ -0,0 +1,275 @@
+import bisect
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+# Upper bounds (in milliseconds) of the latency histogram buckets, growing by
+# 25% from 50 microseconds to about 2 minutes. Percentiles are reported as the
+# upper bound of their bucket, so they are at most 25% above the true value.
+BUCKET_BOUNDS_MS = [0.05 * 1.25**i for i in range(67)]
+PERCENTILES = (50, 95, 99)
+
+
+class RequestProfile:
+    """
+    Timings of one request: wall time per stage (stages may be nested, each
+    one is timed inclusively), plus the database queries and external calls.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.external_calls = {}
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_external_call(self, name, seconds):
+        calls, total = self.external_calls.get(name, (0, 0.0))
+        self.external_calls[name] = (calls + 1, total + seconds)
+
+    def server_timing(self, total_seconds):
+        """
+        Render the profile as a Server-Timing header value.
+        """
+        metrics = [
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()
+        ]
+        metrics.append(
+            f'db;dur={self.query_seconds * 1000:.2f};desc="{self.queries} queries"'
+        )
+        for name, (calls, seconds) in self.external_calls.items():
+            metrics.append(f'{name};dur={seconds * 1000:.2f};desc="{calls} calls"')
+        metrics.append(f"total;dur={total_seconds * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+# Profile of the request being handled. Context variables follow the request
+# into `sync_to_async` threads, so queries made there are counted too.
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the enclosed block as a stage of the current request, if any.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def external_call(name):
+    """
+    Count and time the enclosed call to an external service.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_external_call(name, time.perf_counter() - started)
+
+
+def count_queries(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding every query to the current profile.
+    Installed on each new connection, see `api/signals.py`.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.queries += 1
+        profile.query_seconds += time.perf_counter() - started
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram, cheap enough to update on every request.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, percent):
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if bucket == len(BUCKET_BOUNDS_MS):
+                    return self.max_ms
+                return min(BUCKET_BOUNDS_MS[bucket], self.max_ms)
+        return None
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else None,
+            "max_ms": self.max_ms,
+            **{f"p{percent}_ms": self.percentile(percent) for percent in PERCENTILES},
+        }
+
+
+class RequestMetrics:
+    """
+    Latency histograms per route and stage, aggregated over the requests
+    served by this process.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, profile, total_seconds):
+        samples = {"total": total_seconds, "db": profile.query_seconds}
+        samples.update(profile.stages)
+        samples.update(
+            (name, seconds) for name, (_, seconds) in profile.external_calls.items()
+        )
+        counters = {"requests": 1, "db_queries": profile.queries}
+        counters.update(
+            (f"{name}_calls", calls)
+            for name, (calls, _) in profile.external_calls.items()
+        )
+        with self._lock:
+            histograms = self._histograms.setdefault(route, {})
+            for name, seconds in samples.items():
+                histograms.setdefault(name, LatencyHistogram()).add(seconds * 1000)
+            route_counters = self._counters.setdefault(route, {})
+            for name, value in counters.items():
+                route_counters[name] = route_counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                route: {
+                    "counters": dict(self._counters[route]),
+                    "stages": {
+                        name: histogram.summary()
+                        for name, histogram in histograms.items()
+                    },
+                }
+                for route, histograms in self._histograms.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+request_metrics = RequestMetrics()
+
+
+class ProfilingMiddleware:
+    """
+    Profile every request: per-stage timings, database queries and external
+    calls are sent back in a Server-Timing header and aggregated in
+    `request_metrics`.
+
+    A PROFILING_SAMPLE_RATE fraction of the sync requests also runs under
+    cProfile, and the profiles of those slower than PROFILING_SLOW_REQUEST_MS
+    are dumped to PROFILING_DUMP_DIR (open them with `python -m pstats`).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.PROFILING_ENABLED:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        profiler = None
+        if random.random() < settings.PROFILING_SAMPLE_RATE:
+            profiler = cProfile.Profile()
+        try:
+            if profiler is not None:
+                response = profiler.runcall(self.get_response, request)
+            else:
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        total_seconds = time.perf_counter() - profile.started
+        if profiler is not None:
+            self.dump_if_slow(request, profiler, total_seconds)
+        return self.finish(request, response, profile, total_seconds)
+
+    async def __acall__(self, request):
+        if not settings.PROFILING_ENABLED:
+            return await self.get_response(request)
+
+        # cProfile would also see the other requests of the event loop, async
+        # requests are only timed
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        return self.finish(
+            request, response, profile, time.perf_counter() - profile.started
+        )
+
+    def finish(self, request, response, profile, total_seconds):
+        response["Server-Timing"] = profile.server_timing(total_seconds)
+        request_metrics.record(route_name(request), profile, total_seconds)
+        return response
+
+    def dump_if_slow(self, request, profiler, total_seconds):
+        if total_seconds * 1000 < settings.PROFILING_SLOW_REQUEST_MS:
+            return
+        os.makedirs(settings.PROFILING_DUMP_DIR, exist_ok=True)
+        profiler.dump_stats(
+            os.path.join(
+                settings.PROFILING_DUMP_DIR,
+                f"{time.strftime('%Y%m%d-%H%M%S')}-{route_name(request)}-"
+                f"{total_seconds * 1000:.0f}ms.prof",
+            )
+        )
+
+
+def route_name(request):
+    match = getattr(request, "resolver_match", None)
+    return match.url_name if match and match.url_name else "other"
@@ -0,0 +1,130 @@
+import numpy as np
+from geographiclib.geodesic import Geodesic
+
+EARTH_RADIUS_METERS = 6371008.8
+# Haversine works on a sphere while geopy uses the WGS-84 ellipsoid. For the
+# same pair of points the two distances never differ by more than ~0.56%, so two
+# trucks can only swap places if their spherical distances are within this ratio.
+SPHERE_ERROR = 0.0057
+AMBIGUITY_RATIO = (1 + SPHERE_ERROR) / (1 - SPHERE_ERROR)
+# The WGS-84 ellipsoid in kilometers, as geopy builds it. Importing geopy.distance
+# imports every geopy geocoder with it, a tenth of a second of worker boot
+WGS84 = Geodesic(6378.137, 1 / 298.257223563)
+
+
+def geodesic_meters(lat_1, long_1, lat_2, long_2):
+    """
+    Geodesic distance in meters, the same float as
+    `geopy.distance.distance(...).meters`.
+    """
+    return WGS84.Inverse(lat_1, long_1, lat_2, long_2, Geodesic.DISTANCE)["s12"] * 1000
+
+
+def rerank_by_geodesic(lat, long, ranked, coordinates, k):
+    """
+    Re-order `ranked`, a list of (spherical meters, index) tuples sorted by
+    distance, by exact geodesic distance and return the first `k` of them.
+    Geodesic distances are expensive, so they are only computed for groups of
+    candidates whose spherical distances are too close to be ordered reliably.
+    """
+    resolved = []
+    start = 0
+    while start < len(ranked) and len(resolved) < k:
+        end = start + 1
+        while (
+            end < len(ranked) and ranked[end][0] <= ranked[end - 1][0] * AMBIGUITY_RATIO
+        ):
+            end += 1
+        group = ranked[start:end]
+        if len(group) > 1:
+            group = sorted(
+                (geodesic_meters(lat, long, *coordinates[i]), i) for _, i in group
+            )
+        resolved.extend(group)
+        start = end
+    return resolved[:k]
+
+
+class HaversineRanker:
+    """
+    Batch distance engine holding every truck coordinate in contiguous float64
+    arrays, so the distances to a query point are computed in a single
+    vectorized haversine pass.
+    """
+
+    def __init__(self, ids, latitudes, longitudes):
+        self.ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self.latitudes = np.ascontiguousarray(latitudes, dtype=np.float64)
+        self.longitudes = np.ascontiguousarray(longitudes, dtype=np.float64)
+        self.lat_radians = np.radians(self.latitudes)
+        self.long_radians = np.radians(self.longitudes)
+        self.cos_lat = np.cos(self.lat_radians)
+
+    @classmethod
+    def from_columns(
+        cls, ids, latitudes, longitudes, lat_radians, long_radians, cos_lat
+    ):
+        """
+        Ranker over precomputed columns, used as they are, e.g. views of the
+        memory-mapped truck snapshot.
+        """
+        ranker = cls.__new__(cls)
+        ranker.ids = ids
+        ranker.latitudes = latitudes
+        ranker.longitudes = longitudes
+        ranker.lat_radians = lat_radians
+        ranker.long_radians = long_radians
+        ranker.cos_lat = cos_lat
+        return ranker
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, lat, long):
+        """
+        Haversine distances in meters from (lat, long) to every truck.
+        """
+        lat_rad = np.radians(lat)
+        half_dlat = (self.lat_radians - lat_rad) / 2
+        half_dlong = (self.long_radians - np.radians(long)) / 2
+        a = np.sin(half_dlat) ** 2 + np.cos(lat_rad) * self.cos_lat * (
+            np.sin(half_dlong) ** 2
+        )
+        return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    def top_k(self, lat, long, k=10, mask=None, exact=False):
+        """
+        Return the positions and meters of the `k` trucks closest to (lat, long)
+        as a list of (position, meters) tuples. `mask` is an optional boolean
+        array selecting the eligible trucks. With `exact` the final candidates
+        are re-ranked by geodesic distance, matching a full geopy scan.
+        """
+        meters = self.distances(lat, long)
+        positions = np.arange(len(meters))
+        if mask is not None:
+            positions = positions[mask]
+            meters = meters[mask]
+        if k <= 0 or not len(meters):
+            return []
+
+        if len(meters) > k:
+            # Partial selection is O(N); only the winners get sorted
+            kth = np.partition(meters, k - 1)[k - 1]
+            limit = kth * AMBIGUITY_RATIO if exact else kth
+            selected = np.flatnonzero(meters <= limit)
+        else:
+            selected = np.arange(len(meters))
+        # Ties keep the table order, as a stable full sort would
+        selected = selected[np.lexsort((positions[selected], meters[selected]))]
+        ranked = list(zip(meters[selected].tolist(), positions[selected].tolist()))
+
+        if exact:
+            coordinates = {
+                position: (
+                    float(self.latitudes[position]),
+                    float(self.longitudes[position]),
+                )
+                for _, position in ranked
+            }
+            ranked = rerank_by_geodesic(lat, long, ranked, coordinates, k)
+        return [(position, meters) for meters, position in ranked[:k]]
@@ -0,0 +1,397 @@
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from .dataset_version import get_dataset_version
+from .open_hours import get_open_hours_index
+from .walking_time import serving_estimates
+from .week_bitmap import SECONDS_PER_WEEK, second_of_week
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+HITS_KEY = "food_trucks_cache_hits"
+STALE_HITS_KEY = "food_trucks_cache_stale_hits"
+MISSES_KEY = "food_trucks_cache_misses"
+# How often a request waiting for another worker's computation checks for it
+LOCK_POLL_INTERVAL = 0.05  # In seconds
+# Threads refreshing stale entries in the background, per process
+REFRESH_THREADS = 2
+# How often the hit/miss counts of a process are added to the shared counters
+STATS_FLUSH_INTERVAL = 10  # In seconds
+
+logger = logging.getLogger(__name__)
+
+_refresh_executor = None
+# Keys being refreshed by this process, and the refresh tasks of the event
+# loop, which only keeps weak references to them
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_refresh_tasks = set()
+# Hit/miss counts of this process not yet added to the shared counters
+_counts = dict.fromkeys([HITS_KEY, STALE_HITS_KEY, MISSES_KEY], 0)
+_counts_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def encode_geohash(lat, long, precision):
+    """
+    Encode a coordinate as a geohash of `precision` characters.
+    """
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value, value_range = (long, long_range) if even else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            value_range[0] = middle
+        else:
+            bits = bits << 1
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def normalize_coordinates(lat, long):
+    """
+    Snap a coordinate according to RESPONSE_CACHE_COORDINATE_MODE so that nearby
+    queries share a cache entry:
+    - "grid": rounded to RESPONSE_CACHE_GRID_DECIMALS decimals
+    - "geohash": geohash of RESPONSE_CACHE_GEOHASH_PRECISION characters
+    - "exact": the coordinate itself, only formatting differences are ignored
+    """
+    mode = settings.RESPONSE_CACHE_COORDINATE_MODE
+    if mode == "geohash":
+        return encode_geohash(lat, long, settings.RESPONSE_CACHE_GEOHASH_PRECISION)
+    if mode == "grid":
+        decimals = settings.RESPONSE_CACHE_GRID_DECIMALS
+        # Adding 0.0 turns a rounded -0.0 into 0.0
+        return ",".join(
+            f"{round(value, decimals) + 0.0:.{decimals}f}" for value in (lat, long)
+        )
+    return f"{lat!r},{long!r}"
+
+
+def normalize_time(user_time, user_timezone, open_within=None):
+    """
+    Reduce a user time to the stretch of the week during which the set of open
+    trucks stays the same. Times inside the same stretch share a cache entry.
+    With `open_within`, the eligible trucks are those open in any stretch from
+    the one of the user time to the one `open_within` minutes later.
+    """
+    if not user_time:
+        return "any"
+    import pytz
+
+    try:
+        user_datetime = (
+            pytz.timezone(user_timezone)
+            .localize(datetime.strptime(user_time, "%Y-%m-%dT%H:%M"))
+            .astimezone(pytz.utc)
+        )
+    except Exception:
+        # Invalid values are rejected later, keep them apart from valid ones
+        return f"raw_{user_time}_{user_timezone}"
+
+    moment = second_of_week(user_datetime.weekday(), user_datetime.time())
+    boundaries = get_open_hours_index().boundaries
+    if open_within is None:
+        return _stretch(boundaries, moment)
+    end = moment + open_within * 60
+    return (
+        f"{_stretch(boundaries, moment)}_{end // SECONDS_PER_WEEK}"
+        f"{_stretch(boundaries, end % SECONDS_PER_WEEK)}"
+    )
+
+
+def _stretch(boundaries, moment):
+    position = bisect_right(boundaries, moment)
+    # A stretch is identified by the boundary it starts at
+    return f"w{boundaries[position - 1] if position else 0}"
+
+
+def build_cache_key(lat, long, user_time, user_timezone, open_within=None, fields=None):
+    """
+    Build the response cache key of a validated query, `fields` being the
+    normalized projection of truck details. Keys include the dataset version,
+    so responses computed from older data are no longer served.
+    """
+    return (
+        f"food_trucks_v{get_dataset_version()}_{normalize_coordinates(lat, long)}_"
+        f"{normalize_time(user_time, user_timezone, open_within)}_"
+        f"{','.join(fields) if fields else 'all'}"
+    )
+
+
+def _envelope(value):
+    # Entries outlive their freshness by RESPONSE_CACHE_STALE_TTL seconds, during
+    # which they are still served while a single worker refreshes them
+    return {"value": value, "fresh_until": time.time() + settings.CACHE_TIMEOUT}
+
+
+def _entry_timeout():
+    return settings.CACHE_TIMEOUT + settings.RESPONSE_CACHE_STALE_TTL
+
+
+def _compute(compute):
+    """
+    Call `compute` and return (value, whether the value may be cached). Responses
+    built from offline walking time estimates are not cached, so the next
+    request tries the provider again.
+    """
+    token = serving_estimates.set(False)
+    try:
+        value = compute()
+        return value, not serving_estimates.get()
+    finally:
+        serving_estimates.reset(token)
+
+
+async def _acompute(compute):
+    token = serving_estimates.set(False)
+    try:
+        value = await compute()
+        return value, not serving_estimates.get()
+    finally:
+        serving_estimates.reset(token)
+
+
+def _lock_key(key):
+    return f"{key}_lock"
+
+
+def _compute_and_store(key, compute):
+    value, cacheable = _compute(compute)
+    if cacheable:
+        cache.set(key, _envelope(value), timeout=_entry_timeout())
+    return value
+
+
+async def _acompute_and_store(key, compute):
+    value, cacheable = await _acompute(compute)
+    if cacheable:
+        await cache.aset(key, _envelope(value), timeout=_entry_timeout())
+    return value
+
+
+def _refresh_in_background(key, compute):
+    """
+    Refresh an entry on one of the REFRESH_THREADS threads of the process,
+    unless it is already being refreshed.
+    """
+    global _refresh_executor
+
+    def refresh():
+        try:
+            _compute_and_store(key, compute)
+        except Exception:
+            logger.exception("Could not refresh the cached response %s", key)
+        finally:
+            cache.delete(_lock_key(key))
+            close_old_connections()
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=REFRESH_THREADS, thread_name_prefix="response-cache"
+            )
+    _refresh_executor.submit(refresh)
+
+
+def get_or_compute(key, compute):
+    """
+    Return the cached response for `key`, calling `compute` to build it on a miss.
+
+    Only one worker computes a given key at a time (the one that acquires its
+    lock in the shared cache), the others wait for its result. Stale entries are
+    served immediately while the lock holder refreshes them in the background.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        if entry["fresh_until"] > time.time():
+            record_hit()
+        else:
+            record_stale_hit()
+            if cache.add(
+                _lock_key(key), 1, timeout=settings.RESPONSE_CACHE_LOCK_TIMEOUT
+            ):
+                _refresh_in_background(key, compute)
+        return entry["value"]
+
+    record_miss()
+    deadline = time.monotonic() + settings.RESPONSE_CACHE_LOCK_TIMEOUT
+    while not cache.add(
+        _lock_key(key), 1, timeout=settings.RESPONSE_CACHE_LOCK_TIMEOUT
+    ):
+        # Another worker is computing the same response, wait for it
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry["value"]
+        if time.monotonic() > deadline:
+            # The lock holder died or is stuck, compute without the lock
+            return _compute_and_store(key, compute)
+
+    try:
+        return _compute_and_store(key, compute)
+    finally:
+        cache.delete(_lock_key(key))
+
+
+async def aget_or_compute(key, compute):
+    """
+    Async variant of `get_or_compute`, where `compute` is a coroutine function.
+    """
+    entry = await cache.aget(key)
+    if entry is not None:
+        if entry["fresh_until"] > time.time():
+            await _arecord(HITS_KEY)
+        else:
+            await _arecord(STALE_HITS_KEY)
+            if await cache.aadd(
+                _lock_key(key), 1, timeout=settings.RESPONSE_CACHE_LOCK_TIMEOUT
+            ):
+                task = asyncio.create_task(_arefresh(key, compute))
+                _refresh_tasks.add(task)
+                task.add_done_callback(_refresh_tasks.discard)
+        return entry["value"]
+
+    await _arecord(MISSES_KEY)
+    deadline = time.monotonic() + settings.RESPONSE_CACHE_LOCK_TIMEOUT
+    while not await cache.aadd(
+        _lock_key(key), 1, timeout=settings.RESPONSE_CACHE_LOCK_TIMEOUT
+    ):
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        entry = await cache.aget(key)
+        if entry is not None:
+            return entry["value"]
+        if time.monotonic() > deadline:
+            return await _acompute_and_store(key, compute)
+
+    try:
+        return await _acompute_and_store(key, compute)
+    finally:
+        await cache.adelete(_lock_key(key))
+
+
+async def _arefresh(key, compute):
+    try:
+        await _acompute_and_store(key, compute)
+    except Exception:
+        logger.exception("Could not refresh the cached response %s", key)
+    finally:
+        await cache.adelete(_lock_key(key))
+
+
+def _take_counts(key=None, force=False):
+    """
+    Count a hit or miss of this process, and return the counts to add to the
+    shared counters once STATS_FLUSH_INTERVAL has passed (or when `force`d),
+    None before.
+    """
+    global _last_flush
+    with _counts_lock:
+        if key is not None:
+            _counts[key] += 1
+        if not force and time.monotonic() - _last_flush < STATS_FLUSH_INTERVAL:
+            return None
+        _last_flush = time.monotonic()
+        counts = dict(_counts)
+        for name in _counts:
+            _counts[name] = 0
+    return counts
+
+
+def _flush(counts):
+    for key, count in counts.items():
+        if not count:
+            continue
+        # `incr` fails on missing keys, `add` only creates the counter once
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            # The counter was evicted in between
+            cache.set(key, count, timeout=None)
+
+
+def _record(key):
+    counts = _take_counts(key)
+    if counts:
+        _flush(counts)
+
+
+async def _arecord(key):
+    counts = _take_counts(key)
+    if counts:
+        await sync_to_async(_flush)(counts)
+
+
+def record_hit():
+    _record(HITS_KEY)
+
+
+def record_stale_hit():
+    _record(STALE_HITS_KEY)
+
+
+def record_miss():
+    _record(MISSES_KEY)
+
+
+def flush_stats():
+    """
+    Add the hit/miss counts of this process to the shared counters now.
+    """
+    _flush(_take_counts(force=True))
+
+
+def get_stats():
+    """
+    Hit/miss counters of the response cache along with its current settings,
+    used to tune the coordinate precision. Other processes add their counts
+    every STATS_FLUSH_INTERVAL seconds.
+    """
+    flush_stats()
+    hits = cache.get(HITS_KEY, 0)
+    stale_hits = cache.get(STALE_HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + stale_hits + misses
+    mode = settings.RESPONSE_CACHE_COORDINATE_MODE
+    return {
+        "hits": hits,
+        "stale_hits": stale_hits,
+        "misses": misses,
+        "hit_rate": (hits + stale_hits) / total if total else None,
+        "coordinate_mode": mode,
+        "precision": {
+            "grid": settings.RESPONSE_CACHE_GRID_DECIMALS,
+            "geohash": settings.RESPONSE_CACHE_GEOHASH_PRECISION,
+        }.get(mode),
+    }
+
+
+def reset_stats():
+    _take_counts(force=True)
+    cache.delete_many([HITS_KEY, STALE_HITS_KEY, MISSES_KEY])
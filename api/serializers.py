@@ -1,8 +1,148 @@
+import json
+import threading
+from collections import OrderedDict
+from django.conf import settings
 from rest_framework import serializers
+from .dataset_version import get_dataset_version
 from .models import FoodTruck
+from .truck_snapshot import get_truck_snapshot
 
 
 class FoodTruckSerializer(serializers.ModelSerializer):
     class Meta:
         model = FoodTruck
-        fields = "__all__"
+        # The availability bitmap is an internal representation of `days_hours`
+        exclude = ["open_hours_bitmap"]
+
+
+class TruckFragmentCache:
+    """
+    Fast serialization path for truck details.
+
+    Trucks are read with `.values()` restricted to the requested fields and
+    converted by the DRF fields of `FoodTruckSerializer`, instantiated once, so
+    the output is the same as the serializer's. Each truck is then rendered to
+    a JSON fragment, kept in memory until the dataset version changes.
+
+    When a truck snapshot is available, fragments are assembled from the values
+    it holds already encoded, without querying the database or caching them.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._serializer_fields = FoodTruckSerializer().fields
+        self._fragments = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def field_names(self):
+        return list(self._serializer_fields)
+
+    def normalize_fields(self, fields):
+        """
+        Validate the requested field names and return them in response order,
+        or None for every field. Raises ValueError on unknown names.
+        """
+        if not fields:
+            return None
+        requested = set(fields)
+        unknown = requested - set(self._serializer_fields)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}.")
+        return tuple(name for name in self._serializer_fields if name in requested)
+
+    def get_many(self, truck_ids, fields=None):
+        """
+        Return {truck_id: JSON fragment} for the given trucks, restricted to
+        `fields` (normalized, see `normalize_fields`) when given.
+        """
+        fields = fields or tuple(self._serializer_fields)
+        snapshot = get_truck_snapshot()
+        if snapshot is not None and snapshot.has_fields(fields):
+            fragments = snapshot.fragments(truck_ids, fields)
+            missing = [truck_id for truck_id in truck_ids if truck_id not in fragments]
+            if missing:
+                fragments.update(self.render(missing, fields))
+            return fragments
+
+        version = get_dataset_version()
+        with self._lock:
+            if version != self._version:
+                self._fragments.clear()
+                self._version = version
+            fragments = {}
+            for truck_id in truck_ids:
+                fragment = self._fragments.get((truck_id, fields))
+                if fragment is not None:
+                    self._fragments.move_to_end((truck_id, fields))
+                    fragments[truck_id] = fragment
+
+        missing = [truck_id for truck_id in truck_ids if truck_id not in fragments]
+        if missing:
+            rendered = self.render(missing, fields)
+            with self._lock:
+                if version == self._version:
+                    for truck_id, fragment in rendered.items():
+                        self._fragments[(truck_id, fields)] = fragment
+                    while len(self._fragments) > self.max_entries:
+                        self._fragments.popitem(last=False)
+            fragments.update(rendered)
+        return fragments
+
+    def render(self, truck_ids, fields):
+        """
+        Render trucks to JSON fragments with a single query, without the cache.
+        """
+        serializer_fields = [(name, self._serializer_fields[name]) for name in fields]
+        rows = FoodTruck.objects.filter(pk__in=truck_ids).values(
+            "id", *(name for name in fields if name != "id")
+        )
+        return {
+            row["id"]: json.dumps(
+                {
+                    name: (
+                        None
+                        if row[name] is None
+                        else field.to_representation(row[name])
+                    )
+                    for name, field in serializer_fields
+                },
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+            for row in rows
+        }
+
+    def encode_value(self, name, value):
+        """
+        JSON encoding of a value of field `name`, as it appears in fragments.
+        """
+        return json.dumps(
+            (
+                None
+                if value is None
+                else self._serializer_fields[name].to_representation(value)
+            ),
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+    def discard(self, truck_ids):
+        """
+        Drop the fragments of the given trucks, whatever their fields.
+        """
+        truck_ids = set(truck_ids)
+        with self._lock:
+            for key in [key for key in self._fragments if key[0] in truck_ids]:
+                del self._fragments[key]
+
+    def clear(self, **kwargs):
+        """
+        Drop every fragment. Also usable as a signal receiver.
+        """
+        with self._lock:
+            self._fragments.clear()
+
+
+truck_fragments = TruckFragmentCache(settings.TRUCK_FRAGMENT_CACHE_MAX_ENTRIES)
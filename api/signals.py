@@ -0,0 +1,130 @@
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .answer_grid import discard_answer_grids, refresh_answer_grid
+from .models import FoodTruck, FoodTruckOperatingHour
+from .open_hours import invalidate_open_hours_index, refresh_open_hours_bitmap
+from .profiling import count_queries
+from .serializers import truck_fragments
+from .spatial_index import invalidate_truck_index
+from .truck_snapshot import discard_truck_snapshot, refresh_truck_snapshot
+
+# Set while `bulk_changes` is active
+_bulk_changes = ContextVar("bulk_changes", default=False)
+
+# Orders the single-row changes and the refreshes they schedule. Per thread,
+# the step at which the snapshot and the grid were last rewritten
+_steps = itertools.count()
+_refreshed = threading.local()
+
+
+@contextmanager
+def bulk_changes():
+    """
+    Turn the truck and operating hours receivers off while the block rewrites
+    the tables in bulk, where they would run once per row, and drop the
+    derived structures once when the block succeeds (once its transaction is
+    committed). The block must refresh the stored bitmaps of the trucks whose
+    operating hours it rewrites, see `refresh_open_hours_bitmaps`.
+    """
+    token = _bulk_changes.set(True)
+    try:
+        yield
+    finally:
+        _bulk_changes.reset(token)
+    transaction.on_commit(discard_derived_structures)
+
+
+def discard_derived_structures():
+    invalidate_truck_index()
+    invalidate_open_hours_index()
+    truck_fragments.clear()
+    discard_answer_grids()
+    discard_truck_snapshot()
+
+
+def refresh_derived_structures(truck_id, moved):
+    """
+    Patch the derived structures after a single truck, or its operating hours,
+    changed in place (e.g. from the admin). The in-memory indexes of this
+    process and the truck's fragments are dropped. Once the change is
+    committed, the truck snapshot is rewritten, and so is the answer grid when
+    the truck was added, `moved` or deleted: other workers swap them in rather
+    than falling back to the database.
+    """
+    invalidate_truck_index()
+    invalidate_open_hours_index()
+    truck_fragments.discard([truck_id])
+    scheduled = next(_steps)
+
+    def refresh():
+        # Callbacks run after the commit, so a rewrite this thread started
+        # since the change was made includes it: the changes of a transaction
+        # share a single rewrite
+        if getattr(_refreshed, "snapshot", -1) < scheduled:
+            _refreshed.snapshot = next(_steps)
+            refresh_truck_snapshot()
+        if moved and getattr(_refreshed, "grid", -1) < scheduled:
+            _refreshed.grid = next(_steps)
+            refresh_answer_grid()
+
+    transaction.on_commit(refresh)
+
+
+@receiver(pre_save, sender=FoodTruck)
+def remember_food_truck_location(sender, instance, **kwargs):
+    """
+    Remember where a truck was before it is saved, to tell whether it moved.
+    """
+    if instance.pk is not None and not _bulk_changes.get():
+        instance._saved_location = (
+            FoodTruck.objects.filter(pk=instance.pk)
+            .values_list("latitude", "longitude")
+            .first()
+        )
+
+
+@receiver(post_save, sender=FoodTruck)
+def food_truck_saved(sender, instance, created, **kwargs):
+    """
+    Keep the derived structures in sync with the FoodTruck table.
+    """
+    if _bulk_changes.get():
+        return
+    moved = created or getattr(instance, "_saved_location", None) != (
+        instance.latitude,
+        instance.longitude,
+    )
+    refresh_derived_structures(instance.pk, moved)
+
+
+@receiver(post_delete, sender=FoodTruck)
+def food_truck_deleted(sender, instance, **kwargs):
+    if not _bulk_changes.get():
+        refresh_derived_structures(instance.pk, moved=True)
+
+
+@receiver(post_save, sender=FoodTruckOperatingHour)
+@receiver(post_delete, sender=FoodTruckOperatingHour)
+def food_truck_operating_hour_changed(sender, instance, **kwargs):
+    """
+    Keep the truck's availability bitmap, and the structures built from it, in
+    sync with the operating hours table.
+    """
+    if _bulk_changes.get():
+        return
+    refresh_open_hours_bitmap(instance.food_truck_id)
+    refresh_derived_structures(instance.food_truck_id, moved=False)
+
+
+@receiver(connection_created)
+def profile_queries(sender, connection, **kwargs):
+    """
+    Count the queries of every database connection in the request profile.
+    """
+    connection.execute_wrappers.append(count_queries)
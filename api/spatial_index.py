@@ -0,0 +1,259 @@
+import heapq
+import math
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from .models import FoodTruck
+from .dataset_version import get_dataset_version
+from .process_cache import ProcessWideCache
+from .truck_snapshot import get_truck_snapshot
+from .ranking import (
+    AMBIGUITY_RATIO,
+    EARTH_RADIUS_METERS,
+    HaversineRanker,
+    rerank_by_geodesic,
+)
+
+
+def to_unit_vector(lat, long):
+    """
+    Convert a latitude/longitude pair into a point on the unit sphere.
+    The euclidean (chord) distance between two such points grows monotonically
+    with their great-circle distance, so a plain k-d tree can be used on them.
+    """
+    lat_rad = math.radians(lat)
+    long_rad = math.radians(long)
+    cos_lat = math.cos(lat_rad)
+    return (
+        cos_lat * math.cos(long_rad),
+        cos_lat * math.sin(long_rad),
+        math.sin(lat_rad),
+    )
+
+
+class TruckSpatialIndex:
+    """
+    In-memory k-d tree of food truck coordinates used to answer
+    k-nearest-neighbour queries without scanning the whole table.
+    """
+
+    def __init__(self, points):
+        # points: iterable of (truck_id, latitude, longitude)
+        self.ids = []
+        self.coordinates = []
+        self.vectors = []
+        for truck_id, lat, long in points:
+            self.ids.append(truck_id)
+            self.coordinates.append((float(lat), float(long)))
+            self.vectors.append(to_unit_vector(float(lat), float(long)))
+        self.root = self._build(list(range(len(self.ids))), 0)
+        # Same coordinates as contiguous arrays, for vectorized filtered queries
+        self.ranker = HaversineRanker(
+            self.ids,
+            [lat for lat, _ in self.coordinates],
+            [long for _, long in self.coordinates],
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_database(cls):
+        """
+        Build the index from the current content of the FoodTruck table.
+        """
+        return cls(FoodTruck.objects.values_list("id", "latitude", "longitude"))
+
+    def _build(self, indexes, depth):
+        # Nodes are (point index, split axis, left subtree, right subtree)
+        if not indexes:
+            return None
+        axis = depth % 3
+        indexes.sort(key=lambda i: self.vectors[i][axis])
+        median = len(indexes) // 2
+        return (
+            indexes[median],
+            axis,
+            self._build(indexes[:median], depth + 1),
+            self._build(indexes[median + 1 :], depth + 1),
+        )
+
+    def _search_nearest(self, target, k):
+        # Max-heap (negated squared distances) holding the k best points so far
+        best = []
+
+        def visit(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            point = self.vectors[index]
+            squared = (
+                (point[0] - target[0]) ** 2
+                + (point[1] - target[1]) ** 2
+                + (point[2] - target[2]) ** 2
+            )
+            if len(best) < k:
+                heapq.heappush(best, (-squared, index))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, index))
+            delta = target[axis] - point[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            visit(near)
+            # Only descend the far side if the splitting plane is closer
+            # than the current k-th best candidate
+            if len(best) < k or delta * delta < -best[0][0]:
+                visit(far)
+
+        visit(self.root)
+        return best
+
+    def _search_radius(self, target, radius):
+        squared_radius = radius * radius
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            index, axis, left, right = node
+            point = self.vectors[index]
+            squared = (
+                (point[0] - target[0]) ** 2
+                + (point[1] - target[1]) ** 2
+                + (point[2] - target[2]) ** 2
+            )
+            if squared <= squared_radius:
+                found.append(index)
+            delta = target[axis] - point[axis]
+            if delta < 0 or delta * delta <= squared_radius:
+                stack.append(left)
+            if delta >= 0 or delta * delta <= squared_radius:
+                stack.append(right)
+        return found
+
+    def mask_for(self, allowed_ids):
+        """
+        Boolean mask of the given trucks, in index order, for `nearest`.
+        Worth computing once when many queries share the same eligible trucks.
+        """
+        return np.isin(self.ranker.ids, list(allowed_ids))
+
+    def nearest(self, lat, long, k=10, allowed_ids=None, exact=True, mask=None):
+        """
+        Return the `k` nearest trucks to (lat, long) as (truck_id, meters) tuples.
+        When `allowed_ids` (or its `mask_for` mask) is given only these trucks
+        are considered. With `exact` the order matches a full scan by geodesic
+        distance.
+        """
+        if k <= 0 or not self.ids:
+            return []
+
+        if allowed_ids is not None:
+            mask = self.mask_for(allowed_ids)
+        if mask is not None:
+            # Filtered queries prune badly in the tree, a single vectorized
+            # pass over the eligible trucks is cheaper
+            return [
+                (self.ids[position], meters)
+                for position, meters in self.ranker.top_k(
+                    lat, long, k=k, mask=mask, exact=exact
+                )
+            ]
+
+        target = to_unit_vector(lat, long)
+        best = self._search_nearest(target, k)
+        if not best:
+            return []
+
+        # Widen the search around the k-th chord distance so that the exact
+        # geodesic ordering below cannot miss a truck the sphere ranked later
+        kth_chord = math.sqrt(max(-squared for squared, _ in best))
+        radius = kth_chord * AMBIGUITY_RATIO if exact else kth_chord
+        candidates = self._search_radius(target, radius + 1e-12)
+        # Ties (trucks sharing a location) keep the table order, as a full scan would
+        ranked = sorted((self._great_circle_meters(target, i), i) for i in candidates)
+        if exact:
+            ranked = rerank_by_geodesic(lat, long, ranked, self.coordinates, k)
+        return [(self.ids[i], meters) for meters, i in ranked[:k]]
+
+    def _great_circle_meters(self, target, index):
+        point = self.vectors[index]
+        chord = math.sqrt(
+            (point[0] - target[0]) ** 2
+            + (point[1] - target[1]) ** 2
+            + (point[2] - target[2]) ** 2
+        )
+        return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, chord / 2))
+
+
+def nearest_from_database(lat, long, k=10, allowed_ids=None, exact=True):
+    """
+    Same answer as `TruckSpatialIndex.nearest`, straight from the database.
+
+    Only the trucks of a bounding box around the point are fetched, through the
+    coordinates index. The box starts NEAREST_TRUCKS_START_RADIUS_METERS wide and
+    doubles until its inscribed circle holds the k-th nearest eligible truck
+    (with the geodesic ambiguity margin), past which no other truck can rank.
+    """
+    if k <= 0:
+        return []
+    allowed = None if allowed_ids is None else np.asarray(list(allowed_ids))
+    radius = settings.NEAREST_TRUCKS_START_RADIUS_METERS
+    while True:
+        # Degrees spanned by the radius, longitude degrees being the shortest
+        # at the box edge farthest from the equator
+        lat_delta = math.degrees(radius / EARTH_RADIUS_METERS)
+        widest_lat = min(abs(lat) + lat_delta, 89.9)
+        long_delta = lat_delta / math.cos(math.radians(widest_lat))
+        covers_everything = lat_delta >= 180 or long_delta >= 180
+        trucks = FoodTruck.objects.order_by("id")
+        if not covers_everything:
+            trucks = trucks.filter(
+                latitude__range=(lat - lat_delta, lat + lat_delta),
+                longitude__range=(long - long_delta, long + long_delta),
+            )
+        rows = list(trucks.values_list("id", "latitude", "longitude"))
+        if rows:
+            ranker = HaversineRanker(*zip(*rows))
+            mask = None if allowed is None else np.isin(ranker.ids, allowed)
+            ranked = ranker.top_k(lat, long, k=k, mask=mask, exact=exact)
+            if covers_everything:
+                return [(int(ranker.ids[p]), meters) for p, meters in ranked]
+            if len(ranked) == k:
+                kth = float(ranker.distances(lat, long)[[p for p, _ in ranked]].max())
+                if (kth * AMBIGUITY_RATIO if exact else kth) <= radius:
+                    return [(int(ranker.ids[p]), meters) for p, meters in ranked]
+        elif covers_everything:
+            return []
+        radius *= 2
+
+
+def _table_fingerprint():
+    # Cheap summary of the truck table, used to notice changes made by other
+    # processes (e.g. `load_food_trucks`) that this process got no signal for.
+    # The dataset version also covers in-place updates made by a sync
+    return (get_dataset_version(),) + tuple(
+        FoodTruck.objects.aggregate(count=Count("id"), max_id=Max("id")).values()
+    )
+
+
+_truck_index = ProcessWideCache(TruckSpatialIndex.from_database, _table_fingerprint)
+
+
+def get_truck_index():
+    """
+    Return the truck snapshot when one is available, it answers the same
+    queries. Otherwise return the process-wide truck index, building it on
+    first use and rebuilding it whenever the truck table has changed.
+    """
+    snapshot = get_truck_snapshot()
+    if snapshot is not None:
+        return snapshot
+    return _truck_index.get()
+
+
+def invalidate_truck_index(**kwargs):
+    """
+    Drop the process-wide truck index so the next query rebuilds it.
+    """
+    _truck_index.invalidate()
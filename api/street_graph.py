@@ -0,0 +1,255 @@
+import heapq
+import math
+import os
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from django.conf import settings
+from .process_cache import ProcessWideCache
+from .ranking import EARTH_RADIUS_METERS
+
+# Ways pedestrians cannot use. Every other `highway` is walkable, in both
+# directions, unless tagged `foot=no`.
+NON_WALKABLE_HIGHWAYS = {
+    "motorway",
+    "motorway_link",
+    "construction",
+    "proposed",
+    "raceway",
+    "bus_guideway",
+}
+# Side of the grid buckets used to snap coordinates to the nearest node
+SNAP_CELL_DEGREES = 0.002
+
+
+def haversine_meters(lat, long, lats, longs):
+    """
+    Great-circle distance in meters from a point to one or many points.
+    """
+    lat, long, lats, longs = map(np.radians, (lat, long, lats, longs))
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((longs - long) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+class StreetGraph:
+    """
+    Walkable street network as an undirected graph in compressed sparse row
+    form: the neighbours of node i are indices[indptr[i]:indptr[i + 1]], at
+    lengths[...] meters.
+    """
+
+    def __init__(self, lats, longs, indptr, indices, lengths):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.longs = np.asarray(longs, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        # Python lists are much faster than arrays in the search loop
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._lengths = self.lengths.tolist()
+
+        self._buckets = {}
+        for node, key in enumerate(
+            zip(
+                np.floor(self.lats / SNAP_CELL_DEGREES).astype(int).tolist(),
+                np.floor(self.longs / SNAP_CELL_DEGREES).astype(int).tolist(),
+            )
+        ):
+            self._buckets.setdefault(key, []).append(node)
+
+    def __len__(self):
+        return len(self.lats)
+
+    @classmethod
+    def from_edges(cls, coordinates, edges):
+        """
+        Build a graph from node coordinates [(lat, long)] and (node, node)
+        edges, their lengths being the great-circle distances.
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        lats, longs = coordinates[:, 0], coordinates[:, 1]
+        lengths = haversine_meters(
+            lats[edges[:, 0]], longs[edges[:, 0]], lats[edges[:, 1]], longs[edges[:, 1]]
+        )
+
+        # Both directions, sorted by source node
+        sources = np.concatenate([edges[:, 0], edges[:, 1]])
+        targets = np.concatenate([edges[:, 1], edges[:, 0]])
+        lengths = np.concatenate([lengths, lengths])
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(lats) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(lats)), out=indptr[1:])
+        return cls(lats, longs, indptr, targets[order], lengths[order])
+
+    @classmethod
+    def from_osm(cls, file_path):
+        """
+        Build the walkable graph of an OpenStreetMap XML extract (.osm).
+        Only the nodes used by walkable ways are kept.
+        """
+        node_coordinates = {}
+        ways = []
+        for _, element in ElementTree.iterparse(file_path, events=("end",)):
+            if element.tag == "node":
+                node_coordinates[element.get("id")] = (
+                    float(element.get("lat")),
+                    float(element.get("lon")),
+                )
+            elif element.tag == "way":
+                tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+                highway = tags.get("highway")
+                if (
+                    highway
+                    and highway not in NON_WALKABLE_HIGHWAYS
+                    and tags.get("foot") != "no"
+                ):
+                    ways.append([node.get("ref") for node in element.iter("nd")])
+            if element.tag in ("node", "way", "relation"):
+                element.clear()
+
+        positions = {}
+        coordinates = []
+        edges = []
+        for refs in ways:
+            refs = [ref for ref in refs if ref in node_coordinates]
+            for ref in refs:
+                if ref not in positions:
+                    positions[ref] = len(coordinates)
+                    coordinates.append(node_coordinates[ref])
+            edges.extend(
+                (positions[a], positions[b]) for a, b in zip(refs, refs[1:]) if a != b
+            )
+        return cls.from_edges(coordinates, edges)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(
+                data["lats"],
+                data["longs"],
+                data["indptr"],
+                data["indices"],
+                data["lengths"],
+            )
+
+    def save(self, file_path):
+        # np.savez appends .npz to other names, write through a file object
+        with open(file_path, "wb") as file:
+            np.savez_compressed(
+                file,
+                lats=self.lats,
+                longs=self.longs,
+                indptr=self.indptr,
+                indices=self.indices,
+                lengths=self.lengths,
+            )
+
+    def nearest_node(self, lat, long):
+        """
+        Return (node, meters) for the node closest to the coordinate, looking
+        in growing rings of grid buckets around it.
+        """
+        row = math.floor(lat / SNAP_CELL_DEGREES)
+        column = math.floor(long / SNAP_CELL_DEGREES)
+        best = None
+        for ring in range(0, 64):
+            nodes = [
+                node
+                for d_row in range(-ring, ring + 1)
+                for d_column in range(-ring, ring + 1)
+                if max(abs(d_row), abs(d_column)) == ring
+                for node in self._buckets.get((row + d_row, column + d_column), ())
+            ]
+            if nodes:
+                meters = haversine_meters(
+                    lat, long, self.lats[nodes], self.longs[nodes]
+                )
+                position = int(np.argmin(meters))
+                if best is None or meters[position] < best[1]:
+                    best = (nodes[position], float(meters[position]))
+            # Nodes of the next ring are at least `ring` buckets away
+            if best is not None and best[1] < ring * SNAP_CELL_DEGREES * 55_000:
+                return best
+        return best
+
+    def shortest_distances(self, source, targets, max_meters=math.inf):
+        """
+        Dijkstra from `source`, stopping as soon as every target is settled or
+        paths get longer than `max_meters`. Returns {target: meters} for the
+        reached targets.
+        """
+        remaining = set(targets)
+        found = {}
+        distances = {source: 0.0}
+        heap = [(0.0, source)]
+        indptr, indices, lengths = self._indptr, self._indices, self._lengths
+        while heap and remaining:
+            meters, node = heapq.heappop(heap)
+            if meters > distances[node]:
+                continue
+            if meters > max_meters:
+                break
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = meters
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                candidate = meters + lengths[edge]
+                if candidate < distances.get(neighbour, math.inf):
+                    distances[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+        return found
+
+    def walking_meters(self, lat, long, destinations, max_detour=4.0):
+        """
+        Walking distance in meters from the origin to each (lat, long)
+        destination: to the nearest node, along the streets, then to the
+        destination. None for destinations without a path shorter than
+        `max_detour` times the straight-line distance.
+        """
+        origin, origin_meters = self.nearest_node(lat, long)
+        snapped = [self.nearest_node(*destination) for destination in destinations]
+        straight = haversine_meters(
+            lat,
+            long,
+            [destination[0] for destination in destinations],
+            [destination[1] for destination in destinations],
+        )
+        reached = self.shortest_distances(
+            origin,
+            {node for node, _ in snapped},
+            max_meters=max_detour * float(np.max(straight, initial=0.0)) + 500,
+        )
+        return [
+            (origin_meters + reached[node] + node_meters if node in reached else None)
+            for node, node_meters in snapped
+        ]
+
+
+def _load_street_graph():
+    # False rather than None when no graph was imported, so that it is not
+    # looked for again on every request
+    path = settings.STREET_GRAPH_PATH
+    return StreetGraph.load(path) if os.path.exists(path) else False
+
+
+def _street_graph_fingerprint():
+    path = settings.STREET_GRAPH_PATH
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+_street_graph = ProcessWideCache(_load_street_graph, _street_graph_fingerprint)
+
+
+def get_street_graph():
+    """
+    Return the process-wide street graph, or None when no graph was imported
+    (see the `import_street_graph` command).
+    """
+    graph = _street_graph.get()
+    # An empty graph is falsy too
+    return None if graph is False else graph
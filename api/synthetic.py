@@ -0,0 +1,292 @@
+import csv
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from django.db import connection
+from django.test import override_settings
+from .truck_snapshot import invalidate_truck_snapshot
+from .walking_time import StubWalkingTimeProvider
+
+# San Francisco bounds, synthetic trucks are drawn inside them
+SF_BOUNDS = ((37.70, 37.81), (-122.52, -122.36))
+
+CSV_COLUMNS = [
+    "locationid",
+    "Applicant",
+    "FacilityType",
+    "cnn",
+    "LocationDescription",
+    "Address",
+    "blocklot",
+    "block",
+    "lot",
+    "permit",
+    "Status",
+    "FoodItems",
+    "X",
+    "Y",
+    "Latitude",
+    "Longitude",
+    "Schedule",
+    "dayshours",
+    "NOISent",
+    "Approved",
+    "Received",
+    "PriorPermit",
+    "ExpirationDate",
+    "Location",
+    "Fire Prevention Districts",
+    "Police Districts",
+    "Supervisor Districts",
+    "Zip Codes",
+    "Neighborhoods (old)",
+]
+
+# Operating hours patterns as found in the city feed
+DAYS_HOURS = [
+    "Mo-Fr:10AM-3PM",
+    "Mo-Su:7AM-6PM",
+    "Mo-Fr:7AM-8AM/10AM-11AM/12PM-1PM",
+    "Su/We/Sa:11AM-3PM",
+    "Tu/Sa:8AM-3PM;Mo/Tu/We/Th/Fr:10AM-2PM",
+    "Sa-Su:10AM-6PM;Mo-Fr:10AM-10PM",
+    "Su:12PM-8PM;Fr:3PM-8PM;Sa:4PM-8PM",
+    "Mo-Fr:11AM-12PM",
+]
+
+
+def synthetic_truck_rows(count, seed=0, hours_density=0.5):
+    """
+    Generate `count` CSV rows shaped like the city food truck feed, located in
+    San Francisco. `hours_density` is the share of trucks with operating hours.
+    """
+    rng = random.Random(seed)
+    (min_lat, max_lat), (min_long, max_long) = SF_BOUNDS
+    for i in range(count):
+        lat = rng.uniform(min_lat, max_lat)
+        long = rng.uniform(min_long, max_long)
+        yield {
+            "locationid": str(1_000_000 + i),
+            "Applicant": f"Synthetic Truck {i}",
+            "FacilityType": rng.choice(["Truck", "Push Cart"]),
+            "cnn": str(rng.randint(100000, 9999999)),
+            "LocationDescription": f"SYNTHETIC ST: {i} to {i + 1}",
+            "Address": f"{rng.randint(1, 3000)} SYNTHETIC ST",
+            "blocklot": "3595031",
+            "block": "3595",
+            "lot": "031",
+            "permit": f"23MFF-{i:05d}",
+            "Status": rng.choice(["APPROVED", "REQUESTED", "EXPIRED"]),
+            "FoodItems": "Hot dogs: burritos: coffee",
+            "X": f"{rng.uniform(5.98e6, 6.02e6):.3f}",
+            "Y": f"{rng.uniform(2.08e6, 2.13e6):.3f}",
+            "Latitude": repr(lat),
+            "Longitude": repr(long),
+            "Schedule": "http://example.com/schedule.pdf",
+            "dayshours": rng.choice(DAYS_HOURS) if rng.random() < hours_density else "",
+            "NOISent": "",
+            "Approved": "09/20/2023 12:00:00 AM",
+            "Received": "20230920",
+            "PriorPermit": str(rng.randint(0, 1)),
+            "ExpirationDate": "11/15/2024 12:00:00 AM",
+            "Location": f"({lat}, {long})",
+            "Fire Prevention Districts": str(rng.randint(1, 15)),
+            "Police Districts": str(rng.randint(1, 10)),
+            "Supervisor Districts": str(rng.randint(1, 11)),
+            "Zip Codes": str(rng.randint(28000, 29500)),
+            "Neighborhoods (old)": str(rng.randint(1, 41)),
+        }
+
+
+def write_synthetic_csv(file_path, count, seed=0, hours_density=0.5):
+    """
+    Write a synthetic food truck CSV with `count` rows to `file_path`.
+    """
+    with open(file_path, mode="w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        writer.writerows(synthetic_truck_rows(count, seed, hours_density))
+
+
+@contextmanager
+def temporary_database(file_path=None):
+    """
+    Run the enclosed block against a freshly migrated throwaway database,
+    stored at `file_path` (in memory by default), so benchmarks never touch
+    the real data. The truck snapshot is written next to it, or disabled.
+    """
+    connection.settings_dict["TEST"]["NAME"] = file_path
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False
+    )
+    invalidate_truck_snapshot()
+    try:
+        with override_settings(
+            TRUCK_SNAPSHOT_ENABLED=bool(file_path),
+            TRUCK_SNAPSHOT_PATH=f"{file_path}.snapshot",
+        ):
+            yield
+    finally:
+        invalidate_truck_snapshot()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+class FakeDistanceMatrixClient:
+    """
+    Stand-in for `googlemaps.Client` simulating the latency of the Distance Matrix
+    API: a fixed round trip plus a small cost per element. Like the requests
+    session used by googlemaps, it holds a bounded pool of connections.
+    """
+
+    def __init__(self, round_trip_ms, element_ms, connections):
+        self.round_trip = round_trip_ms / 1000
+        self.per_element = element_ms / 1000
+        self.connections = threading.Semaphore(connections)
+        self.estimator = StubWalkingTimeProvider()
+        self.calls = 0
+        self.elements = 0
+        self.lock = threading.Lock()
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        # Like googlemaps, a single origin or destination needs no list
+        if not isinstance(origins, list):
+            origins = [origins]
+        if not isinstance(destinations, list):
+            destinations = [destinations]
+        elements = len(origins) * len(destinations)
+        with self.lock:
+            self.calls += 1
+            self.elements += elements
+        with self.connections:
+            time.sleep(self.round_trip + self.per_element * elements)
+        return {
+            "status": "OK",
+            "rows": [
+                {"elements": self.estimator.get_elements(*origin, destinations)}
+                for origin in origins
+            ],
+        }
+
+
+class FakeGoogleMapsServer:
+    """
+    Local HTTP server answering Distance Matrix requests with straight-line
+    estimates, to exercise the real client (pooling, rate limiting, hedging,
+    circuit breaker) offline. Point GOOGLE_MAPS_BASE_URL at `url`.
+
+    Each request waits `latency_ms`, or `slow_ms` for a `slow_rate` share of
+    them. An `error_rate` share of the requests fails with an HTTP 500, and
+    `status` other than "OK" is returned as the top-level status of every
+    response. The attributes can be changed while the server runs.
+    """
+
+    def __init__(
+        self,
+        port=0,
+        latency_ms=0,
+        slow_ms=0,
+        slow_rate=0.0,
+        error_rate=0.0,
+        status="OK",
+        seed=None,
+    ):
+        self.latency_ms = latency_ms
+        self.slow_ms = slow_ms
+        self.slow_rate = slow_rate
+        self.error_rate = error_rate
+        self.status = status
+        self.requests = 0
+        self.errors = 0
+        self.estimator = StubWalkingTimeProvider()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, query):
+        """
+        Return the (HTTP status, body) of a request with the given parameters.
+        """
+        with self._lock:
+            self.requests += 1
+            slow = self._random.random() < self.slow_rate
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep((self.slow_ms if slow else self.latency_ms) / 1000)
+        if failed:
+            return 500, {"status": "UNKNOWN_ERROR"}
+        if self.status != "OK":
+            return 200, {"status": self.status, "rows": []}
+
+        def points(value):
+            return [
+                tuple(float(part) for part in point.split(","))
+                for point in value.split("|")
+            ]
+
+        destinations = points(query["destinations"][0])
+        return 200, {
+            "status": "OK",
+            "origin_addresses": [],
+            "destination_addresses": [],
+            "rows": [
+                {"elements": self.estimator.get_elements(*origin, destinations)}
+                for origin in points(query["origins"][0])
+            ],
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so that the client's connection pooling shows
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written apart, don't wait for delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path != "/maps/api/distancematrix/json":
+                    self.send_error(404)
+                    return
+                status, body = server.respond(parse_qs(url.query))
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
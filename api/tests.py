@@ -1,3 +1,1128 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta
+from datetime import timezone as dt_timezone
+from unittest import mock
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+import numpy as np
+from rich.console import Console
+from .answer_grid import AnswerGrid, build_answer_grid, get_answer_grid
+from .coalescer import plan_calls
+from .csv_parsing import map_row, parse_chunk, set_feed_timezone
+from .google_client import CircuitBreaker, ResilientDistanceMatrixClient
+from .importer import bulk_import, sync_import
+from .management.commands import list_food_trucks
+from . import response_cache
+from .models import FoodTruck, FoodTruckOperatingHour, WalkingTimeCacheEntry
+from .open_hours import OpenHoursIndex
+from .serializers import FoodTruckSerializer, truck_fragments
+from .ranking import HaversineRanker, geodesic_meters
+from .spatial_index import TruckSpatialIndex, nearest_from_database
+from . import street_graph
+from .street_graph import StreetGraph, get_street_graph
+from .synthetic import (
+    CSV_COLUMNS,
+    SF_BOUNDS,
+    FakeGoogleMapsServer,
+    synthetic_truck_rows,
+)
+from .truck_snapshot import (
+    get_truck_snapshot,
+    invalidate_truck_snapshot,
+    write_truck_snapshot,
+)
+from .utils import (
+    AdaptiveWalkingSearch,
+    estimate_walking_elements,
+    rank_trucks_by_walking_time,
+)
+from . import walking_time
+from .walking_time import (
+    GoogleDistanceMatrixProvider,
+    WalkingTimeCache,
+    serving_estimates,
+    walking_element,
+    walking_time_cache,
+)
+from .week_bitmap import SLOTS_PER_DAY, decode_week_bitmap, encode_week_bitmap
 
-# Create your tests here.
+
+def write_rows(file_path, rows):
+    with open(file_path, mode="w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# A Monday at 11:00 UTC
+MONDAY_MORNING = datetime(2024, 1, 1, 11, tzinfo=dt_timezone.utc)
+
+
+def load_synthetic_trucks(count, **kwargs):
+    """
+    Import `count` synthetic trucks, with their operating hours, through a CSV.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "trucks.csv")
+        write_rows(csv_path, synthetic_truck_rows(count, **kwargs))
+        return bulk_import(csv_path)
+
+
+# Keep the tests away from the snapshot of the development database
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+class SyncImportTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.csv_path = os.path.join(directory.name, "trucks.csv")
+        self.rows = list(synthetic_truck_rows(3, hours_density=1))
+        self.rows[0]["dayshours"] = "Mo-Fr:10AM-3PM"
+
+    def sync(self):
+        write_rows(self.csv_path, self.rows)
+        return sync_import(self.csv_path)
+
+    def stored_hours(self, truck):
+        return FoodTruckOperatingHour.objects.filter(food_truck=truck).values_list(
+            "day", "open_time", "close_time"
+        )
+
+    def test_changed_hours_rebuild_the_bitmap(self):
+        self.sync()
+        self.rows[0]["dayshours"] = "Mo-Su:12AM-11PM"
+        stats = self.sync()
+
+        self.assertEqual(stats.hours_changed, 1)
+        truck = FoodTruck.objects.get(location_id=self.rows[0]["locationid"])
+        hours = self.stored_hours(truck)
+        self.assertEqual(len(hours), 7)
+        self.assertIsNotNone(truck.open_hours_bitmap)
+        self.assertEqual(bytes(truck.open_hours_bitmap), encode_week_bitmap(hours))
+
+    def test_cleared_hours_clear_the_bitmap(self):
+        self.sync()
+        self.rows[0]["dayshours"] = ""
+        self.sync()
+
+        truck = FoodTruck.objects.get(location_id=self.rows[0]["locationid"])
+        self.assertFalse(self.stored_hours(truck).exists())
+        self.assertIsNone(truck.open_hours_bitmap)
+
+    def test_sync_discards_derived_structures_once(self):
+        self.rows = list(synthetic_truck_rows(6, hours_density=1))
+        self.sync()
+        del self.rows[:3]
+        self.rows[0]["dayshours"] = "Mo-Su:12AM-11PM"
+
+        with mock.patch("api.signals.discard_truck_snapshot") as discard:
+            with self.captureOnCommitCallbacks(execute=True):
+                stats = self.sync()
+
+        self.assertEqual(stats.deleted, 3)
+        discard.assert_called_once_with()
+
+
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+class BulkImportTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.csv_path = os.path.join(directory.name, "trucks.csv")
+        rows = list(synthetic_truck_rows(120, hours_density=0.8))
+        unlocatable = dict(rows[1], locationid="unlocatable", Latitude="0")
+        write_rows(self.csv_path, rows + [dict(rows[0]), unlocatable])
+
+    def stored(self):
+        trucks = list(
+            FoodTruck.objects.order_by("location_id").values_list(
+                *(field.name for field in FoodTruck._meta.fields if field.name != "id")
+            )
+        )
+        hours = list(
+            FoodTruckOperatingHour.objects.order_by(
+                "food_truck__location_id", "day", "open_time"
+            ).values_list("food_truck__location_id", "day", "open_time", "close_time")
+        )
+        return trucks, hours
+
+    def test_parallel_parsing_stores_the_same_trucks(self):
+        stats = bulk_import(self.csv_path, batch_size=25, workers=1)
+        stored = self.stored()
+        FoodTruck.objects.all().delete()
+        parallel_stats = bulk_import(self.csv_path, batch_size=25, workers=2)
+
+        self.assertEqual(self.stored(), stored)
+        for run in (stats, parallel_stats):
+            self.assertEqual(
+                (run.rows, run.created, run.duplicates, run.unlocatable),
+                (122, 120, 1, 1),
+            )
+            self.assertEqual(run.operating_hours, len(stored[1]))
+        self.assertTrue(stored[1])
+
+    def test_reloads_skip_stored_trucks(self):
+        bulk_import(self.csv_path, workers=2)
+        stats = bulk_import(self.csv_path, workers=2)
+
+        self.assertEqual((stats.created, stats.duplicates), (0, 121))
+        self.assertIsNone(stats.version)
+        self.assertEqual(FoodTruck.objects.count(), 120)
+
+
+class UnreachableTruckTests(TestCase):
+    def setUp(self):
+        for row in synthetic_truck_rows(3):
+            FoodTruck.objects.create(**map_row(row, []))
+        self.trucks = list(FoodTruck.objects.order_by("id"))
+        self.elements = {
+            self.trucks[0].id: walking_element(900, 1.4),
+            self.trucks[1].id: {"status": "ZERO_RESULTS"},
+            self.trucks[2].id: walking_element(300, 1.4),
+        }
+
+    def test_ranking_skips_unreachable_trucks(self):
+        ranking = rank_trucks_by_walking_time(self.trucks, self.elements)
+
+        self.assertEqual(
+            [result["truck_details"] for result in ranking],
+            [self.trucks[2], self.trucks[0]],
+        )
+
+    def test_ranking_without_reachable_trucks_raises(self):
+        with self.assertRaises(KeyError):
+            rank_trucks_by_walking_time(
+                self.trucks[1:2], {self.trucks[1].id: {"status": "NOT_FOUND"}}
+            )
+
+    @override_settings(WALKING_TIME_CACHE_ENABLED=True)
+    def test_unreachable_trucks_are_not_cached(self):
+        walking_time_cache.set_many(37.78, -122.41, self.elements)
+
+        cached = walking_time_cache.get_many(
+            37.78, -122.41, [truck.id for truck in self.trucks]
+        )
+        self.assertEqual(set(cached), {self.trucks[0].id, self.trucks[2].id})
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    RESPONSE_CACHE_LOCK_TIMEOUT=0,
+)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_response_computed_past_the_lock_deadline_is_stored(self):
+        # Left behind by a worker that died while computing
+        cache.add(response_cache._lock_key("key"), 1)
+
+        self.assertEqual(response_cache.get_or_compute("key", lambda: "value"), "value")
+        self.assertEqual(response_cache.get_or_compute("key", lambda: "other"), "value")
+
+    def test_hits_and_misses_are_counted(self):
+        response_cache.reset_stats()
+        for _ in range(3):
+            response_cache.get_or_compute("key", lambda: "value")
+
+        stats = response_cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+    def test_responses_built_from_estimates_are_not_stored(self):
+        truck = FoodTruck(id=1, latitude=37.79, longitude=-122.40)
+
+        def compute():
+            estimate_walking_elements(37.78, -122.41, [truck])
+            return "estimated"
+
+        self.assertEqual(response_cache.get_or_compute("key", compute), "estimated")
+        self.assertIsNone(cache.get("key"))
+
+    def test_estimates_outside_the_response_cache_are_not_flagged(self):
+        truck = FoodTruck(id=1, latitude=37.79, longitude=-122.40)
+        estimate_walking_elements(37.78, -122.41, [truck])
+
+        self.assertIsNone(serving_estimates.get())
+        self.assertEqual(response_cache.get_or_compute("key", lambda: "value"), "value")
+        self.assertIsNotNone(cache.get("key"))
+
+
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False, WALKING_TIME_CACHE_ENABLED=True)
+class WalkingTimeCacheTests(TestCase):
+    def setUp(self):
+        for row in synthetic_truck_rows(2):
+            FoodTruck.objects.create(**map_row(row, []))
+        self.truck_ids = list(FoodTruck.objects.values_list("id", flat=True))
+        self.cache = WalkingTimeCache()
+        self.cache.set_many(
+            37.78,
+            -122.41,
+            {truck_id: walking_element(600, 1.4) for truck_id in self.truck_ids},
+        )
+
+    def test_recent_hits_are_not_touched(self):
+        with self.assertNumQueries(1):
+            self.cache.get_many(37.78, -122.41, self.truck_ids)
+
+    def test_old_hits_are_touched(self):
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        WalkingTimeCacheEntry.objects.update(last_used_at=an_hour_ago)
+
+        with self.assertNumQueries(2):
+            self.cache.get_many(37.78, -122.41, self.truck_ids)
+        self.assertFalse(
+            WalkingTimeCacheEntry.objects.filter(last_used_at=an_hour_ago).exists()
+        )
+
+    @override_settings(WALKING_TIME_CACHE_MAX_ENTRIES=1)
+    def test_eviction_runs_once_per_interval(self):
+        with mock.patch.object(self.cache, "evict") as evict:
+            self.cache.set_many(
+                37.79, -122.41, {self.truck_ids[0]: walking_element(9, 1.4)}
+            )
+        evict.assert_not_called()
+
+        self.cache._next_eviction = 0.0
+        self.cache.set_many(
+            37.79, -122.41, {self.truck_ids[1]: walking_element(9, 1.4)}
+        )
+        self.assertEqual(WalkingTimeCacheEntry.objects.count(), 1)
+
+
+class StreetGraphTests(TestCase):
+    @override_settings(STREET_GRAPH_PATH="/nonexistent/street_graph.npz")
+    def test_missing_graph_is_looked_for_once(self):
+        cache = street_graph._street_graph
+        cache.invalidate()
+        self.addCleanup(cache.invalidate)
+
+        with mock.patch.object(cache, "build", wraps=cache.build) as build:
+            for _ in range(3):
+                self.assertIsNone(get_street_graph())
+        build.assert_called_once_with()
+
+
+class RequestMetricsTests(TestCase):
+    def test_metrics_do_not_build_the_google_client(self):
+        with mock.patch.object(walking_time, "_google_client", None):
+            response = self.client.get("/api/food-trucks/metrics/")
+            self.assertIsNone(walking_time.peek_google_client())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("google_client", response.json())
+
+
+class ResilientClientTests(TestCase):
+    origins = [(37.78, -122.41)]
+    destinations = [(37.79, -122.40), (37.77, -122.42)]
+
+    def setUp(self):
+        self.server = FakeGoogleMapsServer().start()
+        self.addCleanup(self.server.stop)
+        self.client = ResilientDistanceMatrixClient(
+            "AIzaFAKEKEYFAKEKEYFAKEKEY",
+            base_url=self.server.url,
+            pool_size=2,
+            breaker_failures=2,
+            breaker_reset_seconds=60,
+        )
+
+    def call(self, times=1):
+        for _ in range(times):
+            try:
+                self.client.distance_matrix(self.origins, self.destinations)
+            except ConnectionError:
+                pass
+
+    def test_server_errors_open_the_breaker(self):
+        self.server.error_rate = 1.0
+        self.call(3)
+
+        stats = self.client.stats()
+        self.assertEqual((stats["circuit"], stats["failures"]), ("open", 2))
+        self.assertEqual(stats["short_circuited"], 1)
+
+    def test_rejected_requests_leave_the_breaker_closed(self):
+        self.server.status = "INVALID_REQUEST"
+        self.call(3)
+
+        stats = self.client.stats()
+        self.assertEqual((stats["circuit"], stats["rejected"]), ("closed", 3))
+        # Not retried either
+        self.assertEqual(self.server.requests, 3)
+        self.server.status = "OK"
+        response = self.client.distance_matrix(self.origins, self.destinations)
+        self.assertEqual(len(response["rows"][0]["elements"]), 2)
+
+    def test_async_rejected_requests_leave_the_breaker_closed(self):
+        self.server.status = "REQUEST_DENIED"
+
+        async def call():
+            for _ in range(3):
+                with self.assertRaises(ConnectionError):
+                    await self.client.distance_matrix_async(
+                        self.origins, self.destinations
+                    )
+
+        asyncio.run(call())
+        self.assertEqual(self.client.stats()["circuit"], "closed")
+
+    def test_over_query_limit_opens_the_breaker(self):
+        self.server.status = "OVER_QUERY_LIMIT"
+        self.call(2)
+
+        self.assertEqual(self.client.stats()["circuit"], "open")
+
+
+class WeekBitmapTests(TestCase):
+    def open_slots(self, hours):
+        return decode_week_bitmap(encode_week_bitmap(hours)).nonzero()[0].tolist()
+
+    def test_round_trip(self):
+        slots = self.open_slots([("Tuesday", time(10), time(15))])
+
+        self.assertEqual(slots, list(range(SLOTS_PER_DAY + 40, SLOTS_PER_DAY + 60)))
+
+    def test_times_off_quarter_hours_are_rounded_outwards(self):
+        self.assertEqual(
+            self.open_slots([("Monday", time(10, 10), time(10, 20))]), [40, 41]
+        )
+
+    def test_intervals_past_midnight_never_match(self):
+        self.assertEqual(self.open_slots([("Friday", time(20), time(2))]), [])
+
+    def test_missing_bitmap_is_closed(self):
+        self.assertFalse(decode_week_bitmap(None).any())
+
+
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+class ResponseCacheKeyTests(TestCase):
+    @override_settings(
+        RESPONSE_CACHE_COORDINATE_MODE="grid", RESPONSE_CACHE_GRID_DECIMALS=3
+    )
+    def test_grid_coordinates(self):
+        normalize = response_cache.normalize_coordinates
+
+        self.assertEqual(normalize(37.77491, -122.41941), "37.775,-122.419")
+        self.assertEqual(normalize(37.77461, -122.41899), "37.775,-122.419")
+        self.assertEqual(normalize(-0.0001, 0.0), "0.000,0.000")
+
+    @override_settings(
+        RESPONSE_CACHE_COORDINATE_MODE="geohash", RESPONSE_CACHE_GEOHASH_PRECISION=11
+    )
+    def test_geohash_coordinates(self):
+        self.assertEqual(
+            response_cache.normalize_coordinates(57.64911, 10.40744), "u4pruydqqvj"
+        )
+
+    def test_times_share_a_key_while_the_open_trucks_stay_the_same(self):
+        row = next(synthetic_truck_rows(1, hours_density=1))
+        row["dayshours"] = "Mo-Fr:10AM-3PM"
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        csv_path = os.path.join(directory.name, "trucks.csv")
+        write_rows(csv_path, [row])
+        sync_import(csv_path)
+
+        def key(user_time, fields=None):
+            return response_cache.build_cache_key(
+                37.78, -122.41, user_time, "UTC", fields=fields
+            )
+
+        # 2024-01-01 was a Monday
+        self.assertEqual(key("2024-01-01T11:00"), key("2024-01-01T14:30"))
+        self.assertNotEqual(key("2024-01-01T09:00"), key("2024-01-01T11:00"))
+        self.assertNotEqual(key("2024-01-01T11:00"), key("2024-01-01T11:00", ["name"]))
+        self.assertIn("_any_", key(None))
+        self.assertIn("_raw_", key("yesterday"))
+
+
+class PlanCallsTests(TestCase):
+    def test_origins_needing_the_same_destinations_share_a_call(self):
+        calls = plan_calls(
+            {
+                "a": ((1, 1), [(9, 1), (9, 2)]),
+                "b": ((2, 2), [(9, 2), (9, 1)]),
+                "c": ((3, 3), [(9, 3)]),
+            }
+        )
+
+        self.assertEqual(
+            calls,
+            [
+                ([(1, 1), (2, 2)], [(9, 1), (9, 2)]),
+                ([(3, 3)], [(9, 3)]),
+            ],
+        )
+
+    def test_calls_stay_within_the_limits(self):
+        destinations = [(9, i) for i in range(30)]
+        calls = plan_calls({cell: ((cell, cell), destinations) for cell in range(5)})
+
+        self.assertEqual(
+            [(len(origins), len(chunk)) for origins, chunk in calls],
+            [(4, 25), (1, 25), (5, 5)],
+        )
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(2, reset_seconds=60)
+
+    def trip(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_consecutive_failures_open_the_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+
+        self.breaker.record_failure()
+        self.assertEqual((self.breaker.state, self.breaker.trips), ("open", 1))
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_lets_a_single_trial_call_through(self):
+        self.trip()
+        self.breaker.reset_seconds = 0
+
+        self.assertEqual(self.breaker.state, "half-open")
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.release()
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_success_closes_the_circuit(self):
+        self.trip()
+        self.breaker.reset_seconds = 0
+        self.breaker.allow()
+        self.breaker.record_success()
+
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_failure_opens_the_circuit_again(self):
+        self.trip()
+        self.breaker.reset_seconds = 0
+        self.breaker.allow()
+        self.breaker.reset_seconds = 60
+        self.breaker.record_failure()
+
+        self.assertEqual((self.breaker.state, self.breaker.trips), ("open", 1))
+        self.assertFalse(self.breaker.allow())
+
+
+@override_settings(
+    TRUCK_SNAPSHOT_ENABLED=False,
+    ANSWER_GRID_ENABLED=False,
+    WALKING_TIME_CACHE_ENABLED=False,
+)
+class AdaptiveWalkingSearchTests(TestCase):
+    lat = 37.7749
+    long = -122.4194
+
+    def setUp(self):
+        for row in synthetic_truck_rows(60):
+            FoodTruck.objects.create(**map_row(row, []))
+        self.trucks = list(FoodTruck.objects.all())
+
+    def elements(self, trucks):
+        # Detours of up to 50%, walked at 1.4 m/s
+        return {
+            truck.id: walking_element(
+                geodesic_meters(self.lat, self.long, truck.latitude, truck.longitude)
+                * (1 + truck.id % 6 / 10),
+                1.4,
+            )
+            for truck in trucks
+        }
+
+    def search(self, elements):
+        """
+        Run the search to the end, returning its ranking and the trucks looked
+        up in each round.
+        """
+        search = AdaptiveWalkingSearch(self.lat, self.long, None)
+        rounds = []
+        while (trucks := search.next_round()) is not None:
+            rounds.append(trucks)
+            search.add(trucks, elements(trucks))
+        return [result["truck_details"].id for result in search.ranking()], rounds
+
+    def expected(self, elements):
+        return [
+            result["truck_details"].id
+            for result in rank_trucks_by_walking_time(
+                self.trucks, elements(self.trucks)
+            )
+        ]
+
+    def test_finds_the_quickest_trucks_with_fewer_lookups(self):
+        ranking, rounds = self.search(self.elements)
+
+        self.assertEqual(ranking, self.expected(self.elements))
+        self.assertLess(sum(map(len, rounds)), len(self.trucks))
+
+    def test_first_round_asks_for_the_fixed_candidates(self):
+        _, rounds = self.search(self.elements)
+
+        self.assertEqual(len(rounds[0]), 10)
+
+    @override_settings(WALKING_TIME_PREFILTER_K=7)
+    def test_street_graph_bounds_the_walks(self):
+        # Streets every 0.005 degrees over the city
+        (min_lat, max_lat), (min_long, max_long) = SF_BOUNDS
+        lats = [min_lat + i * 0.005 for i in range(23)]
+        longs = [min_long + j * 0.005 for j in range(33)]
+        node = {
+            (i, j): len(lats) * j + i
+            for i in range(len(lats))
+            for j in range(len(longs))
+        }
+        graph = StreetGraph.from_edges(
+            [(lat, long) for long in longs for lat in lats],
+            [(node[i, j], node[i + 1, j]) for i, j in node if i + 1 < len(lats)]
+            + [(node[i, j], node[i, j + 1]) for i, j in node if j + 1 < len(longs)],
+        )
+
+        def elements(trucks):
+            # Walks along the streets
+            return dict(
+                zip(
+                    [truck.id for truck in trucks],
+                    [
+                        walking_element(meters, 1.4)
+                        for meters in graph.walking_meters(
+                            self.lat,
+                            self.long,
+                            [(truck.latitude, truck.longitude) for truck in trucks],
+                        )
+                    ],
+                )
+            )
+
+        with mock.patch("api.utils.get_street_graph", return_value=graph):
+            ranking, rounds = self.search(elements)
+
+        self.assertEqual(ranking, self.expected(elements))
+        self.assertEqual([len(trucks) for trucks in rounds], [7])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    WALKING_TIME_ADAPTIVE=False,
+)
+class ViewErrorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_missing_keys_are_reported_alike(self):
+        with mock.patch(
+            "api.utils.get_top_ten_closet_trucks_by_straight_distance",
+            side_effect=KeyError("name"),
+        ):
+            for url in ("/api/food-trucks/", "/api/food-trucks/async/"):
+                with self.subTest(url=url), self.assertLogs("api.views", "ERROR"):
+                    response = self.client.get(
+                        url, {"latitude": 37.78, "longitude": -122.41}
+                    )
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json(), {"message": "'name'"})
+
+    def test_queries_are_validated_alike(self):
+        cases = [
+            ({"latitude": 37.78}, "Latitude and longitude parameters are required."),
+            (
+                {"latitude": "a", "longitude": 1},
+                "Invalid latitude or longitude values.",
+            ),
+            (
+                {"latitude": "nan", "longitude": 1},
+                "Invalid latitude or longitude values.",
+            ),
+            (
+                {"latitude": 95, "longitude": -122.41},
+                "Latitude must be between -90 and 90, "
+                "and longitude between -180 and 180.",
+            ),
+            (
+                {"latitude": 37.78, "longitude": -122.41, "open_within": 30},
+                "When open_within is provided, time also should be provided.",
+            ),
+        ]
+        for params, message in cases:
+            with self.subTest(params=params):
+                for url in ("/api/food-trucks/", "/api/food-trucks/async/"):
+                    response = self.client.get(url, params)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json(), {"message": message})
+                response = self.client.post(
+                    "/api/food-trucks/batch/",
+                    {"points": [params]},
+                    content_type="application/json",
+                )
+                self.assertEqual(
+                    json.loads(b"".join(response.streaming_content)),
+                    [{"message": message}],
+                )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    TRUCK_SNAPSHOT_ENABLED=False,
+    WALKING_TIME_CACHE_ENABLED=False,
+    WALKING_TIME_PROVIDER="api.walking_time.StubWalkingTimeProvider",
+)
+class FoodTruckViewTests(TestCase):
+    # A Monday morning
+    query = {
+        "latitude": 37.7749,
+        "longitude": -122.4194,
+        "time": "2024-01-01T11:00",
+        "timezone": "UTC",
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        load_synthetic_trucks(60)
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, url, params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_lists_the_closest_open_trucks(self):
+        results = self.get("/api/food-trucks/", self.query)
+
+        self.assertEqual(len(results), 5)
+        open_ids = OpenHoursIndex.from_database().open_truck_ids(MONDAY_MORNING)
+        for result in results:
+            self.assertEqual(set(result), {"distance", "duration", "truck_details"})
+            self.assertIn(result["truck_details"]["id"], open_ids)
+        truck = FoodTruck.objects.get(pk=results[0]["truck_details"]["id"])
+        self.assertEqual(results[0]["truck_details"], FoodTruckSerializer(truck).data)
+
+    def test_fields_restrict_the_truck_details(self):
+        results = self.get("/api/food-trucks/", dict(self.query, fields="applicant,id"))
+
+        self.assertEqual(
+            [set(result["truck_details"]) for result in results],
+            [{"id", "applicant"}] * 5,
+        )
+
+    def test_async_view_answers_like_the_sync_view(self):
+        for params in (self.query, {"latitude": 37.79, "longitude": -122.40}):
+            with self.subTest(params=params):
+                expected = self.get("/api/food-trucks/", params)
+                cache.clear()
+                self.assertEqual(self.get("/api/food-trucks/async/", params), expected)
+
+    def test_batch_results_follow_the_points(self):
+        points = [
+            self.query,
+            {"latitude": 37.79, "longitude": -122.40},
+            {"latitude": 37.78},
+            {"latitude": 37.71, "longitude": -122.45, "time": "2024-01-06T17:00"},
+            {"latitude": 37.72, "longitude": -122.39},
+        ]
+        expected = [
+            self.get("/api/food-trucks/", point) for point in (points[0], points[1])
+        ]
+
+        response = self.client.post(
+            "/api/food-trucks/batch/",
+            {"points": points, "fields": ["id", "applicant"]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(b"".join(response.streaming_content))
+
+        self.assertEqual(len(results), len(points))
+        for position in (0, 1):
+            self.assertEqual(
+                results[position],
+                [
+                    dict(
+                        result,
+                        truck_details={
+                            "id": result["truck_details"]["id"],
+                            "applicant": result["truck_details"]["applicant"],
+                        },
+                    )
+                    for result in expected[position]
+                ],
+            )
+        self.assertEqual(
+            results[2], {"message": "Latitude and longitude parameters are required."}
+        )
+        self.assertEqual(
+            results[3],
+            {"message": "When time is provided, timezone also should be provided."},
+        )
+        self.assertEqual(len(results[4]), 5)
+
+
+class LoadFoodTrucksTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.csv_path = os.path.join(directory.name, "trucks.csv")
+        write_rows(self.csv_path, synthetic_truck_rows(20))
+
+    def test_oversized_answer_grid_does_not_stop_the_load(self):
+        snapshot_path = os.path.join(self.directory, "trucks.snapshot")
+        output = io.StringIO()
+        with override_settings(
+            ANSWER_GRID_ENABLED=True,
+            ANSWER_GRID_MAX_CELLS=1,
+            TRUCK_SNAPSHOT_ENABLED=True,
+            TRUCK_SNAPSHOT_PATH=snapshot_path,
+        ):
+            call_command("load_food_trucks", self.csv_path, stdout=output)
+
+        self.assertIn("Answer grid not rebuilt", output.getvalue())
+        self.assertIn("Successfully loaded food truck data", output.getvalue())
+        self.assertTrue(os.path.exists(snapshot_path))
+
+
+@override_settings(ANSWER_GRID_ENABLED=True)
+class SingleTruckEditTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot_path = os.path.join(directory.name, "trucks.snapshot")
+        snapshot_settings = override_settings(
+            TRUCK_SNAPSHOT_ENABLED=True, TRUCK_SNAPSHOT_PATH=self.snapshot_path
+        )
+        snapshot_settings.enable()
+        self.addCleanup(snapshot_settings.disable)
+        self.addCleanup(invalidate_truck_snapshot)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for row in synthetic_truck_rows(20):
+                FoodTruck.objects.create(**map_row(row, []))
+        build_answer_grid()
+        write_truck_snapshot()
+        self.truck = FoodTruck.objects.order_by("id").first()
+
+    def test_edits_rewrite_the_snapshot_in_place(self):
+        self.truck.applicant = "Renamed Truck"
+        with mock.patch("api.signals.refresh_answer_grid") as refresh_grid:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.truck.save()
+
+        snapshot = get_truck_snapshot()
+        self.assertIsNotNone(snapshot)
+        self.assertEqual(
+            snapshot.fragments([self.truck.id], ("applicant",))[self.truck.id],
+            '{"applicant":"Renamed Truck"}',
+        )
+        refresh_grid.assert_not_called()
+
+    def test_moves_rebuild_the_answer_grid(self):
+        self.truck.latitude += 0.01
+        with self.captureOnCommitCallbacks(execute=True):
+            self.truck.save()
+
+        self.assertIsNotNone(get_truck_snapshot())
+        nearest = get_answer_grid().nearest(
+            self.truck.latitude, self.truck.longitude, k=1
+        )
+        self.assertEqual(nearest[0][0], self.truck.id)
+
+    def test_changes_of_a_transaction_share_a_rewrite(self):
+        with mock.patch(
+            "api.truck_snapshot.write_truck_snapshot", wraps=write_truck_snapshot
+        ) as write:
+            with self.captureOnCommitCallbacks(execute=True):
+                for day in ("Monday", "Tuesday", "Wednesday"):
+                    FoodTruckOperatingHour.objects.create(
+                        food_truck=self.truck,
+                        day=day,
+                        open_time=time(10),
+                        close_time=time(14),
+                    )
+        write.assert_called_once_with()
+        self.assertTrue(
+            get_truck_snapshot().open_hours.is_open(
+                self.truck.id, datetime(2024, 1, 1, 11, tzinfo=dt_timezone.utc)
+            )
+        )
+
+
+@override_settings(GOOGLE_MAPS_API_KEY="not-a-key")
+class GoogleProviderTests(TestCase):
+    def test_unusable_key_fails_like_the_service(self):
+        for coalesce in (False, True):
+            with self.subTest(coalesce=coalesce), override_settings(
+                WALKING_TIME_COALESCE_ENABLED=coalesce
+            ), mock.patch.object(walking_time, "_google_client", None):
+                with self.assertRaises(ConnectionError):
+                    GoogleDistanceMatrixProvider().get_elements(
+                        37.78, -122.41, [(37.79, -122.40)]
+                    )
+
+
+class ParseChunkTests(TestCase):
+    def test_spawned_workers_parse_like_the_importer(self):
+        rows = list(synthetic_truck_rows(5, hours_density=1))
+        # Workers started from scratch have no Django settings
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=set_feed_timezone,
+            initargs=(settings.TIME_ZONE,),
+        ) as executor:
+            parsed, errors, _ = executor.submit(parse_chunk, rows).result()
+
+        self.assertEqual((parsed, errors), parse_chunk(rows)[:2])
+        self.assertIsNotNone(parsed[0][0]["approved"].tzinfo)
+
+
+class WalkingTimeProviderTests(TestCase):
+    def test_providers_must_implement_get_elements(self):
+        class IncompleteProvider(walking_time.WalkingTimeProvider):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteProvider()
+
+
+@override_settings(
+    TRUCK_SNAPSHOT_ENABLED=False,
+    WALKING_TIME_CACHE_ENABLED=False,
+    WALKING_TIME_PROVIDER="api.walking_time.StubWalkingTimeProvider",
+)
+class ListFoodTrucksTests(TestCase):
+    def test_lists_the_closest_trucks(self):
+        for row in synthetic_truck_rows(8):
+            FoodTruck.objects.create(**map_row(row, []))
+        console = Console(file=io.StringIO(), width=300)
+
+        with mock.patch.object(list_food_trucks.Command, "console", console):
+            call_command("list_food_trucks", "37.78", "-122.41")
+
+        output = console.file.getvalue()
+        self.assertNotIn("An error occurred", output)
+        self.assertEqual(output.count("Synthetic Truck"), 5)
+
+
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+class NearestTruckTests(TestCase):
+    """
+    Every nearest truck search gives the answer of a full geodesic scan.
+    """
+
+    k = 10
+    # The last one is away from every truck
+    points = [(37.7749, -122.4194), (37.80, -122.45), (37.71, -122.38), (38.2, -123.0)]
+
+    @classmethod
+    def setUpTestData(cls):
+        load_synthetic_trucks(300)
+        cls.rows = list(
+            FoodTruck.objects.order_by("id").values_list("id", "latitude", "longitude")
+        )
+        cls.open_ids = OpenHoursIndex.from_database().open_truck_ids(MONDAY_MORNING)
+
+    def scan(self, lat, long, allowed_ids):
+        return [
+            truck_id
+            for _, truck_id in sorted(
+                (geodesic_meters(lat, long, truck_lat, truck_long), truck_id)
+                for truck_id, truck_lat, truck_long in self.rows
+                if allowed_ids is None or truck_id in allowed_ids
+            )[: self.k]
+        ]
+
+    def assertMatchesScan(self, nearest):
+        """
+        Check `nearest(lat, long, allowed_ids)`, returning (truck_id, meters)
+        tuples, against the scan, with and without a time filter.
+        """
+        self.assertTrue(0 < len(self.open_ids) < len(self.rows))
+        for lat, long in self.points:
+            for allowed_ids in (None, self.open_ids):
+                with self.subTest(point=(lat, long), filtered=allowed_ids is not None):
+                    self.assertEqual(
+                        [truck_id for truck_id, _ in nearest(lat, long, allowed_ids)],
+                        self.scan(lat, long, allowed_ids),
+                    )
+
+    def test_truck_index(self):
+        index = TruckSpatialIndex.from_database()
+
+        self.assertMatchesScan(
+            lambda lat, long, allowed_ids: index.nearest(
+                lat, long, k=self.k, allowed_ids=allowed_ids
+            )
+        )
+
+    def test_haversine_ranker(self):
+        ids, latitudes, longitudes = zip(*self.rows)
+        ranker = HaversineRanker(ids, latitudes, longitudes)
+
+        def nearest(lat, long, allowed_ids):
+            mask = None
+            if allowed_ids is not None:
+                mask = np.isin(ranker.ids, list(allowed_ids))
+            return [
+                (int(ranker.ids[position]), meters)
+                for position, meters in ranker.top_k(
+                    lat, long, k=self.k, mask=mask, exact=True
+                )
+            ]
+
+        self.assertMatchesScan(nearest)
+
+    def test_answer_grid(self):
+        grid = AnswerGrid.build(
+            self.rows,
+            settings.ANSWER_GRID_CELL_METERS,
+            settings.ANSWER_GRID_CANDIDATES,
+        )
+        answered = []
+
+        def nearest(lat, long, allowed_ids):
+            trucks = grid.nearest(lat, long, k=self.k, allowed_ids=allowed_ids)
+            if trucks is None:
+                # Left to the truck index, the grid is not sure of the answer
+                return [
+                    (truck_id, None) for truck_id in self.scan(lat, long, allowed_ids)
+                ]
+            answered.append((lat, long, allowed_ids is not None))
+            return trucks
+
+        self.assertMatchesScan(nearest)
+        self.assertTrue(any(filtered for _, _, filtered in answered))
+        self.assertTrue(any(not filtered for _, _, filtered in answered))
+
+    def test_database_search(self):
+        self.assertMatchesScan(
+            lambda lat, long, allowed_ids: nearest_from_database(
+                lat, long, k=self.k, allowed_ids=allowed_ids
+            )
+        )
+
+    def test_truck_snapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshot = write_truck_snapshot(os.path.join(directory.name, "trucks.snapshot"))
+
+        self.assertMatchesScan(
+            lambda lat, long, allowed_ids: snapshot.nearest(
+                lat, long, k=self.k, allowed_ids=allowed_ids
+            )
+        )
+
+
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+class OpenHoursIndexTests(TestCase):
+    """
+    The open hours index agrees with a query on the operating hours table.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        load_synthetic_trucks(200, hours_density=0.8)
+
+    def open_truck_ids_from_table(self, user_datetime):
+        open_ids = set()
+        for hours in FoodTruckOperatingHour.objects.filter(
+            day=user_datetime.strftime("%A")
+        ):
+            if hours.open_time <= user_datetime.time() <= hours.close_time:
+                open_ids.add(hours.food_truck_id)
+        return open_ids
+
+    def test_open_truck_ids(self):
+        index = OpenHoursIndex.from_database()
+        monday = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        moments = [
+            monday,
+            monday + timedelta(hours=6, minutes=59, seconds=59),
+            monday + timedelta(hours=7),
+            monday + timedelta(hours=10, minutes=30),
+            # Closing times are included
+            monday + timedelta(hours=15),
+            monday + timedelta(hours=15, seconds=1),
+            monday + timedelta(hours=22),
+            monday + timedelta(days=2, hours=12),
+            monday + timedelta(days=5, hours=16),
+            monday + timedelta(days=6, hours=20),
+            monday + timedelta(days=6, hours=23, minutes=59, seconds=59),
+        ]
+
+        for moment in moments:
+            with self.subTest(moment=moment):
+                expected = self.open_truck_ids_from_table(moment)
+                self.assertEqual(index.open_truck_ids(moment), expected)
+        self.assertTrue(index.open_truck_ids(monday + timedelta(hours=10, minutes=30)))
+
+
+@override_settings(TRUCK_SNAPSHOT_ENABLED=False)
+class TruckFragmentTests(TestCase):
+    """
+    Truck fragments are the JSON of `FoodTruckSerializer`, byte for byte.
+    """
+
+    subsets = [None, ("id", "applicant", "x", "approved", "prior_permit")]
+
+    @classmethod
+    def setUpTestData(cls):
+        rows = list(synthetic_truck_rows(30))
+        rows[0]["Applicant"] = "Crêpes & Café ☕"
+        rows[1]["Approved"] = ""
+        rows[1]["X"] = ""
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        csv_path = os.path.join(directory.name, "trucks.csv")
+        write_rows(csv_path, rows)
+        bulk_import(csv_path)
+
+    def assertMatchesSerializer(self):
+        trucks = list(FoodTruck.objects.order_by("id"))
+        truck_ids = [truck.id for truck in trucks]
+        for fields in self.subsets:
+            with self.subTest(fields=fields):
+                fragments = truck_fragments.get_many(truck_ids, fields)
+                for truck in trucks:
+                    data = FoodTruckSerializer(truck).data
+                    if fields is not None:
+                        data = {name: data[name] for name in fields}
+                    self.assertEqual(
+                        fragments[truck.id],
+                        json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+                    )
+
+    def test_fragments_from_the_database(self):
+        self.assertIsNone(get_truck_snapshot())
+        self.assertMatchesSerializer()
+
+    def test_fragments_from_the_snapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshot_path = os.path.join(directory.name, "trucks.snapshot")
+        with override_settings(
+            TRUCK_SNAPSHOT_ENABLED=True, TRUCK_SNAPSHOT_PATH=snapshot_path
+        ):
+            self.addCleanup(invalidate_truck_snapshot)
+            write_truck_snapshot()
+            self.assertIsNotNone(get_truck_snapshot())
+            self.assertMatchesSerializer()
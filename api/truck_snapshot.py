@@ -0,0 +1,357 @@
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import numpy as np
+from django.conf import settings
+from django.db import router
+from .dataset_version import get_dataset_version
+from .models import FoodTruck
+from .process_cache import ProcessWideCache
+from .ranking import HaversineRanker
+from .week_bitmap import stack_week_bitmaps
+
+logger = logging.getLogger(__name__)
+
+# Layout of a snapshot file:
+# - a header: magic, format version, offset and length of the metadata
+# - numpy arrays ("sections"), little-endian, each starting on an ALIGNMENT
+#   boundary, so that they can be used in place from the mapped file
+# - the metadata, JSON: dataset version, display fields, and for each section
+#   its offset, dtype and shape
+MAGIC = b"FTSNAP\r\n"
+# Bumped whenever the layout or the meaning of a section changes
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIqq")
+ALIGNMENT = 64
+
+
+def read_section(buffer, offset, dtype, shape):
+    """
+    Array of the given dtype and shape stored at `offset` in `buffer`, without
+    copying it: a read-only view when `buffer` is a read-only mmap.
+    """
+    count = math.prod(shape)
+    if not count:
+        return np.empty(shape, dtype=dtype)
+    return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+class TruckSnapshot:
+    """
+    Read-only, columnar copy of the trucks of one dataset version, written by
+    `write_truck_snapshot` and used in place from a memory-mapped file.
+
+    Every worker maps the same file, so the columns live once in the page
+    cache whatever the number of workers. The snapshot answers the nearest
+    truck queries (like `TruckSpatialIndex`, by a vectorized scan of the
+    coordinates), the open hours queries (as an `OpenHoursIndex`) and renders
+    truck details from values JSON-encoded by the loader, without querying
+    the database.
+    """
+
+    def __init__(self, buffer):
+        magic, format_version, metadata_offset, metadata_length = HEADER.unpack_from(
+            buffer, 0
+        )
+        if magic != MAGIC:
+            raise ValueError("Not a truck snapshot.")
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported truck snapshot format {format_version}.")
+        metadata = json.loads(
+            bytes(buffer[metadata_offset : metadata_offset + metadata_length])
+        )
+        sections = {
+            name: read_section(buffer, offset, dtype, shape)
+            for name, (offset, dtype, shape) in metadata["sections"].items()
+        }
+
+        # Imported here, the open hours index reads from the snapshot
+        from .open_hours import OpenHoursIndex
+
+        self.buffer = buffer
+        self.dataset_version = metadata["dataset_version"]
+        self.fields = metadata["fields"]
+        # Trucks in ascending id order
+        self.ids = sections["ids"]
+        self.ranker = HaversineRanker.from_columns(
+            self.ids,
+            sections["latitudes"],
+            sections["longitudes"],
+            sections["lat_radians"],
+            sections["long_radians"],
+            sections["cos_lat"],
+        )
+        self.open_hours = OpenHoursIndex(
+            self.ids, sections["bitmaps"], sections["boundaries"].tolist()
+        )
+        # The encoded value of field f of truck t is
+        # values[value_offsets[t * len(fields) + f] : value_offsets[... + 1]]
+        self.value_offsets = sections["value_offsets"]
+        self.values = sections["values"]
+        self._columns = {name: column for column, name in enumerate(self.fields)}
+        # As `json.dumps` writes the keys of a fragment
+        self._keys = [
+            json.dumps(name, ensure_ascii=False) + ":" for name in self.fields
+        ]
+
+    @classmethod
+    def open(cls, file_path):
+        with open(file_path, "rb") as file:
+            # The mapping stays valid once the file is closed, and after the
+            # file is replaced by a newer snapshot
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, truck_ids):
+        """
+        Position of each truck in the snapshot, None for unknown trucks.
+        """
+        if not len(self.ids):
+            return [None] * len(truck_ids)
+        truck_ids = np.asarray(truck_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, truck_ids), len(self.ids) - 1)
+        found = self.ids[positions] == truck_ids
+        return [
+            position if known else None
+            for position, known in zip(positions.tolist(), found.tolist())
+        ]
+
+    def mask_for(self, allowed_ids):
+        """
+        Boolean mask of the given trucks, in snapshot order, for `nearest`.
+        """
+        return np.isin(self.ids, list(allowed_ids))
+
+    def nearest(self, lat, long, k=10, allowed_ids=None, exact=True, mask=None):
+        """
+        Same answer as `TruckSpatialIndex.nearest`, as (truck_id, meters) tuples.
+        """
+        if allowed_ids is not None:
+            mask = self.mask_for(allowed_ids)
+        return [
+            (int(self.ids[position]), meters)
+            for position, meters in self.ranker.top_k(
+                lat, long, k=k, mask=mask, exact=exact
+            )
+        ]
+
+    def trucks(self, truck_ids):
+        """
+        FoodTruck instances of the given trucks, in order, with only their id
+        and coordinates loaded, like `.only("id", "latitude", "longitude")`.
+        """
+        db = router.db_for_read(FoodTruck)
+        latitudes = self.ranker.latitudes
+        longitudes = self.ranker.longitudes
+        return [
+            FoodTruck.from_db(
+                db,
+                ["id", "latitude", "longitude"],
+                (truck_id, float(latitudes[position]), float(longitudes[position])),
+            )
+            for truck_id, position in zip(truck_ids, self.positions(truck_ids))
+            if position is not None
+        ]
+
+    def has_fields(self, fields):
+        return all(name in self._columns for name in fields)
+
+    def fragments(self, truck_ids, fields):
+        """
+        Return {truck_id: JSON fragment} for the trucks of the snapshot among
+        `truck_ids`, restricted to `fields`, as `TruckFragmentCache.render`
+        would render them.
+        """
+        columns = [self._columns[name] for name in fields]
+        width = len(self.fields)
+        fragments = {}
+        for truck_id, position in zip(truck_ids, self.positions(truck_ids)):
+            if position is None:
+                continue
+            bounds = self.value_offsets[
+                position * width : (position + 1) * width + 1
+            ].tolist()
+            encoded = self.values[bounds[0] : bounds[-1]].tobytes()
+            fragments[truck_id] = (
+                "{"
+                + ",".join(
+                    self._keys[column]
+                    + encoded[
+                        bounds[column] - bounds[0] : bounds[column + 1] - bounds[0]
+                    ].decode("utf-8")
+                    for column in columns
+                )
+                + "}"
+            )
+        return fragments
+
+
+def write_truck_snapshot(file_path=None):
+    """
+    Write the snapshot of the current trucks to `file_path`, TRUCK_SNAPSHOT_PATH
+    by default, and return it. The file is written under a temporary name in
+    the same directory and renamed over the previous snapshot, so workers never
+    map a partial file.
+    """
+    # Imported here, both read from the snapshot
+    from .open_hours import week_boundaries
+    from .serializers import truck_fragments
+
+    file_path = file_path or settings.TRUCK_SNAPSHOT_PATH
+    dataset_version = get_dataset_version()
+    fields = truck_fragments.field_names
+    ids = []
+    latitudes = []
+    longitudes = []
+    bitmaps = []
+    value_offsets = [0]
+    values = bytearray()
+    rows = (
+        FoodTruck.objects.order_by("id")
+        .values(
+            *dict.fromkeys(
+                ["id", "latitude", "longitude", "open_hours_bitmap", *fields]
+            )
+        )
+        .iterator(chunk_size=2000)
+    )
+    for row in rows:
+        ids.append(row["id"])
+        latitudes.append(row["latitude"])
+        longitudes.append(row["longitude"])
+        bitmaps.append(row["open_hours_bitmap"])
+        for name in fields:
+            values += truck_fragments.encode_value(name, row[name]).encode("utf-8")
+            value_offsets.append(len(values))
+
+    ranker = HaversineRanker(ids, latitudes, longitudes)
+    bitmaps = stack_week_bitmaps(bitmaps)
+    sections = {
+        "ids": ranker.ids,
+        "latitudes": ranker.latitudes,
+        "longitudes": ranker.longitudes,
+        "lat_radians": ranker.lat_radians,
+        "long_radians": ranker.long_radians,
+        "cos_lat": ranker.cos_lat,
+        "bitmaps": bitmaps,
+        "boundaries": np.array(week_boundaries(bitmaps), dtype=np.int64),
+        "value_offsets": np.array(value_offsets, dtype=np.int64),
+        "values": np.frombuffer(bytes(values), dtype=np.uint8),
+    }
+
+    descriptor, temporary_path = tempfile.mkstemp(
+        prefix=".trucks-", dir=os.path.dirname(os.path.abspath(file_path))
+    )
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(bytes(ALIGNMENT))
+            layout = {}
+            for name, array in sections.items():
+                array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+                layout[name] = [file.tell(), array.dtype.str, list(array.shape)]
+                file.write(array.tobytes())
+                file.write(bytes(-file.tell() % ALIGNMENT))
+            metadata = json.dumps(
+                {
+                    "dataset_version": dataset_version,
+                    "fields": fields,
+                    "sections": layout,
+                }
+            ).encode("utf-8")
+            metadata_offset = file.tell()
+            file.write(metadata)
+            file.seek(0)
+            file.write(
+                HEADER.pack(MAGIC, FORMAT_VERSION, metadata_offset, len(metadata))
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    invalidate_truck_snapshot()
+    return TruckSnapshot.open(file_path)
+
+
+def discard_truck_snapshot(**kwargs):
+    """
+    Delete the snapshot, e.g. after a truck was edited in place, so that
+    workers use the database until the next load. Also usable as a signal
+    receiver.
+    """
+    if settings.TRUCK_SNAPSHOT_ENABLED:
+        try:
+            os.remove(settings.TRUCK_SNAPSHOT_PATH)
+        except FileNotFoundError:
+            pass
+    invalidate_truck_snapshot()
+
+
+def refresh_truck_snapshot():
+    """
+    Rewrite the snapshot after trucks were edited in place, when there is one.
+    Workers swap the new file in on their next check, and keep using the
+    previous one meanwhile instead of falling back to the database.
+    """
+    if settings.TRUCK_SNAPSHOT_ENABLED and os.path.exists(settings.TRUCK_SNAPSHOT_PATH):
+        write_truck_snapshot()
+
+
+def _open_truck_snapshot():
+    # False rather than None when there is no usable snapshot, so that it is
+    # not looked for again on every request
+    if not settings.TRUCK_SNAPSHOT_ENABLED:
+        return False
+    try:
+        snapshot = TruckSnapshot.open(settings.TRUCK_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError):
+        logger.warning(
+            "Unreadable truck snapshot %s", settings.TRUCK_SNAPSHOT_PATH, exc_info=True
+        )
+        return False
+    # Left by an older load, the trucks have changed since
+    if snapshot.dataset_version != get_dataset_version():
+        return False
+    return snapshot
+
+
+def _snapshot_fingerprint():
+    # A new snapshot is a new file (see `write_truck_snapshot`)
+    try:
+        stat = os.stat(settings.TRUCK_SNAPSHOT_PATH)
+        file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        file_id = None
+    return (
+        get_dataset_version(),
+        settings.TRUCK_SNAPSHOT_ENABLED,
+        settings.TRUCK_SNAPSHOT_PATH,
+        file_id,
+    )
+
+
+_truck_snapshot = ProcessWideCache(_open_truck_snapshot, _snapshot_fingerprint)
+
+
+def get_truck_snapshot():
+    """
+    Return the memory-mapped snapshot of the current dataset version, or None
+    when there is none. A newer snapshot is noticed within
+    TRUCK_INDEX_REFRESH_SECONDS and swapped in; requests still using the
+    previous one keep their mapping.
+    """
+    return _truck_snapshot.get() or None
+
+
+def invalidate_truck_snapshot(**kwargs):
+    _truck_snapshot.invalidate()
@@ -1,6 +1,28 @@
 from django.urls import path
-from .views import FoodTruckListView
+from .views import (
+    AsyncFoodTruckListView,
+    FoodTruckBatchView,
+    FoodTruckListView,
+    RequestMetricsView,
+    ResponseCacheStatsView,
+)
 
 urlpatterns = [
     path("food-trucks/", FoodTruckListView.as_view(), name="food-truck-list"),
+    path(
+        "food-trucks/async/",
+        AsyncFoodTruckListView.as_view(),
+        name="food-truck-list-async",
+    ),
+    path("food-trucks/batch/", FoodTruckBatchView.as_view(), name="food-truck-batch"),
+    path(
+        "food-trucks/cache-stats/",
+        ResponseCacheStatsView.as_view(),
+        name="food-truck-cache-stats",
+    ),
+    path(
+        "food-trucks/metrics/",
+        RequestMetricsView.as_view(),
+        name="food-truck-metrics",
+    ),
 ]
@@ -1,101 +1,638 @@
-from django.contrib.gis.measure import Distance, D
-from geopy.distance import distance
-from .models import FoodTruck, FoodTruckOperatingHour
-from food_trucks_locator.settings import gmaps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from .answer_grid import get_answer_grid
+from .models import FoodTruck
+from .open_hours import get_open_hours_index
+from .profiling import stage
+from .spatial_index import get_truck_index, nearest_from_database
+from .street_graph import get_street_graph
+from .truck_snapshot import get_truck_snapshot
+from .walking_time import (
+    get_walking_time_provider,
+    is_reachable,
+    offline_walking_time_provider,
+    serving_estimates,
+    walking_time_cache,
+    wrap_element,
+)
 from datetime import datetime
-import pytz
-from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def calculate_straight_distance_between_two_points(lat_1, long_1, lat_2, long_2):
     """
     Calculate the straight-line distance between two points.
     """
+    # Only the legacy per-row ranking benchmark uses it, geopy and GeoDjango
+    # are slow to import
+    from django.contrib.gis.measure import Distance
+    from geopy.distance import distance
+
     return Distance(m=distance((lat_1, long_1), (lat_2, long_2)).meters)
 
 
-def get_top_ten_closet_trucks_by_straight_distance(lat, long, user_time, user_timezone):
+def parse_user_datetime(user_time, user_timezone):
+    """
+    Localize a user time to the specified timezone and convert it to UTC.
+    This is necessary for time comparison in a standardized format.
+    """
+    import pytz
+
+    try:
+        user_timezone_aware = pytz.timezone(user_timezone).localize(
+            datetime.strptime(user_time, "%Y-%m-%dT%H:%M")
+        )
+        return user_timezone_aware.astimezone(pytz.utc)
+    except Exception as e:
+        raise ValueError("Invalid time or timezone.") from e
+
+
+def get_eligible_truck_ids(user_time, user_timezone, open_within=None):
+    """
+    Ids of the trucks open at the user time, or opening within `open_within`
+    minutes of it. None when no time is given, since every truck is eligible.
+    """
+    if not user_time:
+        return None
+    user_datetime = parse_user_datetime(user_time, user_timezone)
+    with stage("open_hours"):
+        if open_within is None:
+            return get_open_hours_index().open_truck_ids(user_datetime)
+        return get_open_hours_index().open_within_truck_ids(user_datetime, open_within)
+
+
+def load_candidate_trucks(truck_ids):
+    """
+    Load trucks in the given order, with only what the walking time ranking
+    needs. Details are serialized separately.
+    """
+    snapshot = get_truck_snapshot()
+    if snapshot is not None:
+        return snapshot.trucks(truck_ids)
+    trucks = FoodTruck.objects.only("id", "latitude", "longitude").in_bulk(truck_ids)
+    return [trucks[truck_id] for truck_id in truck_ids if truck_id in trucks]
+
+
+def nearest_from_source(lat, long, k, allowed_ids=None, mask=None):
     """
-    Get the top 10 closest trucks by straight-line distance.
-    Considers truck's open status if user_time is provided.
+    Query the straight-line candidates from NEAREST_TRUCKS_SOURCE, as
+    (truck_id, meters) tuples. The in-memory index also takes a precomputed
+    `mask` of the allowed trucks.
     """
-    trucks_with_straight_distance = []
-    if user_time:
-        # Localize user time to the specified timezone and convert to UTC
-        # This is necessary for time comparison in a standardized format
+    exact = settings.GEODESIC_RERANK
+    if settings.NEAREST_TRUCKS_SOURCE == "spatial":
+        # Imported here, GeoDjango needs GDAL which the default mode does not
+        from .geo.queries import nearest_from_spatial_database
+
         try:
-            user_timezone_aware = pytz.timezone(user_timezone).localize(
-                datetime.strptime(user_time, "%Y-%m-%dT%H:%M")
+            return nearest_from_spatial_database(
+                lat, long, k=k, allowed_ids=allowed_ids, exact=exact
             )
-            user_datetime = user_timezone_aware.astimezone(pytz.utc)
-        except Exception as e:
-            raise ValueError("Invalid time or timezone.") from e
-
-        # Loop through all FoodTruck objects
-        for truck in FoodTruck.objects.all():
-            # If user time is provided, check if the truck is open at that time
-            if is_truck_open_now(truck, user_datetime):
-                trucks_with_straight_distance.append(
+        except DatabaseError:
+            # e.g. the spatial migration was not applied, the in-memory index
+            # gives the same answer
+            logger.warning("Spatial query failed, using the truck index", exc_info=True)
+    if settings.NEAREST_TRUCKS_SOURCE == "database":
+        return nearest_from_database(
+            lat, long, k=k, allowed_ids=allowed_ids, exact=exact
+        )
+    if mask is not None:
+        return get_truck_index().nearest(lat, long, k=k, mask=mask, exact=exact)
+    return get_truck_index().nearest(
+        lat, long, k=k, allowed_ids=allowed_ids, exact=exact
+    )
+
+
+def get_top_ten_closet_trucks_by_straight_distance(
+    lat, long, user_time, user_timezone, k=None, open_within=None
+):
+    """
+    Get the top `k` (10 by default) closest trucks by straight-line distance.
+    Considers truck's open status if user_time is provided, or trucks opening
+    within `open_within` minutes of it.
+    """
+    if k is None:
+        k = settings.NEAREST_TRUCKS_K
+
+    # Only trucks open at the user time (or soon after it) are eligible
+    allowed_ids = get_eligible_truck_ids(user_time, user_timezone, open_within)
+
+    nearest = get_nearest_trucks(lat, long, k, allowed_ids)
+    return load_candidate_trucks([truck_id for truck_id, _ in nearest])
+
+
+def get_nearest_trucks(lat, long, k, allowed_ids=None):
+    """
+    The `k` closest eligible trucks by straight-line distance, nearest first,
+    as (truck_id, meters) tuples.
+    """
+    # Points of a precomputed cell are answered from its candidates, the
+    # others query NEAREST_TRUCKS_SOURCE instead of scanning every truck
+    nearest = None
+    if settings.ANSWER_GRID_ENABLED:
+        nearest = get_answer_grid().nearest(
+            lat, long, k=k, allowed_ids=allowed_ids, exact=settings.GEODESIC_RERANK
+        )
+    if nearest is None:
+        nearest = nearest_from_source(lat, long, k, allowed_ids=allowed_ids)
+    return nearest
+
+
+def get_top_ten_closet_trucks_for_points(points, k=None):
+    """
+    Batch variant of `get_top_ten_closet_trucks_by_straight_distance` for
+    (lat, long, user_time, user_timezone, open_within) points. The eligible
+    trucks are computed once per distinct time filter and the candidates of
+    every point are loaded with a single query.
+
+    Returns a list with, for each point, its candidate trucks or the
+    ValueError raised for its time filter.
+    """
+    if k is None:
+        k = settings.NEAREST_TRUCKS_K
+    # Masks over the in-memory index are only worth it when it is queried
+    index = get_truck_index() if settings.NEAREST_TRUCKS_SOURCE == "index" else None
+    grid = get_answer_grid() if settings.ANSWER_GRID_ENABLED else None
+
+    filters = {}
+    nearest_ids = []
+    for lat, long, user_time, user_timezone, open_within in points:
+        time_filter = (user_time, user_timezone, open_within)
+        if time_filter not in filters:
+            try:
+                allowed_ids = get_eligible_truck_ids(*time_filter)
+                filters[time_filter] = (
+                    allowed_ids,
                     (
-                        truck,
-                        calculate_straight_distance_between_two_points(
-                            lat,
-                            long,
-                            float(truck.latitude),
-                            float(truck.longitude),
-                        ),
-                    )
-                )
-    else:
-        for truck in FoodTruck.objects.all():
-            trucks_with_straight_distance.append(
-                (
-                    truck,
-                    calculate_straight_distance_between_two_points(
-                        lat,
-                        long,
-                        float(truck.latitude),
-                        float(truck.longitude),
+                        None
+                        if allowed_ids is None or index is None
+                        else index.mask_for(allowed_ids)
                     ),
                 )
+            except ValueError as e:
+                filters[time_filter] = e
+        if isinstance(filters[time_filter], ValueError):
+            nearest_ids.append(filters[time_filter])
+            continue
+        allowed_ids, mask = filters[time_filter]
+        nearest = None
+        if grid is not None:
+            nearest = grid.nearest(
+                lat,
+                long,
+                k=k,
+                allowed_ids=allowed_ids,
+                exact=settings.GEODESIC_RERANK,
             )
+        if nearest is None:
+            nearest = nearest_from_source(
+                lat, long, k, allowed_ids=allowed_ids, mask=mask
+            )
+        nearest_ids.append([truck_id for truck_id, _ in nearest])
 
-    # Sort the list of trucks by their calculated straight-line distance
-    trucks_with_straight_distance.sort(key=lambda x: x[1])
-    # Return the top 10 closest trucks
-    return [t[0] for t in trucks_with_straight_distance[:10]]
+    trucks = {
+        truck.id: truck
+        for truck in load_candidate_trucks(
+            list(
+                {
+                    truck_id
+                    for ids in nearest_ids
+                    if not isinstance(ids, ValueError)
+                    for truck_id in ids
+                }
+            )
+        )
+    }
+    return [
+        (
+            ids
+            if isinstance(ids, ValueError)
+            else [trucks[truck_id] for truck_id in ids if truck_id in trucks]
+        )
+        for ids in nearest_ids
+    ]
 
 
 def get_walking_time_data(truck, lat, long):
     """
-    Fetches walking time data from Google Maps API for a specific truck.
+    Fetches walking time data for a specific truck, an offline estimate when
+    the provider is unavailable.
     """
-    try:
-        # Perform a request to Google Maps API for walking directions
-        # and return the response along with truck details
-        return {
-            "truck_details": truck,
-            "gmaps_response": gmaps.distance_matrix(
-                (lat, long), (truck.latitude, truck.longitude), mode="walking"
+    element = get_walking_time_elements(lat, long, [truck])[truck.id]
+    return {"truck_details": truck, "gmaps_response": wrap_element(element)}
+
+
+def estimate_walking_elements(lat, long, trucks):
+    """
+    Return a {truck_id: element} dict of offline walking time estimates, used
+    when the provider is unavailable. Marks the response being cached as built
+    from estimates so that it is not stored.
+    """
+    # Only inside `response_cache._compute`, which resets the flag, so that
+    # it does not outlive the response on the worker thread
+    if serving_estimates.get() is not None:
+        serving_estimates.set(True)
+    return dict(
+        zip(
+            [truck.id for truck in trucks],
+            offline_walking_time_provider.get_elements(
+                lat, long, [(truck.latitude, truck.longitude) for truck in trucks]
             ),
-        }
-    except Exception as e:
-        # Raise an error if there's an issue with the API call
-        raise ConnectionError("Error connecting to Google Maps API.") from e
+        )
+    )
+
+
+def prefilter_by_walking_estimate(lat, long, trucks):
+    """
+    Keep the WALKING_TIME_PREFILTER_K trucks with the shortest walk on the
+    street graph, in their original order, so that fewer destinations are sent
+    to the provider. Every truck is kept when no street graph was imported.
+    """
+    k = settings.WALKING_TIME_PREFILTER_K
+    if k <= 0 or len(trucks) <= k or get_street_graph() is None:
+        return trucks
+    elements = offline_walking_time_provider.get_elements(
+        lat, long, [(truck.latitude, truck.longitude) for truck in trucks]
+    )
+    order = sorted(range(len(trucks)), key=lambda i: elements[i]["duration"]["value"])
+    kept = set(order[:k])
+    return [truck for i, truck in enumerate(trucks) if i in kept]
+
+
+def get_walking_time_elements(lat, long, trucks):
+    """
+    Return a {truck_id: Distance Matrix element} dict for walking from the
+    origin to each truck.
+    """
+    # Walking times already known for the origin's cell are served from the cache
+    elements = walking_time_cache.get_many(lat, long, [truck.id for truck in trucks])
+    missing_trucks = [truck for truck in trucks if truck.id not in elements]
+
+    if missing_trucks:
+        elements.update(fetch_walking_time_elements(lat, long, missing_trucks))
+
+    return elements
+
+
+def fetch_walking_time_elements(lat, long, trucks):
+    """
+    Look up the walking times to trucks missing from the walking time cache
+    and store them there. Returns a {truck_id: element} dict, of offline
+    estimates when the provider is unavailable.
+    """
+    # A single batched request covers every truck
+    try:
+        fetched = dict(
+            zip(
+                [truck.id for truck in trucks],
+                get_walking_time_provider().get_elements(
+                    lat, long, [(truck.latitude, truck.longitude) for truck in trucks]
+                ),
+            )
+        )
+    except ConnectionError:
+        if not settings.WALKING_TIME_OFFLINE_FALLBACK:
+            raise
+        logger.warning(
+            "Walking time provider unavailable, serving offline estimates",
+            exc_info=True,
+        )
+        # Estimates are not stored in the walking time cache
+        return estimate_walking_elements(lat, long, trucks)
+    walking_time_cache.set_many(lat, long, fetched)
+    return fetched
 
 
 def get_top_five_closet_trucks_by_walking_time(lat, long, trucks):
     """
     Determines the top 5 closest food trucks based on walking time.
     """
-    # Use a thread pool to make concurrent API calls for each truck
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(get_walking_time_data, truck, lat, long) for truck in trucks
+    trucks = prefilter_by_walking_estimate(lat, long, trucks)
+    return rank_trucks_by_walking_time(
+        trucks, get_walking_time_elements(lat, long, trucks)
+    )
+
+
+def get_top_five_closet_trucks_for_origins(origins):
+    """
+    Batch variant of `get_top_five_closet_trucks_by_walking_time` for
+    (lat, long, trucks) origins. Origins sharing a walking time cache cell
+    share their lookups, so each (cell, truck) pair is fetched at most once.
+
+    Returns a list with, for each origin, its top 5 or the KeyError raised
+    while ranking it.
+    """
+    origins = [
+        (lat, long, prefilter_by_walking_estimate(lat, long, trucks))
+        for lat, long, trucks in origins
+    ]
+    cells = {}
+    for lat, long, trucks in origins:
+        cell = walking_time_cache.cell_for(lat, long)
+        # The first origin of a cell stands for the others
+        _, _, cell_trucks = cells.setdefault(cell, (lat, long, {}))
+        cell_trucks.update((truck.id, truck) for truck in trucks)
+
+    elements_by_cell = {
+        cell: get_walking_time_elements(lat, long, list(trucks.values()))
+        for cell, (lat, long, trucks) in cells.items()
+    }
+    results = []
+    for lat, long, trucks in origins:
+        try:
+            results.append(
+                rank_trucks_by_walking_time(
+                    trucks, elements_by_cell[walking_time_cache.cell_for(lat, long)]
+                )
+            )
+        except KeyError as e:
+            # No walking route to any truck, only this origin fails
+            results.append(e)
+    return results
+
+
+async def get_top_five_closet_trucks_by_walking_time_async(lat, long, trucks):
+    """
+    Async variant of `get_top_five_closet_trucks_by_walking_time`. Trucks whose
+    walking time could not be fetched before the deadline get an offline
+    estimate, or are left out when WALKING_TIME_OFFLINE_FALLBACK is disabled.
+    """
+    trucks = await sync_to_async(prefilter_by_walking_estimate)(lat, long, trucks)
+    elements = await sync_to_async(walking_time_cache.get_many)(
+        lat, long, [truck.id for truck in trucks]
+    )
+    missing_trucks = [truck for truck in trucks if truck.id not in elements]
+
+    if missing_trucks:
+        elements.update(
+            await fetch_walking_time_elements_async(lat, long, missing_trucks)
+        )
+
+    return rank_trucks_by_walking_time(
+        [truck for truck in trucks if truck.id in elements], elements
+    )
+
+
+async def fetch_walking_time_elements_async(lat, long, trucks):
+    """
+    Async variant of `fetch_walking_time_elements`. Trucks whose walking time
+    could not be fetched before the deadline get an offline estimate, or are
+    left out of the dict when WALKING_TIME_OFFLINE_FALLBACK is disabled.
+    """
+    try:
+        fetched_elements = await get_walking_time_provider().get_elements_async(
+            lat, long, [(truck.latitude, truck.longitude) for truck in trucks]
+        )
+    except ConnectionError:
+        if not settings.WALKING_TIME_OFFLINE_FALLBACK:
+            raise
+        logger.warning(
+            "Walking time provider unavailable, serving offline estimates",
+            exc_info=True,
+        )
+        fetched_elements = [None] * len(trucks)
+    fetched = {
+        truck.id: element
+        for truck, element in zip(trucks, fetched_elements)
+        if element is not None
+    }
+    await sync_to_async(walking_time_cache.set_many)(lat, long, fetched)
+
+    unanswered = [truck for truck in trucks if truck.id not in fetched]
+    if unanswered and settings.WALKING_TIME_OFFLINE_FALLBACK:
+        fetched.update(
+            await sync_to_async(estimate_walking_elements)(lat, long, unanswered)
+        )
+    return fetched
+
+
+class AdaptiveWalkingSearch:
+    """
+    Top 5 trucks by walking time, asking for as few walking times as possible.
+
+    Nobody walks faster than WALKING_TIME_MAX_SPEED, so a truck `meters` away
+    in a straight line is at least meters / WALKING_TIME_MAX_SPEED seconds away.
+    When a street graph was imported, the walk along its streets gives a
+    tighter bound. Candidates are looked up by increasing bound: first as many
+    as the fixed candidates (NEAREST_TRUCKS_K), or the WALKING_TIME_PREFILTER_K
+    best ones on the street graph, so that a cold query usually takes a single
+    round, then rounds of at most WALKING_TIME_ROUND_SIZE trucks that could
+    still beat the 5th, until the 5th quickest walk found is no longer than the
+    lower bound of every truck not looked up. When the candidates run out
+    first, their number is doubled, up to WALKING_TIME_MAX_CANDIDATES, so that
+    a truck far behind a hill or a freeway does not push out a quicker one.
+
+    `next_round` and `add` are driven by a sync or an async loop, see
+    `get_top_five_closet_trucks_adaptive`.
+    """
+
+    top = 5
+
+    def __init__(self, lat, long, allowed_ids):
+        self.lat = lat
+        self.long = long
+        self.allowed_ids = allowed_ids
+        self.k = 0
+        # (truck, meters) of the straight-line candidates, nearest first
+        self.candidates = []
+        # Whether every eligible truck is a candidate
+        self.exhausted = False
+        self.trucks = {}
+        self.elements = {}
+        self.looked_up = set()
+        # Walking distances of the candidates on the street graph, if any
+        self.street_meters = {}
+
+    def lower_bound(self, meters, truck_id=None):
+        street_meters = self.street_meters.get(truck_id)
+        if street_meters is not None:
+            meters = max(meters, street_meters)
+        return meters / settings.WALKING_TIME_MAX_SPEED
+
+    def first_round_size(self):
+        size = settings.NEAREST_TRUCKS_K
+        if self.street_meters and settings.WALKING_TIME_PREFILTER_K > 0:
+            size = min(size, settings.WALKING_TIME_PREFILTER_K)
+        return max(self.top, size)
+
+    def quickest(self):
+        """
+        Duration of the 5th quickest walk found so far, None before 5 are known.
+        """
+        durations = sorted(
+            self.elements[truck.id]["duration"]["value"]
+            for truck, _ in self.candidates
+            if truck.id in self.elements and is_reachable(self.elements[truck.id])
+        )
+        return durations[self.top - 1] if len(durations) >= self.top else None
+
+    def widen(self):
+        """
+        Query twice as many straight-line candidates (NEAREST_TRUCKS_K at
+        first), walk to them on the street graph if any, and serve those
+        already in the walking time cache.
+        """
+        self.k = (
+            min(self.k * 2, settings.WALKING_TIME_MAX_CANDIDATES)
+            if self.k
+            else settings.NEAREST_TRUCKS_K
+        )
+        with stage("straight_distance"):
+            nearest = get_nearest_trucks(self.lat, self.long, self.k, self.allowed_ids)
+            self.exhausted = len(nearest) < self.k
+            new_ids = [
+                truck_id for truck_id, _ in nearest if truck_id not in self.trucks
+            ]
+            self.trucks.update(
+                (truck.id, truck) for truck in load_candidate_trucks(new_ids)
+            )
+        self.candidates = [
+            (self.trucks[truck_id], meters)
+            for truck_id, meters in nearest
+            if truck_id in self.trucks
         ]
-        # Retrieve the results from all the futures
-        results = [future.result() for future in futures]
+        graph = get_street_graph()
+        if graph is not None and len(graph) and new_ids:
+            new_trucks = [self.trucks[truck_id] for truck_id in new_ids]
+            with stage("walking_time"):
+                self.street_meters.update(
+                    zip(
+                        new_ids,
+                        graph.walking_meters(
+                            self.lat,
+                            self.long,
+                            [
+                                (float(truck.latitude), float(truck.longitude))
+                                for truck in new_trucks
+                            ],
+                        ),
+                    )
+                )
+        cached = walking_time_cache.get_many(self.lat, self.long, new_ids)
+        self.elements.update(cached)
+        self.looked_up.update(cached)
+
+    def next_round(self):
+        """
+        Trucks whose walking time to look up next, by increasing lower bound,
+        or None once the top 5 is known.
+        """
+        while True:
+            fifth = self.quickest()
+            bounds = sorted(
+                (self.lower_bound(meters, truck.id), position, truck)
+                for position, (truck, meters) in enumerate(self.candidates)
+                if truck.id not in self.looked_up
+            )
+            pending = [
+                truck for bound, _, truck in bounds if fifth is None or bound < fifth
+            ]
+            if pending:
+                size = (
+                    self.first_round_size()
+                    if fifth is None
+                    else settings.WALKING_TIME_ROUND_SIZE
+                )
+                return pending[:size]
+
+            # Trucks beyond the candidates are at least as far as the last one
+            if self.exhausted or (
+                fifth is not None
+                and self.candidates
+                and fifth <= self.lower_bound(self.candidates[-1][1])
+            ):
+                return None
+            if self.k >= settings.WALKING_TIME_MAX_CANDIDATES:
+                logger.info(
+                    "Stopped widening at %s candidates for (%s, %s)",
+                    self.k,
+                    self.lat,
+                    self.long,
+                )
+                return None
+            self.widen()
+
+    def add(self, trucks, elements):
+        """
+        Record the looked up trucks and their {truck_id: element} walking times.
+        Trucks missing from `elements` are left out of the ranking.
+        """
+        self.looked_up.update(truck.id for truck in trucks)
+        self.elements.update(elements)
+
+    def ranking(self):
+        return rank_trucks_by_walking_time(
+            [truck for truck, _ in self.candidates if truck.id in self.elements],
+            self.elements,
+        )
+
 
+def get_top_five_closet_trucks_adaptive(
+    lat, long, user_time, user_timezone, open_within=None
+):
+    """
+    Top 5 closest trucks by walking time, among the trucks open at the user
+    time (or opening within `open_within` minutes) if given. Walking times are
+    looked up nearest first and only as far as needed, see
+    `AdaptiveWalkingSearch`.
+    """
+    search = AdaptiveWalkingSearch(
+        lat, long, get_eligible_truck_ids(user_time, user_timezone, open_within)
+    )
+    while True:
+        trucks = search.next_round()
+        if trucks is None:
+            return search.ranking()
+        with stage("walking_time"):
+            if serving_estimates.get():
+                # The provider already failed for this response
+                elements = estimate_walking_elements(lat, long, trucks)
+            else:
+                elements = fetch_walking_time_elements(lat, long, trucks)
+        search.add(trucks, elements)
+
+
+async def get_top_five_closet_trucks_adaptive_async(
+    lat, long, user_time, user_timezone, open_within=None
+):
+    """
+    Async variant of `get_top_five_closet_trucks_adaptive`.
+    """
+    allowed_ids = await sync_to_async(get_eligible_truck_ids)(
+        user_time, user_timezone, open_within
+    )
+    search = AdaptiveWalkingSearch(lat, long, allowed_ids)
+    while True:
+        trucks = await sync_to_async(search.next_round)()
+        if trucks is None:
+            return search.ranking()
+        with stage("walking_time"):
+            if serving_estimates.get():
+                elements = await sync_to_async(estimate_walking_elements)(
+                    lat, long, trucks
+                )
+            else:
+                elements = await fetch_walking_time_elements_async(lat, long, trucks)
+        search.add(trucks, elements)
+
+
+def rank_trucks_by_walking_time(trucks, elements):
+    """
+    Pair each truck with its Distance Matrix element and return the 5 quickest
+    to walk to. Trucks no walking route reaches are left out; a KeyError is
+    raised when no truck can be reached.
+    """
+    results = [
+        {"truck_details": truck, "gmaps_response": wrap_element(elements[truck.id])}
+        for truck in trucks
+        if is_reachable(elements[truck.id])
+    ]
+    if trucks and not results:
+        # Reported like a missing walking time, e.g. for an origin off the streets
+        raise KeyError("duration")
     # Sort the results based on walking duration and return the top 5
     results.sort(
         key=lambda x: x["gmaps_response"]["rows"][0]["elements"][0]["duration"]["value"]
@@ -107,15 +644,4 @@ def is_truck_open_now(truck, user_datetime):
     """
     Check if the truck is open at the given datetime.
     """
-    user_day = user_datetime.strftime("%A")
-    user_time = user_datetime.time()
-    # Filter the operating hours for the truck based on the day of the week
-    operating_hours = FoodTruckOperatingHour.objects.filter(
-        food_truck=truck, day=user_day
-    )
-
-    for hours in operating_hours:
-        if hours.open_time <= user_time <= hours.close_time:
-            # Check if current time falls within any of the operating hours
-            return True
-    return False
+    return get_open_hours_index().is_open(truck.id, user_datetime)
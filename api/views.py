@@ -1,13 +1,112 @@
+import json
+import math
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .serializers import FoodTruckSerializer
+from .serializers import truck_fragments
+from .walking_time import get_walking_time_provider, peek_google_client
 import api.utils as utils
+import api.profiling as profiling
+import api.response_cache as response_cache
 from rest_framework import status
 from rest_framework.throttling import AnonRateThrottle
-from django.core.cache import cache
-from food_trucks_locator.settings import CACHE_TIMEOUT
+import logging
 import traceback
 
+logger = logging.getLogger(__name__)
+
+# Longest window accepted by the `open_within` parameter: a week
+MAX_OPEN_WITHIN_MINUTES = 7 * 24 * 60
+
+
+def build_response(top_five_closet_trucks_by_walking_time, fields=None):
+    """
+    Render the walking time results into the endpoint's JSON payload, from the
+    pre-rendered truck details restricted to `fields`.
+    """
+    fragments = truck_fragments.get_many(
+        [truck["truck_details"].id for truck in top_five_closet_trucks_by_walking_time],
+        fields,
+    )
+    items = []
+    for truck in top_five_closet_trucks_by_walking_time:
+        element = truck["gmaps_response"]["rows"][0]["elements"][0]
+        items.append(
+            '{"distance":%s,"duration":%s,"truck_details":%s}'
+            % (
+                json.dumps(element["distance"]["text"], ensure_ascii=False),
+                json.dumps(element["duration"]["text"], ensure_ascii=False),
+                fragments[truck["truck_details"].id],
+            )
+        )
+    return "[" + ",".join(items) + "]"
+
+
+def parse_fields(fields):
+    """
+    Parse the comma separated `fields` query parameter, None for every field.
+    Raises ValueError on unknown field names.
+    """
+    if fields is None:
+        return None
+    return truck_fragments.normalize_fields(
+        [name.strip() for name in fields.split(",") if name.strip()]
+    )
+
+
+def parse_location_query(params):
+    """
+    Validate the parameters of a query, from the query string or a point of a
+    batch request, returning its (latitude, longitude, time, timezone,
+    open_within). Raises ValueError with the message to report.
+    """
+    latitude = params.get("latitude")
+    longitude = params.get("longitude")
+    user_time = params.get("time")  # Format: "YYYY-MM-DDTHH:MM"
+    user_timezone = params.get("timezone")
+    open_within = params.get("open_within")  # In minutes
+
+    # Validate latitude and longitude
+    if latitude in (None, "") or longitude in (None, ""):
+        raise ValueError("Latitude and longitude parameters are required.")
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid latitude or longitude values.")
+    if not (math.isfinite(latitude) and math.isfinite(longitude)):
+        raise ValueError("Invalid latitude or longitude values.")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError(
+            "Latitude must be between -90 and 90, "
+            "and longitude between -180 and 180."
+        )
+
+    # Validate time and timezone
+    if user_time and not user_timezone:
+        raise ValueError("When time is provided, timezone also should be provided.")
+
+    # Validate the window for trucks opening soon
+    if open_within is not None:
+        if not user_time:
+            raise ValueError(
+                "When open_within is provided, time also should be provided."
+            )
+        try:
+            open_within = int(open_within)
+        except (TypeError, ValueError):
+            open_within = -1
+        if not 0 <= open_within <= MAX_OPEN_WITHIN_MINUTES:
+            raise ValueError(
+                "open_within must be a number of minutes "
+                f"between 0 and {MAX_OPEN_WITHIN_MINUTES}."
+            )
+
+    return latitude, longitude, user_time or None, user_timezone, open_within
+
 
 class FoodTruckListView(APIView):
     throttle_classes = [AnonRateThrottle]
@@ -15,93 +114,316 @@ class FoodTruckListView(APIView):
     def get(self, request):
         """
         Returns the top 5 closest trucks to a given `latitude` and `longitude` by walking time.
-        Optionally returning only opened trucks if `time` and `timezone` are provided
+        Optionally returning only opened trucks if `time` and `timezone` are provided,
+        or trucks open at some point in the `open_within` minutes following `time`
         """
-        latitude = request.query_params.get("latitude")
-        longitude = request.query_params.get("longitude")
-        user_time = request.query_params.get("time")  # Format: "YYYY-MM-DDTHH:MM"
-        user_timezone = request.query_params.get("timezone")
+        try:
+            latitude, longitude, user_time, user_timezone, open_within = (
+                parse_location_query(request.query_params)
+            )
+            # Comma separated truck detail fields
+            fields = parse_fields(request.query_params.get("fields"))
+        except ValueError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        def compute_response():
+            if settings.WALKING_TIME_ADAPTIVE:
+                # Walking times are looked up nearest first, only as far as needed
+                top_five_closet_trucks_by_walking_time = (
+                    utils.get_top_five_closet_trucks_adaptive(
+                        latitude,
+                        longitude,
+                        user_time,
+                        user_timezone,
+                        open_within=open_within,
+                    )
+                )
+                with profiling.stage("serialization"):
+                    return build_response(
+                        top_five_closet_trucks_by_walking_time, fields
+                    )
 
-        # Create a unique cache key
-        cache_key = f"food_trucks_{latitude}_{longitude}_{user_time}_{user_timezone}"
-        cached_response = cache.get(cache_key)
+            # Get the top 10 closest trucks by straight-line distance
+            with profiling.stage("straight_distance"):
+                top_ten_closet_trucks_by_straight_distance = (
+                    utils.get_top_ten_closet_trucks_by_straight_distance(
+                        latitude,
+                        longitude,
+                        user_time,
+                        user_timezone,
+                        open_within=open_within,
+                    )
+                )
 
-        if cached_response:
-            return Response(cached_response)
+            # From these, get the top 5 closest trucks by walking time using Google Maps API
+            with profiling.stage("walking_time"):
+                top_five_closet_trucks_by_walking_time = (
+                    utils.get_top_five_closet_trucks_by_walking_time(
+                        latitude, longitude, top_ten_closet_trucks_by_straight_distance
+                    )
+                )
 
-        # Validate latitude and longitude
-        if not latitude or not longitude:
-            return Response(
-                {"message": "Latitude and longitude parameters are required."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+            with profiling.stage("serialization"):
+                return build_response(top_five_closet_trucks_by_walking_time, fields)
 
+        # Proceed if latitude and longitude are provided
         try:
-            latitude = float(latitude)
-            longitude = float(longitude)
-        except ValueError:
-            return Response(
-                {"message": "Invalid latitude or longitude values."},
-                status=status.HTTP_400_BAD_REQUEST,
+            # Nearby coordinates and equivalent times share the same cache key,
+            # and a single worker computes a missing entry
+            cache_key = response_cache.build_cache_key(
+                latitude, longitude, user_time, user_timezone, open_within, fields
             )
+            response = response_cache.get_or_compute(cache_key, compute_response)
 
-        # Validate time and timezone
-        if user_time and not user_timezone:
-            return Response(
-                {"message": "When time is provided, timezone also should be provided."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+            # The payload is already JSON, unless another renderer was negotiated
+            # (e.g. the browsable API)
+            if request.accepted_renderer.format == "json":
+                return HttpResponse(response, content_type="application/json")
+            return Response(json.loads(response))
+        except KeyError as e:
+            if str(e) == "'duration'":
+                return Response(
+                    {
+                        "message": "Could not get walking distance from the specified location"
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            # Any other missing key is reported like other errors
+            logger.exception("Could not compute the food trucks response")
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            print(traceback.format_exc())
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Proceed if latitude and longitude are provided
-        try:
-            # Get the top 10 closest trucks by straight-line distance
-            top_ten_closet_trucks_by_straight_distance = (
-                utils.get_top_ten_closet_trucks_by_straight_distance(
-                    latitude, longitude, user_time, user_timezone
+
+class AsyncFoodTruckListView(View):
+    """
+    Async variant of `FoodTruckListView`, meant to be served by an ASGI server
+    (see `food_trucks_locator/asgi.py`). Outbound walking time lookups are
+    awaited instead of blocking a worker, so one worker can keep many requests
+    in flight.
+    """
+
+    throttle_classes = [AnonRateThrottle]
+
+    async def get(self, request):
+        """
+        Returns the top 5 closest trucks to a given `latitude` and `longitude` by walking time.
+        Optionally returning only opened trucks if `time` and `timezone` are provided,
+        or trucks open at some point in the `open_within` minutes following `time`
+        """
+        for throttle in [throttle_class() for throttle_class in self.throttle_classes]:
+            if not await sync_to_async(throttle.allow_request)(request, self):
+                return JsonResponse(
+                    {"detail": "Request was throttled."},
+                    status=status.HTTP_429_TOO_MANY_REQUESTS,
                 )
+
+        try:
+            latitude, longitude, user_time, user_timezone, open_within = (
+                parse_location_query(request.GET)
             )
+            # Comma separated truck detail fields
+            fields = parse_fields(request.GET.get("fields"))
+        except ValueError as e:
+            return JsonResponse({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-            # From these, get the top 5 closest trucks by walking time using Google Maps API
-            top_five_closet_trucks_by_walking_time = (
-                utils.get_top_five_closet_trucks_by_walking_time(
-                    latitude, longitude, top_ten_closet_trucks_by_straight_distance
+        async def compute_response():
+            if settings.WALKING_TIME_ADAPTIVE:
+                top_five_closet_trucks_by_walking_time = (
+                    await utils.get_top_five_closet_trucks_adaptive_async(
+                        latitude,
+                        longitude,
+                        user_time,
+                        user_timezone,
+                        open_within=open_within,
+                    )
+                )
+                with profiling.stage("serialization"):
+                    return await sync_to_async(build_response)(
+                        top_five_closet_trucks_by_walking_time, fields
+                    )
+
+            with profiling.stage("straight_distance"):
+                top_ten_closet_trucks_by_straight_distance = await sync_to_async(
+                    utils.get_top_ten_closet_trucks_by_straight_distance
+                )(
+                    latitude,
+                    longitude,
+                    user_time,
+                    user_timezone,
+                    open_within=open_within,
                 )
-            )
 
-            # Serialize the truck details
-            serializer = FoodTruckSerializer(
-                [
-                    truck["truck_details"]
-                    for truck in top_five_closet_trucks_by_walking_time
-                ],
-                many=True,
+            with profiling.stage("walking_time"):
+                top_five_closet_trucks_by_walking_time = (
+                    await utils.get_top_five_closet_trucks_by_walking_time_async(
+                        latitude, longitude, top_ten_closet_trucks_by_straight_distance
+                    )
+                )
+
+            # Truck details missing from the fragment cache are read from the database
+            with profiling.stage("serialization"):
+                return await sync_to_async(build_response)(
+                    top_five_closet_trucks_by_walking_time, fields
+                )
+
+        try:
+            # Nearby coordinates and equivalent times share the same cache key,
+            # and a single worker computes a missing entry
+            cache_key = await sync_to_async(response_cache.build_cache_key)(
+                latitude, longitude, user_time, user_timezone, open_within, fields
             )
+            response = await response_cache.aget_or_compute(cache_key, compute_response)
 
-            response = [
-                {
-                    "distance": truck["gmaps_response"]["rows"][0]["elements"][0][
-                        "distance"
-                    ]["text"],
-                    "duration": truck["gmaps_response"]["rows"][0]["elements"][0][
-                        "duration"
-                    ]["text"],
-                    "truck_details": serializer.data[i],
-                }
-                for i, truck in enumerate(top_five_closet_trucks_by_walking_time)
-            ]
-
-            cache.set(cache_key, response, timeout=CACHE_TIMEOUT)
-
-            # Construct and return the response
-            return Response(response)
+            return HttpResponse(response, content_type="application/json")
         except KeyError as e:
             if str(e) == "'duration'":
-                return Response(
+                return JsonResponse(
                     {
                         "message": "Could not get walking distance from the specified location"
                     },
                     status=status.HTTP_400_BAD_REQUEST,
                 )
+            # Any other missing key is reported like other errors, as by
+            # `FoodTruckListView`
+            logger.exception("Could not compute the food trucks response")
+            return JsonResponse({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            print(traceback.format_exc())
+            logger.exception("Could not compute the food trucks response")
+            return JsonResponse({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def parse_point(point):
+    """
+    Validate a point of a batch request, see `parse_location_query`.
+    """
+    if not isinstance(point, dict):
+        raise ValueError("Each point must be an object.")
+    return parse_location_query(point)
+
+
+def stream_batch_results(points, fields):
+    """
+    Yield the JSON array of a batch response, one chunk of points at a time.
+    Each item is either the list `FoodTruckListView` would return for the
+    point or a {"message": ...} error.
+    """
+    yield "["
+    chunk_size = settings.BATCH_CHUNK_POINTS
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start : start + chunk_size]
+        results = [None] * len(chunk)
+        try:
+            valid = []
+            for position, point in enumerate(chunk):
+                try:
+                    valid.append((position, parse_point(point)))
+                except ValueError as e:
+                    results[position] = json.dumps({"message": str(e)})
+
+            # One index pass per distinct time filter for the whole chunk
+            candidates = utils.get_top_ten_closet_trucks_for_points(
+                [point for _, point in valid]
+            )
+            origins = []
+            for (position, point), trucks in zip(valid, candidates):
+                if isinstance(trucks, ValueError):
+                    results[position] = json.dumps({"message": str(trucks)})
+                else:
+                    origins.append((position, point[0], point[1], trucks))
+
+            # Walking times are looked up once per cache cell and truck
+            ranked = utils.get_top_five_closet_trucks_for_origins(
+                [(lat, long, trucks) for _, lat, long, trucks in origins]
+            )
+            for (position, _, _, _), top_five in zip(origins, ranked):
+                if isinstance(top_five, KeyError):
+                    results[position] = json.dumps(
+                        {
+                            "message": "Could not get walking distance from the specified location"
+                        }
+                    )
+                else:
+                    results[position] = build_response(top_five, fields)
+        except Exception as e:
+            # The response has already started, report the error in place
+            logger.exception("Could not compute a chunk of the batch response")
+            error = json.dumps({"message": str(e)})
+            results = [result or error for result in results]
+        yield ("," if start else "") + ",".join(results)
+    yield "]"
+
+
+class FoodTruckBatchView(APIView):
+    throttle_classes = [AnonRateThrottle]
+
+    def post(self, request):
+        """
+        Returns the top 5 closest trucks by walking time for each point of a batch.
+        The body holds `points`, a list of objects with the parameters of
+        `FoodTruckListView` (`latitude`, `longitude` and optionally `time`,
+        `timezone` and `open_within`), and optionally `fields`. Results are
+        streamed back in the order of the points.
+        """
+        points = request.data.get("points") if isinstance(request.data, dict) else None
+        if not isinstance(points, list) or not points:
+            return Response(
+                {"message": "A non-empty list of points is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(points) > settings.BATCH_MAX_POINTS:
+            return Response(
+                {
+                    "message": f"At most {settings.BATCH_MAX_POINTS} points are accepted per batch."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Validate the requested truck detail fields, given as a list or like
+        # the query parameter
+        fields = request.data.get("fields")
+        if isinstance(fields, list):
+            fields = ",".join(str(name) for name in fields)
+        try:
+            fields = parse_fields(fields)
+        except ValueError as e:
             return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return StreamingHttpResponse(
+            stream_batch_results(points, fields), content_type="application/json"
+        )
+
+
+class ResponseCacheStatsView(APIView):
+    throttle_classes = [AnonRateThrottle]
+
+    def get(self, request):
+        """
+        Returns the hit/miss counters of the food trucks response cache.
+        """
+        return Response(response_cache.get_stats())
+
+
+class RequestMetricsView(APIView):
+    throttle_classes = [AnonRateThrottle]
+
+    def get(self, request):
+        """
+        Returns the latency percentiles per route and stage, along with the
+        database query and external call counts, of the requests served by
+        this process. `walking_time_coalescer` has the counters of the Google
+        Maps lookups merged across requests, when enabled, and `google_client`
+        those of the Google Maps client (hedges, retries, circuit breaker) once
+        it was used.
+        """
+        metrics = profiling.request_metrics.snapshot()
+        # Only once a lookup built the client, reading its stats must not
+        # import the HTTP clients
+        client = peek_google_client()
+        if client is not None:
+            metrics["google_client"] = client.stats()
+        coalescer = getattr(get_walking_time_provider(), "coalescer", None)
+        if coalescer is not None and settings.WALKING_TIME_COALESCE_ENABLED:
+            metrics["walking_time_coalescer"] = coalescer.stats()
+        return Response(metrics)
@@ -0,0 +1,450 @@
+import abc
+import asyncio
+import contextvars
+import functools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .coalescer import WalkingTimeCoalescer
+from .models import WalkingTimeCacheEntry
+from .profiling import external_call
+from .ranking import EARTH_RADIUS_METERS
+from .street_graph import get_street_graph
+
+METERS_PER_DEGREE_LATITUDE = 111_320
+
+_google_client = None
+_google_client_lock = threading.Lock()
+
+# Set while building a response from offline estimates instead of provider
+# walking times, the response cache does not store such responses. None
+# outside of the response cache, where nothing needs to know
+serving_estimates = contextvars.ContextVar("serving_estimates", default=None)
+
+
+def get_google_client():
+    """
+    Return the Distance Matrix client shared by the whole process, built on
+    first use. Importing googlemaps, requests and httpx takes a few hundred
+    milliseconds, which management commands and workers answering from the
+    caches never pay.
+    """
+    global _google_client
+    if _google_client is None:
+        with _google_client_lock:
+            if _google_client is None:
+                from .google_client import ResilientDistanceMatrixClient
+
+                _google_client = ResilientDistanceMatrixClient.from_settings()
+    return _google_client
+
+
+def peek_google_client():
+    """
+    Return the Distance Matrix client of the process, or None when nothing
+    has needed it yet. Unlike `get_google_client`, never builds it.
+    """
+    return _google_client
+
+
+def snap_to_cell(lat, long, cell_meters):
+    """
+    Snap a coordinate to a square grid cell roughly `cell_meters` wide and
+    return the cell identifier. Every origin inside the cell shares the same id.
+    """
+    lat_step = cell_meters / METERS_PER_DEGREE_LATITUDE
+    row = math.floor(lat / lat_step)
+    # Longitude degrees shrink with latitude, the cell row fixes the scale
+    # so that every point of the row uses the same column width
+    row_lat = math.radians((row + 0.5) * lat_step)
+    long_step = lat_step / max(math.cos(row_lat), 1e-6)
+    column = math.floor(long / long_step)
+    return f"{cell_meters}:{row}:{column}"
+
+
+def wrap_element(element):
+    """
+    Present a single Distance Matrix element the way a one-origin,
+    one-destination `distance_matrix` response would.
+    """
+    return {"status": "OK", "rows": [{"elements": [element]}]}
+
+
+def is_reachable(element):
+    """
+    Whether a Distance Matrix element holds a walking time, rather than e.g.
+    ZERO_RESULTS or NOT_FOUND for a destination no route reaches.
+    """
+    return element.get("status") == "OK"
+
+
+class WalkingTimeCache:
+    """
+    Persistent cache of walking times keyed on (origin cell, truck).
+
+    Entries live in the WalkingTimeCacheEntry table, so they survive restarts and
+    are shared by every worker. Entries older than WALKING_TIME_CACHE_TTL are
+    ignored, and the least recently used ones are evicted past
+    WALKING_TIME_CACHE_MAX_ENTRIES.
+
+    To keep writes off the read path, the last use of an entry is only
+    recorded once per `touch_interval`, and each worker evicts at most once
+    per `evict_interval`, so the table can briefly outgrow the limit.
+    """
+
+    touch_interval = 60  # In seconds
+    evict_interval = 60  # In seconds
+
+    def __init__(self):
+        self._next_eviction = 0.0
+
+    @property
+    def enabled(self):
+        return settings.WALKING_TIME_CACHE_ENABLED
+
+    def cell_for(self, lat, long):
+        return snap_to_cell(lat, long, settings.WALKING_TIME_CACHE_CELL_METERS)
+
+    def get_many(self, lat, long, truck_ids):
+        """
+        Return a {truck_id: element} dict of the fresh cached elements for the
+        given origin and trucks.
+        """
+        if not self.enabled or not truck_ids:
+            return {}
+        now = timezone.now()
+        fresh_after = now - timedelta(seconds=settings.WALKING_TIME_CACHE_TTL)
+        entries = list(
+            WalkingTimeCacheEntry.objects.filter(
+                origin_cell=self.cell_for(lat, long),
+                food_truck_id__in=truck_ids,
+                created_at__gte=fresh_after,
+            ).values_list("id", "food_truck_id", "element", "last_used_at")
+        )
+        touched_before = now - timedelta(seconds=self.touch_interval)
+        stale_ids = [
+            entry_id
+            for entry_id, _, _, last_used_at in entries
+            if last_used_at < touched_before
+        ]
+        if stale_ids:
+            # Refresh the LRU position of the hits in a single statement
+            WalkingTimeCacheEntry.objects.filter(id__in=stale_ids).update(
+                last_used_at=now
+            )
+        return {truck_id: element for _, truck_id, element, _ in entries}
+
+    def set_many(self, lat, long, elements):
+        """
+        Store a {truck_id: element} dict of elements for the given origin.
+        """
+        # Unreachable destinations are asked for again rather than remembered
+        elements = {
+            truck_id: element
+            for truck_id, element in elements.items()
+            if is_reachable(element)
+        }
+        if not self.enabled or not elements:
+            return
+        now = timezone.now()
+        origin_cell = self.cell_for(lat, long)
+        try:
+            with transaction.atomic():
+                # Replace the expired entries being refreshed
+                WalkingTimeCacheEntry.objects.filter(
+                    origin_cell=origin_cell, food_truck_id__in=list(elements)
+                ).delete()
+                WalkingTimeCacheEntry.objects.bulk_create(
+                    [
+                        WalkingTimeCacheEntry(
+                            origin_cell=origin_cell,
+                            food_truck_id=truck_id,
+                            element=element,
+                            created_at=now,
+                            last_used_at=now,
+                        )
+                        for truck_id, element in elements.items()
+                    ]
+                )
+        except IntegrityError:
+            # Another worker stored the same entries concurrently
+            return
+        if time.monotonic() >= self._next_eviction:
+            self._next_eviction = time.monotonic() + self.evict_interval
+            self.evict()
+
+    def evict(self):
+        """
+        Delete expired entries and the least recently used ones past the size limit.
+        """
+        expired_before = timezone.now() - timedelta(
+            seconds=settings.WALKING_TIME_CACHE_TTL
+        )
+        WalkingTimeCacheEntry.objects.filter(created_at__lt=expired_before).delete()
+
+        overflow = (
+            WalkingTimeCacheEntry.objects.count()
+            - settings.WALKING_TIME_CACHE_MAX_ENTRIES
+        )
+        if overflow > 0:
+            oldest = WalkingTimeCacheEntry.objects.order_by("last_used_at").values_list(
+                "id", flat=True
+            )[:overflow]
+            WalkingTimeCacheEntry.objects.filter(id__in=list(oldest)).delete()
+
+    def clear(self):
+        WalkingTimeCacheEntry.objects.all().delete()
+
+
+walking_time_cache = WalkingTimeCache()
+
+
+class WalkingTimeProvider(abc.ABC):
+    """
+    Source of walking times from one origin to many destinations.
+
+    Subclasses implement `get_elements`, returning one Distance Matrix style
+    element ({"status", "distance", "duration"}) per destination, in order.
+    The provider in use is selected by the WALKING_TIME_PROVIDER setting.
+    """
+
+    @abc.abstractmethod
+    def get_elements(self, lat, long, destinations):
+        pass
+
+    async def get_elements_async(self, lat, long, destinations):
+        """
+        Async variant of `get_elements`, returning None for the destinations
+        whose lookup did not finish in time. Providers without a native async
+        implementation run the sync one in a worker thread.
+        """
+        try:
+            return await asyncio.wait_for(
+                sync_to_async(self.get_elements, thread_sensitive=False)(
+                    lat, long, destinations
+                ),
+                timeout=settings.WALKING_TIME_DEADLINE,
+            )
+        except asyncio.TimeoutError as e:
+            raise ConnectionError("Timed out fetching walking times.") from e
+
+
+class GoogleDistanceMatrixProvider(WalkingTimeProvider):
+    """
+    Walking times from the Google Distance Matrix API, sending every
+    destination in as few requests as the API limits allow.
+    """
+
+    # The API accepts at most 25 destinations per request
+    max_destinations = 25
+
+    def __init__(self, client=None):
+        self.client = client
+        self.coalescer = WalkingTimeCoalescer(
+            self._request_matrix, walking_time_cache.cell_for
+        )
+
+    def get_elements(self, lat, long, destinations):
+        if settings.WALKING_TIME_COALESCE_ENABLED:
+            # Sent along with the lookups of concurrent requests
+            with external_call("google"):
+                return self.coalescer.lookup(lat, long, destinations)
+
+        chunks = [
+            destinations[i : i + self.max_destinations]
+            for i in range(0, len(destinations), self.max_destinations)
+        ]
+        if len(chunks) > 1:
+            # Rare, only when more than 25 candidates are requested at once
+            # Each thread runs in a copy of the request's context, so that its
+            # calls are counted in the request profile
+            calls = [
+                functools.partial(
+                    contextvars.copy_context().run, self._request, lat, long, chunk
+                )
+                for chunk in chunks
+            ]
+            with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+                responses = list(executor.map(lambda call: call(), calls))
+        else:
+            responses = [self._request(lat, long, chunk) for chunk in chunks]
+        return [
+            element
+            for response in responses
+            for element in response["rows"][0]["elements"]
+        ]
+
+    async def get_elements_async(self, lat, long, destinations):
+        if settings.WALKING_TIME_COALESCE_ENABLED:
+            with external_call("google"):
+                return await self.coalescer.lookup_async(lat, long, destinations)
+        if self.client is not None:
+            # Injected clients (e.g. in benchmarks) only have the sync interface
+            return await super().get_elements_async(lat, long, destinations)
+
+        chunks = [
+            destinations[i : i + self.max_destinations]
+            for i in range(0, len(destinations), self.max_destinations)
+        ]
+        tasks = [
+            asyncio.create_task(self._request_async(lat, long, chunk))
+            for chunk in chunks
+        ]
+        # Stragglers still running once the deadline is over are cancelled,
+        # their trucks are left without a walking time
+        done, pending = await asyncio.wait(
+            tasks, timeout=settings.WALKING_TIME_DEADLINE
+        )
+        for task in pending:
+            task.cancel()
+
+        elements = []
+        for task, chunk in zip(tasks, chunks):
+            if task in done and task.exception() is None:
+                elements.extend(task.result())
+            else:
+                elements.extend([None] * len(chunk))
+        if all(element is None for element in elements):
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+            raise ConnectionError("Timed out connecting to Google Maps API.")
+        return elements
+
+    async def _request_async(self, lat, long, destinations):
+        try:
+            with external_call("google"):
+                response = await get_google_client().distance_matrix_async(
+                    (lat, long), destinations, mode="walking"
+                )
+        except Exception as e:
+            raise ConnectionError("Error connecting to Google Maps API.") from e
+        return response["rows"][0]["elements"]
+
+    def _request(self, lat, long, destinations):
+        try:
+            # A client that cannot be built (e.g. a malformed key) fails like
+            # the service
+            client = self.client or get_google_client()
+            with external_call("google"):
+                return client.distance_matrix((lat, long), destinations, mode="walking")
+        except Exception as e:
+            # Raise an error if there's an issue with the API call
+            raise ConnectionError("Error connecting to Google Maps API.") from e
+
+    def _request_matrix(self, origins, destinations):
+        """
+        One multi-origin call for the coalescer, returning a row of elements
+        per origin.
+        """
+        try:
+            client = self.client or get_google_client()
+            return client.distance_matrix(origins, destinations, mode="walking")["rows"]
+        except Exception as e:
+            raise ConnectionError("Error connecting to Google Maps API.") from e
+
+
+def walking_element(meters, walking_speed):
+    """
+    Build a Distance Matrix-like element for walking `meters` meters.
+    """
+    meters = round(meters)
+    seconds = round(meters / walking_speed)
+    minutes = max(1, round(seconds / 60))
+    return {
+        "status": "OK",
+        "distance": {"text": f"{meters / 1000:.1f} km", "value": meters},
+        "duration": {
+            "text": f"{minutes} min" if minutes == 1 else f"{minutes} mins",
+            "value": seconds,
+        },
+    }
+
+
+class StubWalkingTimeProvider(WalkingTimeProvider):
+    """
+    Offline provider estimating walking times from the straight-line distance.
+    Meant for tests and benchmarks, it never performs a network call.
+    """
+
+    # Streets are rarely straight, and people walk at about 5 km/h
+    detour_factor = 1.3
+    walking_speed = 1.4  # In meters per second
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_elements(self, lat, long, destinations):
+        self.calls += 1
+        return [
+            self.estimate(lat, long, float(dest_lat), float(dest_long))
+            for dest_lat, dest_long in destinations
+        ]
+
+    def estimate(self, lat, long, dest_lat, dest_long):
+        half_dlat = math.radians(dest_lat - lat) / 2
+        half_dlong = math.radians(dest_long - long) / 2
+        a = math.sin(half_dlat) ** 2 + math.cos(math.radians(lat)) * math.cos(
+            math.radians(dest_lat)
+        ) * (math.sin(half_dlong) ** 2)
+        meters = (
+            2
+            * EARTH_RADIUS_METERS
+            * math.asin(min(1.0, math.sqrt(a)))
+            * self.detour_factor
+        )
+        return walking_element(meters, self.walking_speed)
+
+
+class OfflineWalkingTimeProvider(StubWalkingTimeProvider):
+    """
+    Provider computing walking times on the street graph imported with
+    `import_street_graph`, without any network call. Destinations the graph
+    cannot reach, or every destination when no graph was imported, fall back
+    to the straight-line estimate of `StubWalkingTimeProvider`.
+    """
+
+    def get_elements(self, lat, long, destinations):
+        self.calls += 1
+        destinations = [
+            (float(dest_lat), float(dest_long)) for dest_lat, dest_long in destinations
+        ]
+        graph = get_street_graph()
+        if graph is None or not len(graph):
+            return [
+                self.estimate(lat, long, *destination) for destination in destinations
+            ]
+
+        return [
+            (
+                self.estimate(lat, long, *destination)
+                if meters is None
+                else walking_element(meters, self.walking_speed)
+            )
+            for destination, meters in zip(
+                destinations, graph.walking_meters(lat, long, destinations)
+            )
+        ]
+
+
+offline_walking_time_provider = OfflineWalkingTimeProvider()
+
+
+_providers = {}
+
+
+def get_walking_time_provider():
+    """
+    Return the walking time provider configured by WALKING_TIME_PROVIDER.
+    """
+    path = settings.WALKING_TIME_PROVIDER
+    if path not in _providers:
+        _providers[path] = import_string(path)()
+    return _providers[path]
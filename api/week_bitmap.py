@@ -0,0 +1,71 @@
+import numpy as np
+
+# Weekly availability of a truck as one bit per quarter hour: 7 days x 96
+# slots, packed in 84 bytes. Slot s covers [s * SLOT_SECONDS, (s + 1) * SLOT_SECONDS)
+# seconds since Monday 00:00. This module does not import the models, so the
+# CSV parsing workers can use it.
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+SLOT_SECONDS = 15 * 60
+SLOTS_PER_DAY = SECONDS_PER_DAY // SLOT_SECONDS
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+BITMAP_BYTES = SLOTS_PER_WEEK // 8
+
+
+def second_of_week(day_index, time_value):
+    """
+    Position of a time of day within the week, in seconds since Monday 00:00.
+    """
+    return (
+        day_index * SECONDS_PER_DAY
+        + time_value.hour * 3600
+        + time_value.minute * 60
+        + time_value.second
+    )
+
+
+def encode_week_bitmap(hours):
+    """
+    Pack operating hours, an iterable of (day name, open_time, close_time), into
+    a weekly bitmap.
+
+    The slots covered by [open, close) are set. Hours of the feed fall on
+    quarter hours, other times are rounded outwards. Closing times are
+    inclusive, which readers handle by also checking the slot before a slot
+    boundary (see `OpenHoursIndex`). As before, an interval whose close time is
+    not after its open time (e.g. 8PM-2AM) never matches.
+    """
+    slots = np.zeros(SLOTS_PER_WEEK, dtype=bool)
+    for day, open_time, close_time in hours:
+        day_index = DAYS.index(day)
+        start = second_of_week(day_index, open_time)
+        end = second_of_week(day_index, close_time)
+        if end > start:
+            slots[start // SLOT_SECONDS : -(-end // SLOT_SECONDS)] = True
+    return np.packbits(slots, bitorder="little").tobytes()
+
+
+def decode_week_bitmap(bitmap):
+    """
+    Unpack a weekly bitmap into an array of SLOTS_PER_WEEK booleans. A missing
+    bitmap means the truck has no operating hours.
+    """
+    if not bitmap:
+        return np.zeros(SLOTS_PER_WEEK, dtype=bool)
+    return np.unpackbits(
+        np.frombuffer(bytes(bitmap), dtype=np.uint8), bitorder="little"
+    ).astype(bool)
+
+
+def stack_week_bitmaps(bitmaps):
+    """
+    Stack weekly bitmaps into a (len(bitmaps), BITMAP_BYTES) uint8 matrix, a
+    missing bitmap being a row of zeros.
+    """
+    matrix = np.zeros((len(bitmaps), BITMAP_BYTES), dtype=np.uint8)
+    for row, bitmap in enumerate(bitmaps):
+        if bitmap:
+            matrix[row] = np.frombuffer(bytes(bitmap), dtype=np.uint8)
+    return matrix
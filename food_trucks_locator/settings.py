@@ -12,14 +12,170 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 from decouple import config
-import googlemaps
 
 GOOGLE_MAPS_API_KEY = config("GOOGLE_MAPS_API_KEY")
 CACHE_TIMEOUT = int(config("CACHE_TIMEOUT"))  # In seconds
 SECRET_KEY = config("SECRET_KEY")
 DEBUG = config("DEBUG", cast=bool, default=False)
 ANON_THROTTLE_RATE_PER_MINUTE = config("ANON_THROTTLE_RATE_PER_MINUTE")
-gmaps = googlemaps.Client(GOOGLE_MAPS_API_KEY)
+# Cache backend shared by the workers: "locmem" (per process), "file",
+# "database" (works offline, needs `python manage.py createcachetable`) or
+# "redis" (needs the `redis` package). CACHE_LOCATION overrides the default
+# directory, table name or Redis URL.
+CACHE_BACKEND = config("CACHE_BACKEND", default="locmem")
+CACHE_LOCATION = config("CACHE_LOCATION", default="")
+# Expired responses are still served for this long (in seconds) while a single
+# worker refreshes them
+RESPONSE_CACHE_STALE_TTL = config("RESPONSE_CACHE_STALE_TTL", cast=int, default=600)
+# Upper bound (in seconds) on how long other workers wait for the worker
+# computing a missing response
+RESPONSE_CACHE_LOCK_TIMEOUT = config(
+    "RESPONSE_CACHE_LOCK_TIMEOUT", cast=int, default=30
+)
+# How query coordinates are snapped in the response cache key: "grid" (rounded
+# to RESPONSE_CACHE_GRID_DECIMALS), "geohash" (RESPONSE_CACHE_GEOHASH_PRECISION
+# characters) or "exact"
+RESPONSE_CACHE_COORDINATE_MODE = config(
+    "RESPONSE_CACHE_COORDINATE_MODE", default="grid"
+)
+RESPONSE_CACHE_GRID_DECIMALS = config(
+    "RESPONSE_CACHE_GRID_DECIMALS", cast=int, default=4
+)
+RESPONSE_CACHE_GEOHASH_PRECISION = config(
+    "RESPONSE_CACHE_GEOHASH_PRECISION", cast=int, default=8
+)
+# Number of straight-line candidates passed on to the walking time ranking
+NEAREST_TRUCKS_K = config("NEAREST_TRUCKS_K", cast=int, default=10)
+# Optional GeoDjango mode: "spatialite" or "postgis" store truck locations as
+# points with a spatial index (needs GDAL, and SpatiaLite or psycopg2)
+SPATIAL_BACKEND = config("SPATIAL_BACKEND", default="")
+# Where straight-line candidates come from: "index" (an in-memory k-d tree per
+# process), "database" (bounding box queries growing from
+# NEAREST_TRUCKS_START_RADIUS_METERS, nothing held in memory) or "spatial"
+# (nearest first from the spatial database, the default with SPATIAL_BACKEND)
+NEAREST_TRUCKS_SOURCE = config(
+    "NEAREST_TRUCKS_SOURCE", default="spatial" if SPATIAL_BACKEND else "index"
+)
+# Trucks fetched per candidate by spatial queries, doubled until enough
+SPATIAL_KNN_OVERFETCH = config("SPATIAL_KNN_OVERFETCH", cast=int, default=3)
+NEAREST_TRUCKS_START_RADIUS_METERS = config(
+    "NEAREST_TRUCKS_START_RADIUS_METERS", cast=float, default=500
+)
+# Re-rank the final candidates by exact geodesic distance (slower, but the
+# ordering is identical to a full geopy scan)
+GEODESIC_RERANK = config("GEODESIC_RERANK", cast=bool, default=True)
+# How often (in seconds) a process checks whether its truck index is stale
+TRUCK_INDEX_REFRESH_SECONDS = config(
+    "TRUCK_INDEX_REFRESH_SECONDS", cast=int, default=60
+)
+# Straight-line candidates precomputed over a grid of ANSWER_GRID_CELL_METERS
+# cells, ANSWER_GRID_CANDIDATES per cell, rebuilt by `load_food_trucks`
+ANSWER_GRID_ENABLED = config("ANSWER_GRID_ENABLED", cast=bool, default=True)
+ANSWER_GRID_CELL_METERS = config("ANSWER_GRID_CELL_METERS", cast=int, default=250)
+ANSWER_GRID_CANDIDATES = config("ANSWER_GRID_CANDIDATES", cast=int, default=40)
+ANSWER_GRID_MAX_CELLS = config("ANSWER_GRID_MAX_CELLS", cast=int, default=250_000)
+# Per-stage request timings (Server-Timing headers and /api/food-trucks/metrics/)
+PROFILING_ENABLED = config("PROFILING_ENABLED", cast=bool, default=True)
+# Fraction of the requests run under cProfile, whose profile is dumped to
+# PROFILING_DUMP_DIR when they take longer than PROFILING_SLOW_REQUEST_MS
+PROFILING_SAMPLE_RATE = config("PROFILING_SAMPLE_RATE", cast=float, default=0.0)
+PROFILING_SLOW_REQUEST_MS = config(
+    "PROFILING_SLOW_REQUEST_MS", cast=float, default=1000
+)
+# How long (in seconds) the current dataset version is cached between lookups
+DATASET_VERSION_CACHE_SECONDS = config(
+    "DATASET_VERSION_CACHE_SECONDS", cast=int, default=10
+)
+# Truck details pre-rendered to JSON kept in memory, per process
+TRUCK_FRAGMENT_CACHE_MAX_ENTRIES = config(
+    "TRUCK_FRAGMENT_CACHE_MAX_ENTRIES", cast=int, default=10000
+)
+# Largest batch accepted by the batch endpoint, and number of points computed
+# (and streamed back) together
+BATCH_MAX_POINTS = config("BATCH_MAX_POINTS", cast=int, default=1000)
+BATCH_CHUNK_POINTS = config("BATCH_CHUNK_POINTS", cast=int, default=50)
+# Dotted path of the class providing walking times (see api/walking_time.py)
+WALKING_TIME_PROVIDER = config(
+    "WALKING_TIME_PROVIDER", default="api.walking_time.GoogleDistanceMatrixProvider"
+)
+# Timeout of a single walking time request, and overall deadline after which
+# the async endpoint stops waiting for the remaining ones (in seconds)
+WALKING_TIME_TIMEOUT = config("WALKING_TIME_TIMEOUT", cast=float, default=5)
+WALKING_TIME_DEADLINE = config("WALKING_TIME_DEADLINE", cast=float, default=8)
+# Persistent walking time cache, shared by every worker through the database
+WALKING_TIME_CACHE_ENABLED = config(
+    "WALKING_TIME_CACHE_ENABLED", cast=bool, default=True
+)
+# Origins closer than this (in meters) share their cached walking times
+WALKING_TIME_CACHE_CELL_METERS = config(
+    "WALKING_TIME_CACHE_CELL_METERS", cast=int, default=25
+)
+WALKING_TIME_CACHE_TTL = config(
+    "WALKING_TIME_CACHE_TTL", cast=int, default=7 * 24 * 60 * 60
+)  # In seconds
+WALKING_TIME_CACHE_MAX_ENTRIES = config(
+    "WALKING_TIME_CACHE_MAX_ENTRIES", cast=int, default=100_000
+)
+# When a street graph (see STREET_GRAPH_PATH) is available, only the WALKING_TIME_PREFILTER_K
+# candidates with the shortest estimated walk are sent to the provider (0 to
+# send them all)
+WALKING_TIME_PREFILTER_K = config("WALKING_TIME_PREFILTER_K", cast=int, default=7)
+# Serve offline estimates, without caching them, when the provider fails
+WALKING_TIME_OFFLINE_FALLBACK = config(
+    "WALKING_TIME_OFFLINE_FALLBACK", cast=bool, default=True
+)
+# Look walking times up by increasing lower bound, until the top 5 is certain,
+# instead of for the NEAREST_TRUCKS_K candidates only (see
+# AdaptiveWalkingSearch). Exact, but it asks for slightly more walking times
+WALKING_TIME_ADAPTIVE = config("WALKING_TIME_ADAPTIVE", cast=bool, default=False)
+# Upper bound of the walking speed (in meters per second) giving each truck's
+# shortest possible walk, Google Maps assumes about 1.39 (5 km/h)
+WALKING_TIME_MAX_SPEED = config("WALKING_TIME_MAX_SPEED", cast=float, default=1.45)
+# Most trucks looked up per round after the first 5 (25 fit in one Distance
+# Matrix request), and most straight-line candidates considered
+WALKING_TIME_ROUND_SIZE = config("WALKING_TIME_ROUND_SIZE", cast=int, default=25)
+WALKING_TIME_MAX_CANDIDATES = config(
+    "WALKING_TIME_MAX_CANDIDATES", cast=int, default=40
+)
+# Merge the Google Maps lookups of concurrent requests: lookups are collected
+# for WALKING_TIME_COALESCE_WINDOW_MS, deduplicated per walking time cache cell
+# and sent by a pool of WALKING_TIME_COALESCE_WORKERS threads per process
+WALKING_TIME_COALESCE_ENABLED = config(
+    "WALKING_TIME_COALESCE_ENABLED", cast=bool, default=True
+)
+WALKING_TIME_COALESCE_WINDOW_MS = config(
+    "WALKING_TIME_COALESCE_WINDOW_MS", cast=float, default=5
+)
+WALKING_TIME_COALESCE_WORKERS = config(
+    "WALKING_TIME_COALESCE_WORKERS", cast=int, default=16
+)
+# Google Maps client (see ResilientDistanceMatrixClient): pooled connections,
+# client-side quota in elements per second, hedging of calls slower than
+# GOOGLE_MAPS_HEDGE_AFTER_MS (0 to disable) and a circuit breaker opening for
+# GOOGLE_MAPS_BREAKER_RESET_SECONDS after GOOGLE_MAPS_BREAKER_FAILURES failed
+# calls in a row. GOOGLE_MAPS_BASE_URL can point to `fake_google_server`.
+GOOGLE_MAPS_BASE_URL = config(
+    "GOOGLE_MAPS_BASE_URL", default="https://maps.googleapis.com"
+)
+GOOGLE_MAPS_POOL_SIZE = config("GOOGLE_MAPS_POOL_SIZE", cast=int, default=32)
+GOOGLE_MAPS_ELEMENTS_PER_SECOND = config(
+    "GOOGLE_MAPS_ELEMENTS_PER_SECOND", cast=float, default=1000
+)
+GOOGLE_MAPS_BURST_ELEMENTS = config(
+    "GOOGLE_MAPS_BURST_ELEMENTS", cast=float, default=1000
+)
+GOOGLE_MAPS_RATE_LIMIT_WAIT = config(
+    "GOOGLE_MAPS_RATE_LIMIT_WAIT", cast=float, default=1
+)  # In seconds
+GOOGLE_MAPS_HEDGE_AFTER_MS = config(
+    "GOOGLE_MAPS_HEDGE_AFTER_MS", cast=float, default=600
+)
+GOOGLE_MAPS_BREAKER_FAILURES = config(
+    "GOOGLE_MAPS_BREAKER_FAILURES", cast=int, default=5
+)
+GOOGLE_MAPS_BREAKER_RESET_SECONDS = config(
+    "GOOGLE_MAPS_BREAKER_RESET_SECONDS", cast=float, default=30
+)
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,8 +205,12 @@ INSTALLED_APPS = [
     "api",
     "rest_framework",
 ]
+if SPATIAL_BACKEND:
+    INSTALLED_APPS += ["django.contrib.gis", "api.geo"]
 
 MIDDLEWARE = [
+    # First, so that the timings cover the whole request
+    "api.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -107,6 +267,61 @@ DATABASES = {
     }
 }
 
+if SPATIAL_BACKEND == "spatialite":
+    DATABASES["default"]["ENGINE"] = "django.contrib.gis.db.backends.spatialite"
+    SPATIALITE_LIBRARY_PATH = config(
+        "SPATIALITE_LIBRARY_PATH", default="mod_spatialite"
+    )
+elif SPATIAL_BACKEND == "postgis":
+    DATABASES["default"] = {
+        "ENGINE": "django.contrib.gis.db.backends.postgis",
+        "NAME": config("DATABASE_NAME", default="food_trucks"),
+        "USER": config("DATABASE_USER", default="postgres"),
+        "PASSWORD": config("DATABASE_PASSWORD", default=""),
+        "HOST": config("DATABASE_HOST", default="localhost"),
+        "PORT": config("DATABASE_PORT", default="5432"),
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHE_BACKENDS = {
+    "locmem": ("django.core.cache.backends.locmem.LocMemCache", ""),
+    "file": (
+        "api.cache_backends.AtomicFileBasedCache",
+        str(BASE_DIR / "cache"),
+    ),
+    "database": ("django.core.cache.backends.db.DatabaseCache", "food_trucks_cache"),
+    "redis": ("django.core.cache.backends.redis.RedisCache", "redis://127.0.0.1:6379"),
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": CACHE_BACKENDS[CACHE_BACKEND][0],
+        "LOCATION": CACHE_LOCATION or CACHE_BACKENDS[CACHE_BACKEND][1],
+    }
+}
+
+# Columnar snapshot of the trucks written by `load_food_trucks`, memory-mapped
+# by every worker to answer the nearest truck, open hours and truck details
+# lookups without the database
+TRUCK_SNAPSHOT_ENABLED = config("TRUCK_SNAPSHOT_ENABLED", cast=bool, default=True)
+TRUCK_SNAPSHOT_PATH = config(
+    "TRUCK_SNAPSHOT_PATH", default=str(BASE_DIR / "trucks.snapshot")
+)
+# Street graph imported with `python manage.py import_street_graph`, used to
+# estimate walking times offline
+STREET_GRAPH_PATH = config(
+    "STREET_GRAPH_PATH", default=str(BASE_DIR / "street_graph.npz")
+)
+# Where the cProfile dumps of slow requests are written
+PROFILING_DUMP_DIR = config("PROFILING_DUMP_DIR", default=str(BASE_DIR / "profiles"))
+# Median startup, in milliseconds, allowed by the startup section of
+# `python manage.py benchmark_suite` for a WSGI worker and each management
+# command it times
+STARTUP_BUDGET_MS = config("STARTUP_BUDGET_MS", cast=float, default=1500)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators